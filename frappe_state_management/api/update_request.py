@@ -1,10 +1,47 @@
+from collections import OrderedDict
+
 import frappe
-from frappe.utils import now_datetime
-from frappe_state_management.frappe_state_management.doctype.update_request.update_request import UpdateRequest
+from frappe import _
+from frappe.utils import now_datetime, cint
+from frappe_state_management.classes import fsm_checkpoint, fsm_concurrency, fsm_dispatch, fsm_feed, fsm_fifo, \
+  fsm_inbox, fsm_queue, fsm_trace
+from frappe_state_management.classes.fsm_bulk import bulk_insert_documents
+from frappe_state_management.classes.fsm_concurrency import load_target
+from frappe_state_management.classes.fsm_error import DuplicateUpdateRequestError
+from frappe_state_management.frappe_state_management.doctype.update_request.update_request import UpdateRequest, \
+  get_by_idempotency_scope, save_update_requests
+from frappe_state_management.frappe_state_management.doctype.update_request_archive.update_request_archive import \
+  UpdateRequestArchive
 
 dt = 'Update Request'
 
 
+@frappe.whitelist()
+def submit_update_request(update_request) -> dict:
+  """
+  Insert and submit an update request.
+  If it has an `idempotency_key` already used on the same document, the existing update request's outcome is returned
+  instead, so clients can safely retry a submission
+  :param update_request: The update request (dict with the Update Request fields)
+  :return: The outcome of the update request
+  """
+  update_request_doc: UpdateRequest = frappe.get_doc(dict(frappe.parse_json(update_request), doctype=dt))
+  existing = get_by_idempotency_scope(update_request_doc.get_idempotency_scope())
+  if existing:
+    return _get_result(existing)
+
+  try:
+    update_request_doc.insert()
+    update_request_doc.submit()
+  except DuplicateUpdateRequestError:
+    # A concurrent retry was inserted first
+    existing = get_by_idempotency_scope(update_request_doc.get_idempotency_scope())
+    if not existing:
+      raise
+    return _get_result(existing)
+  return _get_result(update_request_doc)
+
+
 @frappe.whitelist()
 def approve(update_request: str) -> dict:
   """
@@ -21,6 +58,7 @@ def approve(update_request: str) -> dict:
     update_request_doc.approved_by = user
     update_request_doc.approved_on = now_datetime()
     update_request_doc.save()
+    fsm_inbox.clear_pending_counts(update_request_doc.approval_party)
   return update_request_doc.as_dict()
 
 
@@ -40,16 +78,450 @@ def reject(update_request: str) -> dict:
     update_request_doc.rejected_by = user
     update_request_doc.rejected_on = now_datetime()
     update_request_doc.save()
+    fsm_inbox.clear_pending_counts(update_request_doc.approval_party)
+    fsm_feed.record([update_request_doc])
   return update_request_doc.as_dict()
 
 
 @frappe.whitelist()
-def revert(update_request: str) -> dict:
+def approve_many(update_requests) -> list:
+  """
+  Approve many update requests in a single call.
+  Update requests are grouped by their target document. Each target is loaded once, its update requests are applied
+  in creation order and it's saved once. Targets of queued doctypes are enqueued once instead of being applied.
+  Every target runs under its own savepoint, so a failing target does not roll back the rest of the batch.
+  Update requests that are not Pending Approval are returned as-is, the ones the user can't write are reported as
+  not permitted
+  :param update_requests: List of update request names
+  :return: The outcome of every update request, in the given order
+  """
+  if not frappe.has_permission(dt, 'write'):
+    frappe.throw(_('Not permitted'), frappe.PermissionError)
+
+  user, now = frappe.session.user, now_datetime()
+  names = _parse_names(update_requests)
+  results = OrderedDict((name, _get_missing_result(name)) for name in names)
+  groups = OrderedDict()
+  for row in _lock_update_requests(names):
+    update_request_doc: UpdateRequest = frappe.get_doc(dict(row, doctype=dt))
+    if update_request_doc.status != 'Pending Approval':
+      results[update_request_doc.name] = _get_result(update_request_doc)
+      continue
+    # Document level permissions, as `save` checks them in `approve`
+    if not frappe.has_permission(dt, 'write', doc=update_request_doc):
+      results[update_request_doc.name] = _get_result(update_request_doc, error=_('Not permitted'))
+      continue
+    update_request_doc.status = 'Approved'
+    update_request_doc.approved_by = user
+    update_request_doc.approved_on = now
+    if update_request_doc.request_type == 'Create':
+      key = (update_request_doc.dt, None, update_request_doc.name)
+    else:
+      key = (update_request_doc.dt, update_request_doc.docname)
+    groups.setdefault(key, []).append(update_request_doc)
+
+  for key, update_request_docs in groups.items():
+    savepoint = 'fsm_approve_{}'.format(frappe.generate_hash(length=8))
+    frappe.db.savepoint(savepoint)
+    try:
+      if key[1] is None:
+        _approve_create_request(update_request_docs)
+      elif fsm_queue.is_queued(key[0]):
+        _enqueue_approved_group(key, update_request_docs)
+      else:
+        _approve_group(key, update_request_docs)
+      for update_request_doc in update_request_docs:
+        results[update_request_doc.name] = _get_result(update_request_doc)
+    except Exception as e:
+      frappe.db.rollback(save_point=savepoint)
+      for update_request_doc in update_request_docs:
+        results[update_request_doc.name] = _get_result(update_request_doc, status='Pending Approval', error=str(e))
+
+  fsm_inbox.clear_pending_counts(*[x.approval_party for docs in groups.values() for x in docs])
+  return list(results.values())
+
+
+@frappe.whitelist()
+def reject_many(update_requests) -> list:
+  """
+  Reject many update requests in a single call, using one update query.
+  Update requests that are not Pending Approval are returned as-is, the ones the user can't write are reported as
+  not permitted
+  :param update_requests: List of update request names
+  :return: The outcome of every update request, in the given order
+  """
+  if not frappe.has_permission(dt, 'write'):
+    frappe.throw(_('Not permitted'), frappe.PermissionError)
+
+  user, now = frappe.session.user, now_datetime()
+  names = _parse_names(update_requests)
+  results = OrderedDict((name, _get_missing_result(name)) for name in names)
+  rows = _lock_update_requests(names)
+  # Document level permissions, as `save` checks them in `reject`
+  forbidden = set(row.name for row in rows if row.status == 'Pending Approval' and
+                  not frappe.has_permission(dt, 'write', doc=frappe.get_doc(dict(row, doctype=dt))))
+  rejected = [row.name for row in rows if row.status == 'Pending Approval' and row.name not in forbidden]
+  if len(rejected):
+    # Rejected requests release the target document, see `UpdateRequest.set_pending_key`
+    frappe.db.sql("""
+      UPDATE `tabUpdate Request`
+      SET status = 'Rejected', rejected_by = %(user)s, rejected_on = %(now)s, pending_key = NULL,
+        modified = %(now)s, modified_by = %(user)s
+      WHERE name IN %(names)s AND status = 'Pending Approval'
+    """, {'user': user, 'now': now, 'names': rejected})
+    fsm_inbox.clear_pending_counts(*[row.approval_party for row in rows if row.name in rejected])
+
+  for row in rows:
+    if row.name in forbidden:
+      results[row.name] = _get_result(row, error=_('Not permitted'))
+      continue
+    if row.status == 'Pending Approval':
+      row.status = 'Rejected'
+    results[row.name] = _get_result(row)
+  fsm_feed.record([row for row in rows if row.name in rejected])
+  fsm_fifo.release([row for row in rows if row.name in rejected])
+  return list(results.values())
+
+
+@frappe.whitelist()
+def get_approval_inbox(approval_party: str, limit=20, cursor: str = None, dt: str = None, group_by_dt=False) -> dict:
+  """
+  The update requests Pending Approval of a party, paginated with a cursor, see `fsm_inbox.get_inbox`
+  :param approval_party: The FSM Party Type
+  :param limit: The page size
+  :param cursor: The `next_cursor` returned with the previous page
+  :param dt: Only return the update requests of this doctype
+  :param group_by_dt: Group the page by doctype
+  :return:
+  """
+  # `dt` is the target doctype here
+  if not frappe.has_permission('Update Request', 'read'):
+    frappe.throw(_('Not permitted'), frappe.PermissionError)
+  return fsm_inbox.get_inbox(approval_party, limit=limit, cursor=cursor, dt=dt, group_by_dt=cint(group_by_dt))
+
+
+@frappe.whitelist()
+def revert(update_request: str, dry_run=False) -> dict:
   """
   Revert an update request.
   Given the Update Request is Successful and that it's the latest for the Doctype/Docname combination
   :param update_request: The name of the update request
+  :param dry_run: Return the planned operations and their estimated cost without reverting
   :return:
   """
   update_request_doc: UpdateRequest = frappe.get_doc(dt, update_request)
-  return update_request_doc.revert()
+  if cint(dry_run):
+    return update_request_doc.revert(dry_run=True)
+  return update_request_doc.revert().as_dict()
+
+
+@frappe.whitelist()
+def revert_to(update_request: str, dry_run=False):
+  """
+  Revert an update request along with every successful update request applied on the same document after it.
+  The document is loaded and saved once and all the update requests are reverted in the same transaction
+  :param update_request: The name of the oldest update request to revert
+  :param dry_run: Return the planned operations and their estimated cost without reverting
+  :return: The reverted update requests
+  """
+  update_request_doc: UpdateRequest = frappe.get_doc(dt, update_request)
+  if cint(dry_run):
+    return update_request_doc.revert_to(dry_run=True)
+  return [_get_result(x) for x in update_request_doc.revert_to()]
+
+
+@frappe.whitelist()
+def restore(update_request: str) -> dict:
+  """
+  Restore an archived update request, see `compact_update_requests`
+  :param update_request: The name of the archived update request
+  :return: The restored update request
+  """
+  frappe.only_for('System Manager')
+  archive: UpdateRequestArchive = frappe.get_doc('Update Request Archive', update_request)
+  return archive.restore().as_dict()
+
+
+@frappe.whitelist()
+def apply_bulk(update_requests) -> list:
+  """
+  Apply many update requests in a single call.
+  Update requests are grouped by their target document. Each target is loaded once, its update requests are applied
+  in the given order and it's saved once. The update requests and their revert items are written using batched inserts.
+  Every target runs under its own savepoint, so a failing target does not roll back the rest of the batch.
+  Update requests whose `idempotency_key` was already used return the outcome of the existing update request
+  :param update_requests: List of update requests (dicts with the Update Request fields)
+  :return: The outcome of every update request, in the given order
+  """
+  if not frappe.has_permission(dt, 'submit'):
+    frappe.throw(_('Not permitted'), frappe.PermissionError)
+
+  update_requests = frappe.parse_json(update_requests) or []
+  results = [None] * len(update_requests)
+  update_request_docs = [frappe.get_doc(dict(update_request, doctype=dt)) for update_request in update_requests]
+  existing = _get_by_idempotency_scopes([x.get_idempotency_scope() for x in update_request_docs])
+  first_seen, duplicates = {}, []
+  groups = OrderedDict()
+  for idx, update_request_doc in enumerate(update_request_docs):
+    idempotency_scope = update_request_doc.get_idempotency_scope()
+    if idempotency_scope in existing:
+      results[idx] = _get_result(existing[idempotency_scope])
+      continue
+    if idempotency_scope in first_seen:
+      # Retried within the batch, answered with the outcome of the first one
+      duplicates.append((idx, first_seen[idempotency_scope]))
+      continue
+    if idempotency_scope:
+      first_seen[idempotency_scope] = idx
+
+    if update_request_doc.request_type == 'Create':
+      key = (update_request_doc.dt, None, idx)
+    else:
+      key = (update_request_doc.dt, update_request_doc.docname)
+    groups.setdefault(key, []).append((idx, update_request_doc))
+
+  for key, items in groups.items():
+    savepoint = 'fsm_bulk_{}'.format(frappe.generate_hash(length=8))
+    frappe.db.savepoint(savepoint)
+    try:
+      if key[1] is None:
+        _apply_create_request(items, results)
+      else:
+        _apply_group(key, items, results)
+    except Exception as e:
+      frappe.db.rollback(save_point=savepoint)
+      for idx, update_request_doc in items:
+        results[idx] = _get_result(update_request_doc, status='Failed', error=str(e))
+
+  for idx, first in duplicates:
+    results[idx] = results[first]
+  return results
+
+
+@frappe.whitelist()
+def get_transition_graph(doctype: str) -> dict:
+  """
+  The allowed transitions of the doctype's fields, see `fsm_transitions.compile_transitions`
+  :param doctype: The target doctype
+  :return: {field: {from: [to, ...]}}
+  """
+  return fsm_dispatch.get_transitions(doctype).as_dict()
+
+
+@frappe.whitelist()
+def get_state_at(dt: str, docname: str, timestamp) -> dict:
+  """
+  The document as it was at the given time, see `fsm_checkpoint.get_state_at`
+  :param dt: The doctype
+  :param docname: The docname
+  :param timestamp: The time to rebuild the document at
+  :return: The document, or None if it did not exist yet
+  """
+  frappe.has_permission(dt, 'read', docname, throw=True)
+  return fsm_checkpoint.get_state_at(dt, docname, timestamp)
+
+
+@frappe.whitelist()
+def get_change_feed(cursor=None, limit=100, dt: str = None) -> dict:
+  """
+  The status changes of update requests after the cursor, oldest first, see `fsm_feed.get_changes`
+  :param cursor: The `cursor` returned by the previous call, empty to read from the start of the feed
+  :param limit: The batch size
+  :param dt: Only return the changes of this doctype
+  :return: {events, cursor}
+  """
+  if not frappe.has_permission('Update Request Event', 'read'):
+    frappe.throw(_('Not permitted'), frappe.PermissionError)
+  return fsm_feed.get_changes(cursor, limit=limit, dt=dt)
+
+
+@frappe.whitelist()
+def get_queue_stats() -> list:
+  """
+  Depth and lag of the queued update requests per doctype
+  :return:
+  """
+  frappe.only_for('System Manager')
+  return fsm_queue.get_queue_stats()
+
+
+@frappe.whitelist()
+def get_stage_metrics() -> dict:
+  """
+  Durations and query counts per stage, aggregated by the `cache_sink` trace sink
+  :return:
+  """
+  frappe.only_for('System Manager')
+  return fsm_trace.get_metrics()
+
+
+@frappe.whitelist()
+def get_contention_metrics() -> dict:
+  """
+  Lock waits, optimistic retries and conflicts per doctype
+  :return:
+  """
+  frappe.only_for('System Manager')
+  return fsm_concurrency.get_contention_metrics()
+
+
+def _apply_create_request(items: list, results: list):
+  """
+  Create requests have no target to group on, they go through the standard insert and submit
+  :param items: A single (index, update request) pair
+  :param results: The results list to fill
+  :return:
+  """
+  for idx, update_request_doc in items:
+    update_request_doc.insert()
+    update_request_doc.submit()
+    results[idx] = _get_result(update_request_doc)
+
+
+def _apply_group(key: tuple, items: list, results: list):
+  """
+  Validates and applies all the update requests of one target document, then persists them
+  :param key: The (dt, docname) of the target document
+  :param items: Ordered list of (index, update request) pairs
+  :param results: The results list to fill
+  :return:
+  """
+  with fsm_trace.trace('apply_bulk'):
+    target = load_target(*key)
+    valid = []
+    with fsm_trace.stage('validate'):
+      for idx, update_request_doc in items:
+        try:
+          update_request_doc.flags.target_doc = target
+          update_request_doc.before_insert()
+          update_request_doc.validate()
+          update_request_doc.docstatus = 1
+          valid.append((idx, update_request_doc))
+        except Exception as e:
+          results[idx] = _get_result(update_request_doc, status='Failed', error=str(e))
+
+    if not len(valid):
+      return
+
+    # Requests waiting behind another request of the document are stored without being applied
+    fifo = fsm_fifo.is_fifo(key[0])
+    with fsm_trace.stage('apply'):
+      target.apply_update_requests([update_request_doc for idx, update_request_doc in valid
+                                    if not update_request_doc.waiting], stop_on_approval=fifo)
+    # Requests of FIFO doctypes left behind one that went Pending Approval wait for it to be processed, see
+    # `fsm_fifo.release`
+    if fifo:
+      for idx, update_request_doc in valid:
+        if update_request_doc.status == 'Pending' and not update_request_doc.next_attempt_on:
+          update_request_doc.waiting = 1
+    with fsm_trace.stage('status_write'):
+      for idx, update_request_doc in valid:
+        update_request_doc.set_new_name()
+        if update_request_doc.status == 'Success':
+          update_request_doc.set_as_head()
+      bulk_insert_update_requests([update_request_doc for idx, update_request_doc in valid])
+      fsm_feed.record([update_request_doc for idx, update_request_doc in valid])
+      fsm_fifo.release([update_request_doc for idx, update_request_doc in valid])
+    for idx, update_request_doc in valid:
+      results[idx] = _get_result(update_request_doc)
+
+
+def _approve_create_request(update_request_docs: list):
+  """
+  Create requests have no target to group on, they go through the standard save
+  :param update_request_docs: A single approved update request
+  :return:
+  """
+  for update_request_doc in update_request_docs:
+    update_request_doc.save()
+
+
+def _enqueue_approved_group(key: tuple, update_request_docs: list):
+  """
+  Marks the approved update requests of a queued target document with one update query and enqueues the target once
+  :param key: The (dt, docname) of the target document
+  :param update_request_docs: The approved update requests
+  :return:
+  """
+  update_request_doc = update_request_docs[0]
+  frappe.db.sql("""
+    UPDATE `tabUpdate Request`
+    SET status = 'Approved', approved_by = %(user)s, approved_on = %(now)s, pending_key = NULL,
+      queued = 1, enqueued_on = %(now)s, modified = %(now)s, modified_by = %(user)s
+    WHERE name IN %(names)s
+  """, {'user': update_request_doc.approved_by, 'now': update_request_doc.approved_on,
+        'names': [x.name for x in update_request_docs]})
+  fsm_queue.enqueue_document_queue(*key)
+
+
+def _approve_group(key: tuple, update_request_docs: list):
+  """
+  Applies the approved update requests of one target document, then persists them
+  :param key: The (dt, docname) of the target document
+  :param update_request_docs: The approved update requests, in creation order
+  :return:
+  """
+  with fsm_trace.trace('approve_many'):
+    target = load_target(*key)
+    with fsm_trace.stage('apply'):
+      target.apply_update_requests(update_request_docs)
+    with fsm_trace.stage('status_write'):
+      save_update_requests(update_request_docs)
+
+
+def _get_by_idempotency_scopes(idempotency_scopes: list) -> dict:
+  """
+  The existing update requests holding the idempotency scopes, with one query
+  :return: idempotency_scope => {name, dt, docname, status, error}
+  """
+  idempotency_scopes = [x for x in idempotency_scopes if x]
+  if not len(idempotency_scopes):
+    return {}
+  return {x.idempotency_scope: x for x in frappe.get_all(dt, filters={'idempotency_scope': ['in', idempotency_scopes]},
+                                                         fields=['name', 'dt', 'docname', 'status', 'error',
+                                                                 'idempotency_scope'])}
+
+
+def _parse_names(update_requests) -> list:
+  update_requests = frappe.parse_json(update_requests) or []
+  if isinstance(update_requests, str):
+    update_requests = [update_requests]
+  return list(OrderedDict.fromkeys(update_requests))
+
+
+def _lock_update_requests(names: list, fields='*') -> list:
+  """
+  Reads and locks the update requests until the end of the transaction, in creation order
+  :param names: The update request names
+  :param fields: The columns to read
+  :return:
+  """
+  if not len(names):
+    return []
+  return frappe.db.sql("""
+    SELECT {fields} FROM `tabUpdate Request`
+    WHERE name IN %(names)s
+    ORDER BY creation ASC
+    FOR UPDATE
+  """.format(fields=fields), {'names': names}, as_dict=True)
+
+
+def bulk_insert_update_requests(update_request_docs: list):
+  """
+  Inserts new update requests along with their revert items using one insert query per doctype
+  :param update_request_docs: Update Request documents that are not yet in the database
+  :return:
+  """
+  for update_request_doc in update_request_docs:
+    update_request_doc.set_pending_key()
+  bulk_insert_documents(update_request_docs)
+
+
+def _get_missing_result(name: str) -> dict:
+  return frappe._dict(name=name, dt=None, docname=None, status=None, error=_('Update Request not found'))
+
+
+def _get_result(update_request_doc: UpdateRequest, status=None, error=None) -> dict:
+  return frappe._dict(name=update_request_doc.name,
+                      dt=update_request_doc.dt, docname=update_request_doc.docname,
+                      status=status or update_request_doc.status, error=error or update_request_doc.error)
@@ -0,0 +1,108 @@
+import frappe
+from frappe_state_management.classes.fsm_document import FSMDocument
+
+bench_dt = 'FSM Bench Document'
+bench_item_dt = 'FSM Bench Item'
+party_type = 'FSM Bench Party'
+
+
+class FSMBenchDocument(FSMDocument):
+  """
+  Controller of the benchmark doctype. Every field handler sets the value given in `data`
+  """
+
+  def set_from_data(self, fieldname: str):
+    self.set(fieldname, self.parse_data().get('value'))
+    return self.standard_revert_data()
+
+  def _status(self):
+    return self.set_from_data('status')
+
+  def _approved(self):
+    return self.set_from_data('approved')
+
+  def _title(self):
+    return self.set_from_data('title')
+
+  def _docstatus(self):
+    self.docstatus = 1
+    return self.standard_revert_data()
+
+
+def setup():
+  """
+  Creates the benchmark doctypes as custom doctypes and registers `FSMBenchDocument` as their controller.
+  Custom doctypes can't have a controller, so it's set in `frappe.controllers` which `get_controller` reads from
+  :return:
+  """
+  if not frappe.db.exists('DocType', bench_item_dt):
+    frappe.get_doc({
+      'doctype': 'DocType', 'name': bench_item_dt, 'module': 'Frappe State Management', 'custom': 1, 'istable': 1,
+      'fields': [
+        {'fieldname': 'item', 'fieldtype': 'Data', 'label': 'Item'},
+        {'fieldname': 'qty', 'fieldtype': 'Int', 'label': 'Qty'},
+      ]
+    }).insert(ignore_permissions=True)
+
+  if not frappe.db.exists('DocType', bench_dt):
+    frappe.get_doc({
+      'doctype': 'DocType', 'name': bench_dt, 'module': 'Frappe State Management', 'custom': 1,
+      'is_submittable': 1, 'autoname': 'hash',
+      'fields': [
+        {'fieldname': 'status', 'fieldtype': 'Select', 'label': 'Status', 'options': 'Open\nClosed',
+         'allow_on_submit': 1},
+        {'fieldname': 'approved', 'fieldtype': 'Check', 'label': 'Approved', 'allow_on_submit': 1},
+        {'fieldname': 'title', 'fieldtype': 'Data', 'label': 'Title', 'allow_on_submit': 1},
+        {'fieldname': 'items', 'fieldtype': 'Table', 'label': 'Items', 'options': bench_item_dt,
+         'allow_on_submit': 1},
+      ],
+      'permissions': [{'role': 'System Manager', 'read': 1, 'write': 1, 'create': 1, 'submit': 1, 'delete': 1}]
+    }).insert(ignore_permissions=True)
+
+  if not frappe.db.exists('FSM Party Type', party_type):
+    frappe.get_doc({'doctype': 'FSM Party Type', 'title': party_type}).insert(ignore_permissions=True)
+
+  frappe.controllers.setdefault(frappe.local.site, {})[bench_dt] = FSMBenchDocument
+  frappe.db.commit()
+
+
+def teardown():
+  """
+  Removes the benchmark documents, their Update Requests and the benchmark doctypes
+  :return:
+  """
+  frappe.db.sql("""DELETE FROM `tabUpdate Request Revert Item` WHERE parent IN (
+    SELECT name FROM `tabUpdate Request` WHERE dt = %s)""", bench_dt)
+  frappe.db.sql("DELETE FROM `tabUpdate Request` WHERE dt = %s", bench_dt)
+  frappe.db.sql("DELETE FROM `tabUpdate Request Head` WHERE dt = %s", bench_dt)
+  frappe.db.sql("DELETE FROM `tabUpdate Request Event` WHERE dt = %s", bench_dt)
+  frappe.db.sql("DELETE FROM `tabUpdate Request Checkpoint` WHERE dt = %s", bench_dt)
+  for doctype in (bench_dt, bench_item_dt):
+    if frappe.db.exists('DocType', doctype):
+      frappe.delete_doc('DocType', doctype, force=True, ignore_permissions=True)
+  frappe.controllers.get(frappe.local.site, {}).pop(bench_dt, None)
+  frappe.db.commit()
+
+
+def make_document(rows: int, **values) -> FSMBenchDocument:
+  """
+  Inserts a benchmark document with the given number of child rows
+  :param rows: The number of child rows
+  :return:
+  """
+  doc = frappe.get_doc(dict({'doctype': bench_dt, 'status': 'Open', 'title': 'Benchmark'}, **values))
+  for i in range(rows):
+    doc.append('items', {'item': 'Item {}'.format(i), 'qty': i})
+  return doc.insert(ignore_permissions=True)
+
+
+def make_update_request(doc, docfield: str, type: str, data=None, **values):
+  """
+  An Update Request on the benchmark document, not inserted
+  :return:
+  """
+  return frappe.get_doc(dict({
+    'doctype': 'Update Request', 'request_type': 'Update', 'dt': bench_dt, 'docname': doc.name,
+    'docfield': docfield, 'type': type, 'data': frappe.as_json(data) if data is not None else None,
+    'party_type': party_type
+  }, **values))
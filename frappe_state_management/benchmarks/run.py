@@ -0,0 +1,164 @@
+"""
+Benchmarks of the FSM hot paths.
+
+Run them on a throwaway site, backed by a local MariaDB and Redis:
+  bench --site bench.localhost execute frappe_state_management.benchmarks.run.run \
+    --kwargs "{'output': '/tmp/fsm_bench.json'}"
+
+Every result is a JSON object with the benchmark name, its parameters and the timings in milliseconds.
+The benchmark doctypes are created on start and removed at the end
+"""
+import json
+import time
+
+import frappe
+from frappe_state_management.api.update_request import bulk_insert_update_requests
+from frappe_state_management.benchmarks import fixtures
+from frappe_state_management.classes.fsm_data import parse_data
+from frappe_state_management.classes.fsm_revert_data import dumps
+from frappe_state_management.frappe_state_management.doctype.update_request_head.update_request_head import set_head
+
+
+def run(doc_sizes=(10, 100, 1000), iterations=20, history_sizes=(0, 1000, 10000), revert_item_counts=(1, 10, 100),
+        payload_sizes=(10, 1000, 10000), output=None) -> list:
+  """
+  Runs all the benchmarks
+  :param doc_sizes: Number of child rows of the target documents
+  :param iterations: Number of measured runs of each benchmark
+  :param history_sizes: Number of Update Requests already stored for the target document
+  :param revert_item_counts: Number of revert items of the reverted Update Request
+  :param payload_sizes: Number of keys of the parsed payloads
+  :param output: File to write the results to, as JSON lines
+  :return: The results
+  """
+  frappe.set_user('Administrator')
+  fixtures.setup()
+  results = []
+  try:
+    for rows in doc_sizes:
+      results += bench_apply(rows, iterations)
+    for count in revert_item_counts:
+      results.append(bench_revert(count, iterations))
+    for size in history_sizes:
+      results.append(bench_pending_check(size, iterations))
+    for size in payload_sizes:
+      results.append(bench_parse_data(size, iterations))
+  finally:
+    fixtures.teardown()
+
+  if output:
+    with open(output, 'w') as f:
+      for result in results:
+        f.write(json.dumps(result) + '\n')
+  return results
+
+
+def measure(name: str, fn, iterations: int, setup=None, **params) -> dict:
+  """
+  Times `fn` over the iterations. `setup` runs before each call, outside of the timing, and its result is passed to fn
+  :return: The result
+  """
+  timings = []
+  for i in range(iterations):
+    arg = setup(i) if setup else i
+    start = time.perf_counter()
+    fn(arg)
+    timings.append((time.perf_counter() - start) * 1000)
+  frappe.db.commit()
+
+  timings.sort()
+  total = sum(timings)
+  return dict(benchmark=name, iterations=iterations, total_ms=total, mean_ms=total / iterations,
+              p50_ms=timings[len(timings) // 2], p95_ms=timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+              ops_per_sec=iterations / (total / 1000) if total else None, **params)
+
+
+def submit(update_request):
+  update_request.insert(ignore_permissions=True)
+  update_request.submit()
+  if update_request.status != 'Success':
+    frappe.throw('Benchmark Update Request {} failed: {}'.format(update_request.name, update_request.error))
+
+
+def bench_apply(rows: int, iterations: int) -> list:
+  """
+  Insert, submit and apply throughput per request type on a document with `rows` child rows
+  """
+  results = []
+  doc = fixtures.make_document(rows)
+  values = {
+    'Select': ('status', lambda i: 'Closed' if i % 2 == 0 else 'Open'),
+    'Check': ('approved', lambda i: 1 if i % 2 == 0 else 0),
+    'Field': ('title', lambda i: 'Title {}'.format(i)),
+  }
+  for type, (docfield, value) in values.items():
+    results.append(measure('apply', lambda i: submit(fixtures.make_update_request(
+        doc, docfield, type, {'value': value(i)})), iterations, type=type, rows=rows))
+
+  # Every Docstatus request needs a draft document
+  results.append(measure('apply', submit, iterations, type='Docstatus', rows=rows,
+                         setup=lambda i: fixtures.make_update_request(fixtures.make_document(rows), 'docstatus',
+                                                                      'Docstatus')))
+
+  child_rows = [{'item': 'Added', 'qty': 1}]
+  results.append(measure('apply', lambda i: submit(fixtures.make_update_request(
+      doc, 'items', 'Add Child Rows', child_rows)), iterations, type='Add Child Rows', rows=rows))
+
+  names = frappe.get_all(fixtures.bench_item_dt, filters={'parent': doc.name}, pluck='name')
+  results.append(measure('apply', lambda i: submit(fixtures.make_update_request(
+      doc, 'items', 'Update Child Rows', [{'name': names[i % len(names)], 'qty': i}])), iterations,
+                         type='Update Child Rows', rows=rows))
+
+  results.append(measure('apply', lambda i: submit(fixtures.make_update_request(
+      doc, 'items', 'Delete Child Rows', [{'name': names[-(i + 1)]}])), min(iterations, len(names)),
+                         type='Delete Child Rows', rows=rows))
+  return results
+
+
+def bench_revert(count: int, iterations: int) -> dict:
+  """
+  Revert latency of a successful Update Request holding `count` revert items, each on its own document
+  """
+
+  def setup(i):
+    docs = [fixtures.make_document(0) for _ in range(count)]
+    update_request = fixtures.make_update_request(docs[0], 'title', 'Field', {'value': 'Reverted'})
+    update_request.status = 'Success'
+    update_request.docstatus = 1
+    for doc in docs:
+      update_request.append('revert_items', {
+        'dt': fixtures.bench_dt, 'docname': doc.name, 'change_type': 'Update',
+        'revert_data': dumps({'version': 2, 'fields': {'title': 'Reverted'}, 'tables': {}})
+      })
+    bulk_insert_update_requests([update_request])
+    set_head(update_request.dt, update_request.docname, update_request.name)
+    return update_request
+
+  return measure('revert', lambda update_request: update_request.revert(), iterations, setup=setup,
+                 revert_items=count)
+
+
+def bench_pending_check(size: int, iterations: int) -> dict:
+  """
+  Cost of `UpdateRequest.validate`, which holds the pending check, with `size` Update Requests stored for the document
+  """
+  doc = fixtures.make_document(0)
+  history = []
+  for i in range(size):
+    update_request = fixtures.make_update_request(doc, 'title', 'Field', {'value': i})
+    update_request.status = 'Success'
+    update_request.docstatus = 1
+    history.append(update_request)
+  for i in range(0, size, 1000):
+    bulk_insert_update_requests(history[i:i + 1000])
+
+  update_request = fixtures.make_update_request(doc, 'title', 'Field', {'value': 'Pending'})
+  return measure('pending_check', lambda i: update_request.validate(), iterations, history=size)
+
+
+def bench_parse_data(size: int, iterations: int) -> dict:
+  """
+  Cost of parsing a payload of `size` keys
+  """
+  payload = json.dumps({'field_{}'.format(i): 'value {}'.format(i) for i in range(size)})
+  return measure('parse_data', lambda i: parse_data(payload), iterations, keys=size, bytes=len(payload))
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+
+import frappe
+from frappe.model.naming import set_new_name
+
+
+def bulk_load_documents(doctype: str, names: list) -> dict:
+  """
+  Loads documents of a doctype along with their child rows using one query for the parents and one query per child
+  table, instead of one `frappe.get_doc` per document
+  :param doctype: The doctype, not a single doctype
+  :param names: The document names
+  :return: name => Document, documents that don't exist are left out
+  """
+  if not len(names):
+    return {}
+  rows = frappe.db.sql("SELECT * FROM `tab{}` WHERE name IN %(names)s".format(doctype), {'names': names},
+                       as_dict=True)
+  if not len(rows):
+    return {}
+
+  for df in frappe.get_meta(doctype).get_table_fields():
+    children = {}
+    for child in frappe.db.sql("""
+      SELECT * FROM `tab{child_doctype}`
+      WHERE parent IN %(names)s AND parenttype = %(parenttype)s AND parentfield = %(parentfield)s
+      ORDER BY idx ASC
+    """.format(child_doctype=df.options), {'names': [x.name for x in rows], 'parenttype': doctype,
+                                           'parentfield': df.fieldname}, as_dict=True):
+      children.setdefault(child.parent, []).append(child)
+    for row in rows:
+      row[df.fieldname] = children.get(row.name, [])
+
+  return {row.name: frappe.get_doc(dict(row, doctype=doctype)) for row in rows}
+
+
+def bulk_insert_documents(docs: list):
+  """
+  Inserts new documents along with their child rows using one insert query per doctype.
+  Controller hooks and validations are not run
+  :param docs: Documents that are not yet in the database
+  :return:
+  """
+  rows = OrderedDict()
+  for doc in docs:
+    if not doc.name:
+      doc.set_new_name()
+    doc.set_user_and_timestamp()
+    doc.set_docstatus()
+    doc.set_parent_in_children()
+    for d in [doc] + doc.get_all_children():
+      rows.setdefault(d.doctype, []).append(d.get_valid_dict(convert_dates_to_str=True))
+
+  _insert_rows(rows)
+
+
+def bulk_update_documents(docs: list):
+  """
+  Updates existing documents with one query each and inserts their new child rows using one insert query per doctype.
+  Child rows already in the database are not updated. Controller hooks and validations are not run
+  :param docs: Documents that are already in the database
+  :return:
+  """
+  rows = OrderedDict()
+  for doc in docs:
+    doc.set_user_and_timestamp()
+    doc.set_docstatus()
+    doc.set_parent_in_children()
+    doc.db_update()
+    _add_new_children(doc, rows)
+
+  _insert_rows(rows)
+
+
+def insert_new_children(doc):
+  """
+  Inserts the child rows of an existing document that are not yet in the database, using one insert query per
+  doctype. The document itself is not written, its timestamps are expected to be set
+  :param doc: Document that is already in the database
+  :return:
+  """
+  rows = OrderedDict()
+  doc.set_docstatus()
+  doc.set_parent_in_children()
+  _add_new_children(doc, rows)
+  _insert_rows(rows)
+
+
+def _add_new_children(doc, rows: OrderedDict):
+  for d in doc.get_all_children():
+    if not d.get('__islocal') and d.name:
+      continue
+    if not d.name:
+      set_new_name(d)
+    rows.setdefault(d.doctype, []).append(d.get_valid_dict(convert_dates_to_str=True))
+    d.__dict__.pop('__islocal', None)
+
+
+def _insert_rows(rows: OrderedDict):
+  for doctype, dicts in rows.items():
+    fields = list(dicts[0].keys())
+    frappe.db.bulk_insert(doctype, fields, [[d.get(f) for f in fields] for d in dicts])
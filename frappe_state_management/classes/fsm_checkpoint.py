@@ -0,0 +1,175 @@
+import frappe
+from frappe import _
+from frappe.utils import add_days, cint, get_datetime, now_datetime
+from frappe_state_management.classes.fsm_bulk import bulk_insert_documents
+from frappe_state_management.classes.fsm_data import parse_data
+from frappe_state_management.classes.fsm_revert_data import is_revert_delta, apply_revert_delta
+from frappe_state_management.frappe_state_management.doctype.update_request_archive.update_request_archive import \
+  compress
+from frappe_state_management.frappe_state_management.doctype.update_request_checkpoint.update_request_checkpoint \
+  import get_checkpoint_data
+from frappe_state_management.frappe_state_management.doctype.update_request_head.update_request_head import get_head
+
+checkpoint_dt = 'Update Request Checkpoint'
+
+
+def get_checkpoint_settings(doctype: str):
+  """
+  Checkpoints are enabled per doctype with the `fsm_checkpoints` hook, for example
+    fsm_checkpoints = {"Order": {"interval": 50, "retention_days": 365}}
+  `interval` is the number of successful Update Requests between two checkpoints, 100 by default.
+  Checkpoints older than `retention_days` are removed daily, 0 (default) keeps them
+  :param doctype: The doctype
+  :return: {interval, retention_days} or None if the doctype has no checkpoints
+  """
+  settings = frappe.get_hooks('fsm_checkpoints', {}).get(doctype)
+  if not settings:
+    return None
+
+  def get_setting(key, default):
+    value = settings.get(key)
+    # Hook values are merged into lists, the last app wins
+    return cint(value[-1] if isinstance(value, (list, tuple)) else value) if value else default
+
+  return frappe._dict(interval=max(get_setting('interval', 100), 1), retention_days=get_setting('retention_days', 0))
+
+
+def take_checkpoint(doc, checkpoint_type='Interval', taken_on=None):
+  """
+  Stores a snapshot of the document
+  :param doc: The document
+  :param checkpoint_type: "Interval" or "Revert"
+  :param taken_on: The time the document was in this state, now by default
+  :return:
+  """
+  bulk_insert_documents([frappe.get_doc({
+    'doctype': checkpoint_dt,
+    'dt': doc.doctype,
+    'docname': doc.name,
+    'taken_on': taken_on or now_datetime(),
+    'checkpoint_type': checkpoint_type,
+    'update_request': get_head(doc.doctype, doc.name),
+    'checkpoint_data': compress(doc.as_dict(no_nulls=True))
+  })])
+
+
+def on_update_requests_applied(doc, count: int, applied_on):
+  """
+  Takes a checkpoint once `interval` successful Update Requests were applied on the document since the last one.
+  Called before the `count` applied Update Requests are persisted
+  :param doc: The target document, saved
+  :param count: The number of Update Requests that were just applied
+  :param applied_on: Their `applied_on`
+  :return:
+  """
+  settings = get_checkpoint_settings(doc.doctype)
+  if not settings or not doc.name:
+    return
+
+  last = frappe.db.sql("""
+    SELECT MAX(taken_on) FROM `tabUpdate Request Checkpoint` WHERE dt = %s AND docname = %s
+  """, (doc.doctype, doc.name))[0][0]
+  since = frappe.db.sql("""
+    SELECT COUNT(*) FROM `tabUpdate Request`
+    WHERE dt = %(dt)s AND docname = %(docname)s AND applied_on > %(last)s
+  """, {'dt': doc.doctype, 'docname': doc.name, 'last': last or '1900-01-01'})[0][0]
+  if since + count >= settings.interval:
+    take_checkpoint(doc, taken_on=applied_on)
+
+
+def on_revert(doc):
+  """
+  Takes a checkpoint right before a revert. Reconstruction only undoes changes, so the state of the document before
+  the revert has to be stored
+  :param doc: The document about to be reverted
+  :return:
+  """
+  if doc.name and get_checkpoint_settings(doc.doctype):
+    take_checkpoint(doc, 'Revert')
+
+
+def get_state_at(doctype: str, docname: str, timestamp) -> frappe._dict:
+  """
+  Rebuilds the document as it was at the given time.
+  Starts from the first checkpoint taken at or after that time, or the current document, and undoes the Update
+  Requests applied in between, newest first. The cost is bounded by the checkpoint interval.
+  Only the changes made by Update Requests targeting the document are undone
+  :param doctype: The doctype
+  :param docname: The docname
+  :param timestamp: The time to rebuild the document at
+  :return: The document as a dict, or None if it did not exist yet
+  """
+  if not get_checkpoint_settings(doctype):
+    frappe.throw(_('Checkpoints are not enabled for {0}').format(doctype))
+
+  timestamp = get_datetime(timestamp)
+  horizon = get_history_horizon(doctype)
+  if horizon and timestamp < horizon:
+    frappe.throw(_('The history of {0} {1} is only kept since {2}').format(doctype, docname, horizon))
+
+  checkpoint = frappe.db.sql("""
+    SELECT taken_on, checkpoint_data FROM `tabUpdate Request Checkpoint`
+    WHERE dt = %(dt)s AND docname = %(docname)s AND taken_on >= %(timestamp)s
+    ORDER BY taken_on ASC
+    LIMIT 1
+  """, {'dt': doctype, 'docname': docname, 'timestamp': timestamp}, as_dict=True)
+  if checkpoint:
+    doc = frappe.get_doc(dict(get_checkpoint_data(checkpoint[0].checkpoint_data), doctype=doctype))
+    until = checkpoint[0].taken_on
+  else:
+    doc = frappe.get_doc(doctype, docname)
+    until = now_datetime()
+
+  if get_datetime(doc.creation) > timestamp:
+    return None
+
+  # Reverted requests in the window were reverted after the checkpoint, they were still applied at that time
+  names = frappe.db.sql_list("""
+    SELECT name FROM `tabUpdate Request`
+    WHERE dt = %(dt)s AND docname = %(docname)s AND docstatus = 1 AND status IN ('Success', 'Reverted')
+      AND applied_on > %(timestamp)s AND applied_on <= %(until)s
+    ORDER BY applied_on DESC, creation DESC
+  """, {'dt': doctype, 'docname': docname, 'timestamp': timestamp, 'until': until})
+  if not names:
+    return doc.as_dict()
+
+  revert_items = {}
+  for revert_item in frappe.get_all('Update Request Revert Item', fields=['parent', 'revert_data'],
+                                    filters={'parenttype': 'Update Request', 'parent': ['in', names],
+                                             'dt': doctype, 'docname': docname, 'change_type': 'Update'},
+                                    order_by='idx DESC'):
+    revert_items.setdefault(revert_item.parent, []).append(revert_item)
+
+  for name in names:
+    for revert_item in revert_items.get(name, []):
+      revert_data = frappe._dict(parse_data(revert_item.revert_data))
+      if is_revert_delta(revert_data):
+        apply_revert_delta(doc, revert_data)
+      else:
+        doc.update(revert_data)
+  return doc.as_dict()
+
+
+def get_history_horizon(doctype: str):
+  """
+  The oldest time documents of the doctype can be rebuilt at. Older checkpoints are removed after `retention_days`
+  and older revert items by `compact_update_requests`
+  :param doctype: The doctype
+  :return: datetime or None if the whole history is kept
+  """
+  days = [cint(get_checkpoint_settings(doctype).retention_days), cint(frappe.conf.get('fsm_history_hot_days', 90))]
+  days = [x for x in days if x > 0]
+  return add_days(now_datetime(), -min(days)) if days else None
+
+
+def clear_old_checkpoints():
+  """
+  Daily job removing the checkpoints older than the `retention_days` of their doctype
+  :return:
+  """
+  for doctype in frappe.get_hooks('fsm_checkpoints', {}):
+    retention_days = get_checkpoint_settings(doctype).retention_days
+    if retention_days > 0:
+      frappe.db.sql("DELETE FROM `tabUpdate Request Checkpoint` WHERE dt = %s AND taken_on < %s",
+                    (doctype, add_days(now_datetime(), -retention_days)))
+  frappe.db.commit()
@@ -0,0 +1,167 @@
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import cint, flt
+from frappe_state_management.classes.fsm_trace import stage
+
+contention_key = 'fsm_contention_metrics'
+modes = ('lock', 'optimistic', 'none')
+# Lock acquisitions slower than this are counted as lock waits
+lock_wait_threshold_ms = 10
+
+
+def get_concurrency_mode(doctype: str) -> str:
+  """
+  How concurrent applications on the same document are handled, set per doctype with the `fsm_concurrency` hook,
+  for example
+    fsm_concurrency = {"Order": "optimistic"}
+  falling back to the `fsm_concurrency_mode` site config, "lock" by default.
+  - "lock": the target row is read with `SELECT ... FOR UPDATE`, applications on a document run one after the other
+  - "optimistic": the target is read without locking and the application is retried when the save finds the
+    document was modified in the meantime
+  - "none": no locking nor retry, a concurrent write fails the Update Request with `TimestampMismatchError`
+  :param doctype: The target doctype
+  :return:
+  """
+  mode = frappe.get_hooks('fsm_concurrency', {}).get(doctype)
+  # Hook values are merged into lists, the last app wins
+  if isinstance(mode, (list, tuple)):
+    mode = mode[-1] if len(mode) else None
+  mode = mode or frappe.conf.get('fsm_concurrency_mode') or 'lock'
+  return mode if mode in modes else 'lock'
+
+
+def load_target(doctype: str, docname: str):
+  """
+  Loads the target document of Update Requests, locking its row until the end of the transaction in "lock" mode.
+  Only the lock is timed for the contention metrics, the document and its child rows are loaded once it's acquired
+  :param doctype: The target doctype
+  :param docname: The target docname
+  :return:
+  """
+  with stage('load_target'):
+    if get_concurrency_mode(doctype) != 'lock':
+      return frappe.get_doc(doctype, docname)
+    # Single doctypes have no row of their own
+    if frappe.get_meta(doctype).issingle:
+      return frappe.get_doc(doctype, docname, for_update=True)
+
+    start = time.perf_counter()
+    locked = frappe.db.sql("SELECT name FROM `tab{}` WHERE name = %s FOR UPDATE".format(doctype), docname)
+    wait_ms = (time.perf_counter() - start) * 1000
+    if wait_ms > lock_wait_threshold_ms:
+      record_contention(doctype, lock_waits=1, lock_wait_ms=wait_ms)
+    if not locked:
+      frappe.throw(_('{0} {1} not found').format(_(doctype), docname), frappe.DoesNotExistError)
+    # Locking reads, the transaction's snapshot may predate the lock
+    return frappe.get_doc(doctype, docname, for_update=True)
+
+
+def run_with_concurrency(doc, apply, update_requests: list):
+  """
+  Calls `apply` which changes and saves the document.
+  In "optimistic" mode `apply` runs under a savepoint. If the save finds the document was modified by another
+  transaction, the savepoint is rolled back, the Update Requests are reset, the document is reloaded with locking
+  reads and `apply` is called again, up to `fsm_optimistic_retries` times (site config, 3 by default).
+  The last conflict is raised
+  :param doc: The target document
+  :param apply: Function applying the Update Requests on `doc` and saving it
+  :param update_requests: The Update Requests being applied, reset before a retry
+  :return:
+  """
+  if get_concurrency_mode(doc.doctype) != 'optimistic':
+    return apply()
+
+  retries = max(cint(frappe.conf.get('fsm_optimistic_retries', 3)), 0)
+  reset = get_reset(update_requests)
+  attempt = 0
+  while True:
+    savepoint = 'fsm_apply_{}'.format(frappe.generate_hash(length=8))
+    frappe.db.savepoint(savepoint)
+    try:
+      return apply()
+    except frappe.TimestampMismatchError:
+      frappe.db.rollback(save_point=savepoint)
+      record_contention(doc.doctype, conflicts=1)
+      if attempt >= retries:
+        raise
+      attempt += 1
+      record_contention(doc.doctype, retries=1)
+      reset()
+      with stage('load_target'):
+        reload_latest(doc)
+
+
+def reload_latest(doc):
+  """
+  Reloads the document and its child rows with locking reads. A plain read returns the snapshot of the transaction,
+  which under REPEATABLE READ still has the version that conflicted. The rows stay locked until the transaction
+  ends, so the retry can't conflict again
+  :param doc: The document
+  :return:
+  """
+  doc.flags.for_update = True
+  try:
+    doc.load_from_db()
+  finally:
+    doc.flags.for_update = False
+  for df in doc.meta.get_table_fields():
+    doc.set(df.fieldname, frappe.db.sql("""
+      SELECT * FROM `tab{doctype}`
+      WHERE parent = %s AND parenttype = %s AND parentfield = %s
+      ORDER BY idx ASC
+      FOR UPDATE
+    """.format(doctype=df.options), (doc.name, doc.doctype, df.fieldname), as_dict=True))
+
+
+def get_reset(update_requests: list):
+  """
+  Snapshots the fields of the Update Requests an application changes
+  :param update_requests: The Update Requests
+  :return: Function restoring the snapshot
+  """
+  fields = ('status', 'error', 'approval_party', 'applied_on', 'modified')
+  snapshots = [(x, {field: x.get(field) for field in fields}, len(x.revert_items)) for x in update_requests]
+
+  def reset():
+    for update_request, values, revert_items in snapshots:
+      update_request.update(values)
+      update_request.revert_items = update_request.revert_items[:revert_items]
+
+  return reset
+
+
+def record_contention(doctype: str, **metrics):
+  """
+  Adds to the contention metrics of the doctype
+  :param doctype: The doctype
+  :param metrics: lock_waits, lock_wait_ms, retries or conflicts
+  :return:
+  """
+  try:
+    cache = frappe.cache()
+    key = cache.make_key(contention_key)
+    for metric, value in metrics.items():
+      field = '{}|{}'.format(doctype, metric)
+      if isinstance(value, float):
+        cache.hincrbyfloat(key, field, value)
+      else:
+        cache.hincrby(key, field, value)
+  except Exception:
+    # Metrics never fail an application
+    pass
+
+
+def get_contention_metrics() -> dict:
+  """
+  The contention metrics recorded since the cache was last flushed
+  :return: {doctype: {lock_waits, lock_wait_ms, retries, conflicts}}
+  """
+  cache = frappe.cache()
+  metrics = {}
+  for field, value in (cache.hgetall(cache.make_key(contention_key)) or {}).items():
+    doctype, metric = frappe.safe_decode(field).rsplit('|', 1)
+    metrics.setdefault(doctype, dict(lock_waits=0, lock_wait_ms=0, retries=0, conflicts=0))[metric] = \
+      flt(frappe.safe_decode(value))
+  return metrics
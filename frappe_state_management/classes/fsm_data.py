@@ -0,0 +1,51 @@
+import ast
+import json
+
+import frappe
+from frappe_state_management.classes.fsm_error import MissingOrInvalidDataError
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+
+def loads(data: str):
+  if orjson:
+    return orjson.loads(data)
+  return json.loads(data)
+
+
+def parse_data(data, strict=False):
+  """
+  Parses an Update Request payload in a single pass.
+  The canonical format is a JSON object, or a JSON array of objects for the child rows types.
+  A JSON string holding the JSON payload (double encoded) is accepted as well.
+  Unless `strict`, payloads written as Python literals by older versions are parsed with `ast.literal_eval`
+  :param data: The payload, either a string or an already parsed dict
+  :param strict: Reject payloads that are not JSON
+  :return: The parsed payload, a dict or a list of dicts
+  """
+  if isinstance(data, dict):
+    return frappe._dict(data)
+  if not data or not isinstance(data, str):
+    raise MissingOrInvalidDataError
+
+  try:
+    value = loads(data)
+    if isinstance(value, str):
+      value = loads(value)
+  except ValueError:
+    if strict:
+      raise MissingOrInvalidDataError
+    try:
+      value = ast.literal_eval(data)
+    except (ValueError, SyntaxError):
+      raise MissingOrInvalidDataError
+
+  # A list of rows is used by the "Child Rows" types
+  if isinstance(value, list) and all(isinstance(row, dict) for row in value):
+    return [frappe._dict(row) for row in value]
+  if not isinstance(value, dict):
+    raise MissingOrInvalidDataError
+  return frappe._dict(value)
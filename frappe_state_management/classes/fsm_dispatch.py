@@ -0,0 +1,138 @@
+import inspect
+from collections import namedtuple
+
+import frappe
+from frappe.model.base_document import get_controller
+from frappe_state_management.classes.fsm_transitions import compile_transitions
+
+# A resolved Update Request handler. `pass_doc` tells if the document is passed as the first argument
+FSMHandler = namedtuple('FSMHandler', ['fn', 'pass_doc'])
+
+# What `UpdateRequest.validate` needs to know about a target doctype, without loading any of its documents
+DoctypeInfo = namedtuple('DoctypeInfo', ['controller', 'istable', 'is_fsm_document', 'metadata_version'])
+
+# (site, doctype) => DispatchTable, kept for the lifetime of the worker
+_registry = {}
+# (site, doctype) => DoctypeInfo, rebuilt when the metadata version changes
+_doctype_info = {}
+
+
+class DispatchTable(object):
+  """
+  Handlers and transitions of a doctype, resolved once per worker.
+  `fsm_fields` and `fsm_transitions` hooks are read when the table is built, custom calls and `_<docfield>` methods
+  are resolved on first use and memoized once found
+  """
+
+  def __init__(self, doctype: str):
+    self.doctype = doctype
+    self.controller = get_controller(doctype)
+    self.hooks = frappe.get_hooks('fsm_fields', {}).get(doctype, {})
+    self.transitions = compile_transitions(doctype, self.controller)
+    self.handlers = {}
+
+  def get(self, docfield: str = None, custom_call: str = None):
+    key = ('custom_call', custom_call) if custom_call else ('docfield', docfield)
+    handler = self.handlers.get(key)
+    if not handler:
+      # Failed resolutions are not memoized, a fixed hook or deployed module is picked up on the next request
+      handler = self.resolve(docfield, custom_call)
+      if handler:
+        self.handlers[key] = handler
+    return handler
+
+  def resolve(self, docfield: str = None, custom_call: str = None):
+    """
+    Same precedence as before: custom call, then `fsm_fields` hook, then the `_<docfield>` method
+    :return: FSMHandler or None if nothing handles the request
+    """
+    if custom_call:
+      if '.' in custom_call:
+        fn = self.get_attr(custom_call)
+        return FSMHandler(fn, len(inspect.getfullargspec(fn).args) > 0) if fn else None
+      return self.get_method(custom_call)
+
+    if not docfield:
+      return None
+
+    if self.hooks.get(docfield):
+      fn = self.get_attr(self.hooks.get(docfield)[-1])
+      return FSMHandler(fn, True) if fn else None
+
+    return self.get_method('_{}'.format(docfield))
+
+  def get_attr(self, path: str):
+    """
+    Imports a dotted handler path. An import error or a missing attribute is logged and resolves to no handler,
+    anything else is raised
+    :param path: The dotted path
+    :return: The function or None
+    """
+    try:
+      return frappe.get_attr(path)
+    except (AttributeError, ImportError):
+      frappe.log_error(frappe.get_traceback(), 'FSM handler {} of {} not found'.format(path, self.doctype))
+      return None
+
+  def get_method(self, name: str):
+    fn = getattr(self.controller, name, None)
+    if not callable(fn):
+      return None
+    return FSMHandler(fn, True)
+
+
+def get_handler(doctype: str, docfield: str = None, custom_call: str = None):
+  """
+  The handler applying an Update Request on the doctype
+  :param doctype: The target doctype
+  :param docfield: The Update Request's docfield
+  :param custom_call: The Update Request's custom call
+  :return: FSMHandler or None
+  """
+  return get_dispatch_table(doctype).get(docfield, custom_call)
+
+
+def get_transitions(doctype: str):
+  """
+  The allowed transitions of the doctype's fields
+  :param doctype: The target doctype
+  :return: TransitionGraph
+  """
+  return get_dispatch_table(doctype).transitions
+
+
+def get_dispatch_table(doctype: str) -> DispatchTable:
+  key = (getattr(frappe.local, 'site', None), doctype)
+  table = _registry.get(key)
+  # The controller class changes when it is reloaded, rebuild the table in that case
+  if not table or table.controller is not get_controller(doctype):
+    table = _registry[key] = DispatchTable(doctype)
+  return table
+
+
+def get_doctype_info(doctype: str) -> DoctypeInfo:
+  """
+  The controller of the doctype and whether it is a child doctype or extends FSMDocument, cached per worker.
+  Schema changes reset the metadata version, which rebuilds the entry
+  :param doctype: The target doctype
+  :return:
+  """
+  from frappe_state_management.classes.fsm_document import FSMDocument
+
+  key = (getattr(frappe.local, 'site', None), doctype)
+  metadata_version = frappe.cache().get_value('metadata_version')
+  controller = get_controller(doctype)
+  info = _doctype_info.get(key)
+  if not info or info.metadata_version != metadata_version or info.controller is not controller:
+    info = _doctype_info[key] = DoctypeInfo(controller, frappe.get_meta(doctype).istable,
+                                            issubclass(controller, FSMDocument), metadata_version)
+  return info
+
+
+def clear_registry():
+  """
+  Called on `frappe.clear_cache` through the `clear_cache` hook
+  :return:
+  """
+  _registry.clear()
+  _doctype_info.clear()
@@ -1,12 +1,25 @@
 import copy
+from contextlib import contextmanager
 
 import frappe
 from frappe import _
 from frappe.model.document import Document
+from frappe.utils import cint, now_datetime
+from frappe_state_management.classes.fsm_bulk import bulk_insert_documents, bulk_load_documents
+from frappe_state_management.classes.fsm_concurrency import run_with_concurrency
+from frappe_state_management.classes.fsm_checkpoint import on_update_requests_applied, on_revert
+from frappe_state_management.classes.fsm_data import parse_data
+from frappe_state_management.classes.fsm_dispatch import get_handler, get_transitions
+from frappe_state_management.classes.fsm_inbox import clear_pending_counts
+from frappe_state_management.classes.fsm_retry import is_deadlock, schedule_retry
+from frappe_state_management.classes.fsm_trace import trace, stage
+from frappe_state_management.classes.fsm_tracking import TrackedTable, FSMSnapshot
+from frappe_state_management.classes.fsm_revert_data import get_revert_delta, dumps, is_revert_delta, \
+  apply_revert_delta
 from frappe_state_management.classes.fsm_error import MethodNotDefinedError, MissingRevertDataError, \
-  MissingOrInvalidDataError
-from frappe_state_management.frappe_state_management.doctype.update_request.update_request import UpdateRequest
-import inspect
+  MissingOrInvalidDataError, PendingUpdateRequestError
+from frappe_state_management.frappe_state_management.doctype.update_request.update_request import UpdateRequest, \
+  child_rows_types, persist_update_requests
 
 child_row_methods = ['Add Child Row', 'Update Child Row', 'Delete Child Row']
 
@@ -15,34 +28,160 @@ class FSMDocument(Document):
   # TODO: Add documentation
   update_request: UpdateRequest
   is_revert = False
-  doc_before_save: Document
+  # Allowed transitions of Select, Check and Docstatus fields as {field: {from: [to, ...]}}, '*' matching any state.
+  # Extended per field by the `fsm_transitions` hook
+  fsm_transitions = {}
+  # Create requests with a list of payloads write the documents with batched inserts, skipping the controller hooks
+  fsm_bulk_create = False
+  doc_before_save: FSMSnapshot
+
+  def revert(self, update_request: UpdateRequest, dry_run=False):
+    result = self.revert_update_requests([update_request], dry_run=dry_run)
+    return result if dry_run else self.update_request
+
+  def revert_update_requests(self, update_requests: list, dry_run=False):
+    """
+    Reverts the Update Requests in the given order, newest first.
+    Revert items are planned first: items on the same document are merged so each document is loaded and saved
+    once, and the operations run in the reverse order of the changes.
+    :param update_requests: The Update Requests to revert
+    :param dry_run: Return the planned operations and their estimated cost without writing anything
+    :return: The reverted Update Requests, or the plan if `dry_run`
+    """
+    operations = self.get_revert_plan(update_requests)
+    if dry_run:
+      return self.describe_revert_plan(operations)
 
-  def revert(self, update_request: UpdateRequest):
-    self.update_request = update_request
     self.is_revert = True
-
-    for revert_item in update_request.revert_items:
-      doc: Document = frappe.get_doc(revert_item.dt, revert_item.docname)
-      revert_data = frappe._dict(self.parse_data(revert_item.revert_data))
-      if revert_item.change_type == 'Create':
-        meta = frappe.get_meta(revert_item.dt)
-        # If submittable, cancel the doc instead of delete
-        if meta.get('is_submittable', None):
-          doc.cancel()
-        else:
-          doc.delete()
-      elif revert_item.change_type == 'Update':
-        doc.update(revert_data)
-        doc.save()
-      elif revert_item.change_type == 'Remove':
-        doc = frappe.new_doc(revert_item.dt)
-        doc.update(revert_data)
-        doc.save()
-
-    if len(update_request.revert_items):
-      self.set_as_reverted()
-
-    return self.update_request
+    self.flags.in_revert = True
+    with trace('FSMDocument.revert', update_requests[0] if update_requests else None), \
+        self.deferred_update_request_writes(update_requests):
+      on_revert(self)
+      try:
+        with stage('revert_prefetch'):
+          docs = self.prefetch_revert_documents(operations)
+        with stage('revert_apply'):
+          for operation in operations:
+            self.run_revert_operation(operation, docs.get((operation.dt, operation.docname)))
+      finally:
+        self.flags.in_revert = False
+
+      for update_request in update_requests:
+        if len(update_request.revert_items):
+          self.update_request = update_request
+          self.set_as_reverted()
+
+    return update_requests
+
+  def get_revert_plan(self, update_requests: list) -> list:
+    """
+    Turns the revert items into operations, in the reverse order of the changes.
+    - Update items of the same document are merged into one "Update" operation
+    - Create items become "Delete", or "Cancel" for submittable doctypes, replacing the document's updates
+    - Remove items become "Restore"
+    :param update_requests: The Update Requests to revert, newest first
+    :return: List of operations
+    """
+    operations = []
+    by_doc = {}
+    submittable = {}
+    for update_request in update_requests:
+      for revert_item in reversed(update_request.revert_items):
+        key = (revert_item.dt, revert_item.docname)
+        if revert_item.change_type == 'Update':
+          operation = by_doc.get(key)
+          if not operation:
+            operation = by_doc[key] = frappe._dict(operation='Update', dt=revert_item.dt,
+                                                   docname=revert_item.docname, revert_data=[])
+            operations.append(operation)
+          if operation.operation == 'Update':
+            operation.revert_data.append(frappe._dict(self.parse_data(revert_item.revert_data)))
+        elif revert_item.change_type == 'Create':
+          # The updates of a document are irrelevant once its creation is undone
+          if by_doc.get(key):
+            operations.remove(by_doc[key])
+          if revert_item.dt not in submittable:
+            submittable[revert_item.dt] = frappe.get_meta(revert_item.dt).get('is_submittable', None)
+          operation = by_doc[key] = frappe._dict(operation='Cancel' if submittable[revert_item.dt] else 'Delete',
+                                                 dt=revert_item.dt, docname=revert_item.docname, revert_data=[])
+          operations.append(operation)
+        elif revert_item.change_type == 'Remove':
+          operations.append(frappe._dict(operation='Restore', dt=revert_item.dt, docname=revert_item.docname,
+                                         revert_data=[frappe._dict(self.parse_data(revert_item.revert_data))]))
+    return operations
+
+  @staticmethod
+  def describe_revert_plan(operations: list) -> frappe._dict:
+    """
+    The planned operations and their estimated cost in documents loaded, writes and load queries
+    :param operations: The operations returned by `get_revert_plan`
+    :return:
+    """
+    loaded = [x for x in operations if x.operation != 'Restore']
+    doctypes = set(x.dt for x in loaded)
+    return frappe._dict(
+        operations=[frappe._dict(operation=x.operation, dt=x.dt, docname=x.docname, items=len(x.revert_data) or 1)
+                    for x in operations],
+        cost=frappe._dict(loads=len(loaded), writes=len(operations),
+                          queries=sum(1 + len(frappe.get_meta(x).get_table_fields()) for x in doctypes)))
+
+  def prefetch_revert_documents(self, operations: list) -> dict:
+    """
+    Loads the documents to revert with one query per doctype and one per child table, see `bulk_load_documents`,
+    and checks that every one of them exists. This document is reused as-is
+    :param operations: The operations returned by `get_revert_plan`
+    :return: (dt, docname) => Document
+    """
+    names = {}
+    for operation in operations:
+      if operation.operation != 'Restore':
+        names.setdefault(operation.dt, set()).add(operation.docname)
+
+    docs = {}
+    for doctype, docnames in names.items():
+      if doctype == self.doctype and self.name in docnames:
+        docs[(doctype, self.name)] = self
+        docnames = docnames - {self.name}
+      if frappe.get_meta(doctype).issingle:
+        loaded = {x: frappe.get_doc(doctype, x) for x in docnames}
+      else:
+        loaded = bulk_load_documents(doctype, list(docnames))
+      missing = docnames - set(loaded)
+      if missing:
+        frappe.throw(_('Cannot revert, {0} {1} not found').format(doctype, ', '.join(missing)),
+                     frappe.DoesNotExistError)
+      for docname, doc in loaded.items():
+        docs[(doctype, docname)] = doc
+    return docs
+
+  def run_revert_operation(self, operation: frappe._dict, doc: Document):
+    """
+    Runs a single operation of the revert plan
+    :param operation: The operation
+    :param doc: The prefetched document, None for "Restore"
+    :return:
+    """
+    if operation.operation == 'Update':
+      for revert_data in operation.revert_data:
+        self.apply_revert_data(doc, revert_data)
+      doc.save()
+    elif operation.operation == 'Cancel':
+      # Drafts of submittable doctypes are deleted
+      doc.cancel() if doc.docstatus == 1 else doc.delete()
+    elif operation.operation == 'Delete':
+      doc.delete()
+    elif operation.operation == 'Restore':
+      doc = frappe.new_doc(operation.dt)
+      doc.update(operation.revert_data[0])
+      doc.save()
+
+  @staticmethod
+  def apply_revert_data(doc: Document, revert_data: frappe._dict):
+    # Revert data is either a delta or, for older Update Requests, the whole document
+    if is_revert_delta(revert_data):
+      apply_revert_delta(doc, revert_data)
+    else:
+      doc.update(revert_data)
 
   def create_document(self, update_request: UpdateRequest):
     """
@@ -52,87 +191,373 @@ class FSMDocument(Document):
     :return:
     """
     self.update_request = update_request
-    try:
-      if self.update_request.status in ('Approved', 'Pending'):
-        method_call = None
-        data = self.parse_data()
-        if self.update_request.custom_call:
-          if '.' in self.update_request.custom_call:
-            method_call = frappe.get_attr(self.update_request.custom_call)
-          else:
-            method_call = getattr(self, self.update_request.custom_call)
-
-        # If a method is specified, use it, otherwise create the document without inserting
-        if not method_call:
-          getattr(self, '_create_')()
+    with trace('FSMDocument.create_document', update_request, store_duration=True), \
+        self.deferred_update_request_writes([update_request]):
+      savepoint = self.start_attempt()
+      try:
+        if self.update_request.status in ('Approved', 'Pending'):
+          method_call = None
+          data = self.parse_data()
+          if self.update_request.custom_call:
+            if '.' in self.update_request.custom_call:
+              method_call = frappe.get_attr(self.update_request.custom_call)
+            else:
+              method_call = getattr(self, self.update_request.custom_call)
+
+          # If a method is specified, use it, otherwise create the document without inserting
+          with stage('handler'):
+            if not method_call:
+              getattr(self, '_create_')()
+            else:
+              method_call(data)
+
+        elif self.update_request.status == 'Pending Approval':
+          frappe.throw(_('Update Request is Pending Approval'))
         else:
-          method_call(data)
+          frappe.throw(_('Update Request processed. Create a new one for updates'))
+      except Exception as e:
+        self.fail_attempt(savepoint, e)
+        self.add_error_to_update_request(
+            "Exception Name: {name}\nException Message: {message}".format(name=type(e).__name__, message=str(e)), e)
 
-      elif self.update_request.status == 'Pending Approval':
-        frappe.throw(_('Update Request is Pending Approval'))
-      else:
-        frappe.throw(_('Update Request processed. Create a new one for updates'))
-    except Exception as e:
-      self.add_error_to_update_request(
-          "Exception Name: {name}\nException Message: {message}".format(name=type(e).__name__, message=str(e)))
+  def create_documents(self, update_request: UpdateRequest):
+    """
+    Called if the update request is of type "Create" with a list of payloads, on an unsaved document of the doctype.
+    Payloads are created in batches of `fsm_bulk_create_batch_size` (500 by default), with batched inserts if the
+    doctype sets `fsm_bulk_create`, otherwise one by one through the custom call or `_create_`. A custom call receives
+    the payload and returns the document it created, or its name.
+    A failing payload is reported in the error and the others are still created. Every created document is added
+    as a "Create" revert item so the batch is reverted together
+    :param update_request:
+    :return:
+    """
+    self.update_request = update_request
+    with trace('FSMDocument.create_documents', update_request, store_duration=True), \
+        self.deferred_update_request_writes([update_request]):
+      created, failures = [], []
+      try:
+        if self.update_request.status not in ('Approved', 'Pending'):
+          frappe.throw(_('Update Request is Pending Approval') if self.is_pending_approval() else
+                       _('Update Request processed. Create a new one for updates'))
+        payloads = self.parse_data()
+        batch_size = cint(frappe.conf.get('fsm_bulk_create_batch_size')) or 500
+        for start in range(0, len(payloads), batch_size):
+          with stage('handler'):
+            if self.fsm_bulk_create and not self.update_request.custom_call:
+              self.bulk_create_batch(payloads[start:start + batch_size], start, created, failures)
+            else:
+              self.create_batch(payloads[start:start + batch_size], start, created, failures)
+      except Exception as e:
+        self.add_error_to_update_request(self.get_error_message(e))
+        return
+
+      self.update_request.created_count = len(created)
+      self.update_request.failed_count = len(failures)
+      self.update_request.error = '\n'.join('Row {}: {}'.format(idx + 1, error) for idx, error in failures)
+      if not len(created):
+        self.set_as_failed()
+        return
+      self.add_revert_data([{'dt': dt, 'docname': name, 'change_type': 'Create'} for dt, name in created])
+      self.set_as_success()
+
+  def create_batch(self, payloads: list, start: int, created: list, failures: list):
+    """
+    Creates the documents one by one, each under its own savepoint
+    :param payloads: The payloads of the batch
+    :param start: The row index of the first payload
+    :param created: (doctype, docname) of the created documents, appended to
+    :param failures: (row index, error) of the failed payloads, appended to
+    :return:
+    """
+    custom_call = self.update_request.custom_call
+    for idx, payload in enumerate(payloads, start):
+      savepoint = 'fsm_create_{}'.format(frappe.generate_hash(length=8))
+      frappe.db.savepoint(savepoint)
+      try:
+        if custom_call and '.' in custom_call:
+          result = frappe.get_attr(custom_call)(payload)
+        else:
+          doc = frappe.get_doc(dict(payload, doctype=self.doctype))
+          doc.update_request = self.update_request
+          # The Update Request is saved once, after the batch
+          doc.flags.in_bulk_update = True
+          result = getattr(doc, custom_call or '_create_')(*([payload] if custom_call else []))
+          # Methods of the document may insert it without returning it
+          if result is None:
+            result = doc
+        created.append(self.get_created_document(result))
+      except Exception as e:
+        frappe.db.rollback(save_point=savepoint)
+        failures.append((idx, str(e)))
+
+  def get_created_document(self, result) -> tuple:
+    """
+    The document returned by `_create_` or a custom call, checked to be in the database
+    :param result: The returned document or docname
+    :return: (doctype, docname)
+    """
+    if isinstance(result, Document):
+      dt, name = result.doctype, result.name
+      inserted = name and not result.get('__islocal')
+    else:
+      dt, name = self.doctype, result
+      inserted = bool(name)
+    if not inserted or not frappe.db.exists(dt, name):
+      frappe.throw(_('Document was not inserted, the custom call should return the created document or its name'))
+    return dt, name
+
+  def bulk_create_batch(self, payloads: list, start: int, created: list, failures: list):
+    """
+    Creates the documents with one insert query per doctype. Only the defaults, naming and mandatory fields are
+    handled, controller hooks are not run. If the database rejects the batch, the documents are inserted one by one
+    :param payloads: The payloads of the batch
+    :param start: The row index of the first payload
+    :param created: (doctype, docname) of the created documents, appended to
+    :param failures: (row index, error) of the failed payloads, appended to
+    :return:
+    """
+    docs = []
+    for idx, payload in enumerate(payloads, start):
+      try:
+        doc = frappe.get_doc(dict(payload, doctype=self.doctype))
+        doc._set_defaults()
+        doc.set_new_name()
+        doc._validate_mandatory()
+        docs.append((idx, doc))
+      except Exception as e:
+        failures.append((idx, str(e)))
+
+    savepoint = 'fsm_create_{}'.format(frappe.generate_hash(length=8))
+    frappe.db.savepoint(savepoint)
+    try:
+      bulk_insert_documents([doc for idx, doc in docs])
+      created.extend((self.doctype, doc.name) for idx, doc in docs)
+      return
+    except Exception:
+      frappe.db.rollback(save_point=savepoint)
+
+    for idx, doc in docs:
+      frappe.db.savepoint(savepoint)
+      try:
+        doc.db_insert()
+        for d in doc.get_all_children():
+          d.db_insert()
+        created.append((self.doctype, doc.name))
+      except Exception as e:
+        frappe.db.rollback(save_point=savepoint)
+        failures.append((idx, str(e)))
 
   def apply_update_request(self, update_request: UpdateRequest) -> None:
     self.update_request = update_request
-    self.doc_before_save = copy.copy(self)
-    self.validate_child_table()
-    try:
-      if self.update_request.status in ('Approved', 'Pending'):
-        method_call = None
-        revert_data = None
-        if self.update_request.custom_call:
-          if '.' in self.update_request.custom_call:
-            method_call = frappe.get_attr(self.update_request.custom_call)
-          else:
-            method_call = getattr(self, self.update_request.custom_call, None)
-        elif frappe.get_hooks('fsm_fields', {}).get(self.doctype, {}).get(self.update_request.docfield):
-          revert_data = frappe.call(
-              frappe.get_hooks('fsm_fields', {}).get(self.doctype, {}).get(self.update_request.docfield)[-1], self)
+    with trace('FSMDocument.apply_update_request', update_request, store_duration=True), \
+        self.deferred_update_request_writes([update_request]):
+      self.validate_child_table()
+      savepoint = self.start_attempt()
+      try:
+        if self.update_request.status in ('Approved', 'Pending'):
+          def apply():
+            self.doc_before_save = self.start_tracking()
+            try:
+              with stage('handler'):
+                self.run_update_request()
+            finally:
+              self.stop_tracking()
+
+            # Finally save the document if there are no exceptions raised
+            with stage('save'):
+              self.save(ignore_permissions=True)
+
+          run_with_concurrency(self, apply, [self.update_request])
+
+        elif self.update_request.status == 'Pending Approval':
+          frappe.throw(_('Update Request is Pending Approval'))
         else:
-          method_call = getattr(self, "_{}".format(self.update_request.docfield), None)
-
-        if not (method_call or revert_data):
-          raise MethodNotDefinedError
-
-        if not revert_data and method_call:
-          if self.update_request.custom_call and '.' in self.update_request.custom_call and len(inspect.getfullargspec(method_call).args) > 0:
-            revert_data = method_call(self)
-          else:
-            revert_data = method_call()
-        if not self.is_pending_approval():
-          if not revert_data and not len(revert_data):
-            raise MissingRevertDataError
-          self.add_revert_data(revert_data)
-
-        # Finally save the document if there are no exceptions raised
+          frappe.throw(_('Update Request processed. Create a new one for updates'))
+      except Exception as e:
+        self.fail_attempt(savepoint, e)
+        self.add_error_to_update_request(self.get_error_message(e), e)
+
+  @staticmethod
+  def start_attempt() -> str:
+    """
+    Takes the savepoint an attempt to apply an Update Request rolls back to when it fails, so a failed or retried
+    request leaves no partial writes behind
+    :return: The savepoint
+    """
+    savepoint = 'fsm_attempt_{}'.format(frappe.generate_hash(length=8))
+    frappe.db.savepoint(savepoint)
+    return savepoint
+
+  @staticmethod
+  def fail_attempt(savepoint: str, e: Exception):
+    """
+    Rolls back the writes of a failed attempt.
+    A deadlock rolls back the whole transaction, the savepoint with it, and the Update Request too if it was inserted
+    in that transaction. The exception is raised again rather than persisting a request that may no longer exist,
+    the retry of committed requests is scheduled by the worker, see `fsm_retry.retry_update_requests`
+    :param savepoint: The savepoint taken by `start_attempt`
+    :param e: The raised exception
+    :return:
+    """
+    if is_deadlock(e):
+      raise e
+    frappe.db.rollback(save_point=savepoint)
+
+  def apply_update_requests(self, update_requests: list, stop_on_approval=False) -> list:
+    """
+    Applies several Update Requests targeting this document in the given order, saving the document once.
+    A failing Update Request is marked as "Failed", its changes on the document are discarded and its database writes
+    are rolled back to a savepoint taken before it.
+    The Update Requests themselves are not saved, the caller is responsible for persisting them.
+    :param update_requests: Ordered list of Update Requests targeting this document
+    :param stop_on_approval: Leave the Update Requests behind one that goes Pending Approval untouched,
+    instead of failing them
+    :return: The Update Requests that were applied
+    """
+    applied = []
+
+    def apply():
+      del applied[:]
+      for update_request in update_requests:
+        if stop_on_approval and any(x.status == 'Pending Approval' for x in applied):
+          break
+        self.update_request = update_request
+        # The database writes of the handler are discarded along with its changes on the document
+        savepoint = 'fsm_request_{}'.format(frappe.generate_hash(length=8))
+        frappe.db.savepoint(savepoint)
+        try:
+          self.validate_child_table()
+          if self.update_request.status not in ('Approved', 'Pending'):
+            frappe.throw(_('Update Request processed. Create a new one for updates'))
+          # Requests queued behind one that is now Pending Approval can't proceed
+          if any(x.status == 'Pending Approval' for x in applied):
+            raise PendingUpdateRequestError
+          self.doc_before_save = self.start_tracking()
+          self.run_update_request()
+          applied.append(update_request)
+        except Exception as e:
+          frappe.db.rollback(save_point=savepoint)
+          self.rollback_changes()
+          self.add_error_to_update_request(self.get_error_message(e))
+        finally:
+          self.stop_tracking()
+
+      if len(applied):
         self.save(ignore_permissions=True)
 
-      elif self.update_request.status == 'Pending Approval':
-        frappe.throw(_('Update Request is Pending Approval'))
-      else:
-        frappe.throw(_('Update Request processed. Create a new one for updates'))
-    except Exception as e:
-      msg = "Exception Name: {name}\nException Message: {message}".format(name=type(e).__name__, message=str(e))
-      if frappe.conf.get('developer_mode'):
-        msg += 'Traceback: {}'.format(frappe.get_traceback())
-      self.add_error_to_update_request(msg)
+    self.flags.in_bulk_update = True
+    try:
+      run_with_concurrency(self, apply, update_requests)
+
+      applied_on = now_datetime()
+      succeeded = [x for x in applied if x.status != 'Pending Approval']
+      for update_request in succeeded:
+        update_request.status = 'Success'
+        update_request.applied_on = applied_on
+      if len(succeeded):
+        on_update_requests_applied(self, len(succeeded), applied_on)
+    finally:
+      self.flags.in_bulk_update = False
+
+    return applied
+
+  def run_update_request(self):
+    """
+    Resolves and calls the method handling the Update Request and collects its revert data.
+    The document is not saved
+    :return:
+    """
+    handler = get_handler(self.doctype, self.update_request.docfield, self.update_request.custom_call)
+    if handler:
+      revert_data = handler.fn(self) if handler.pass_doc else handler.fn()
+    elif self.update_request.type in child_rows_types:
+      revert_data = self.apply_child_rows()
+    else:
+      raise MethodNotDefinedError
+    self.validate_transitions()
+    if not self.is_pending_approval():
+      if not revert_data:
+        raise MissingRevertDataError
+      self.add_revert_data(revert_data)
+
+  def validate_transitions(self):
+    """
+    Raises `InvalidFieldTransitionError` if the handler changed a field to a state that is not allowed from its
+    original one, see `fsm_transitions.compile_transitions`. Only the fields changed by the handler are checked
+    :return:
+    """
+    transitions = get_transitions(self.doctype)
+    for field, value in (self.__dict__.get('_tracked_fields') or {}).items():
+      transitions.validate(field, value, self.__dict__.get(field))
+
+  def get_error_message(self, e: Exception) -> str:
+    """
+    Formats the exception to be stored in the Update Request's error field
+    :param e: The raised exception
+    :return:
+    """
+    msg = "Exception Name: {name}\nException Message: {message}".format(name=type(e).__name__, message=str(e))
+    if frappe.conf.get('developer_mode'):
+      msg += 'Traceback: {}'.format(frappe.get_traceback())
+    return msg
 
   def set_as_pending_approval(self, approval_party):
     self.update_request.status = 'Pending Approval'
     self.update_request.approval_party = approval_party
-    self.update_request.save(ignore_permissions=True)
+    self.save_update_request()
+    clear_pending_counts(approval_party)
 
   def set_as_success(self):
     self.update_request.status = 'Success'
-    self.update_request.save(ignore_permissions=True)
+    self.update_request.applied_on = now_datetime()
+    self.update_request.set_as_head()
+    on_update_requests_applied(self, 1, self.update_request.applied_on)
+    self.save_update_request()
 
   def set_as_failed(self):
     self.update_request.status = 'Failed'
-    self.update_request.save(ignore_permissions=True)
+    self.save_update_request()
+
+  def save_update_request(self):
+    """
+    Persists the Update Request and records its status in the change feed, see `persist_update_requests`.
+    Inside `deferred_update_request_writes` the write is left to the end of the block, so an application writes
+    the Update Request once whatever the number of status changes. When multiple Update Requests are applied at
+    once, they are persisted and recorded together by the caller
+    :return:
+    """
+    if self.flags.in_bulk_update:
+      return
+    if self.flags.defer_update_request_writes:
+      self.update_request.flags.unsaved = True
+      return
+    with stage('status_write'):
+      persist_update_requests([self.update_request])
+
+  @contextmanager
+  def deferred_update_request_writes(self, update_requests: list):
+    """
+    Keeps the status changes of the Update Requests made inside the block in memory, and persists the changed ones
+    once the block exits. Nothing is written if the block raises
+    :param update_requests: The Update Requests processed in the block
+    :return:
+    """
+    if self.flags.defer_update_request_writes:
+      yield
+      return
+
+    self.flags.defer_update_request_writes = True
+    try:
+      yield
+    finally:
+      self.flags.defer_update_request_writes = False
+
+    unsaved = [x for x in update_requests if x.flags.unsaved]
+    for update_request in unsaved:
+      update_request.flags.unsaved = False
+    if len(unsaved):
+      with stage('status_write'):
+        persist_update_requests(unsaved)
 
   def on_update(self):
     """
@@ -141,7 +566,7 @@ class FSMDocument(Document):
     super().on_update()
     :return:
     """
-    if self.get('update_request') and not self.is_pending_approval():
+    if self.should_set_update_request_status():
       if self.is_revert:
         self.set_as_reverted()
       else:
@@ -154,7 +579,7 @@ class FSMDocument(Document):
         super().on_update_after_submit()
         :return:
         """
-    if self.get('update_request') and not self.is_pending_approval():
+    if self.should_set_update_request_status():
       if self.is_revert:
         self.set_as_reverted()
       else:
@@ -167,17 +592,30 @@ class FSMDocument(Document):
     super().before_insert()
     :return:
     """
-    if self.get('update_request') and not self.is_pending_approval():
+    if self.should_set_update_request_status():
       self.update_request.created_docname = self.name
       self.set_as_success()
 
-  def add_error_to_update_request(self, error: str):
+  def should_set_update_request_status(self):
+    """
+    The status is set by the caller when multiple Update Requests are applied or reverted at once
+    :return:
     """
-    Add the error object to the Update Request and mark it as "Failed"
+    return self.get('update_request') and not self.flags.in_bulk_update and not self.flags.in_revert and \
+           not self.is_pending_approval()
+
+  def add_error_to_update_request(self, error: str, e: Exception = None):
+    """
+    Add the error object to the Update Request and mark it as "Failed", unless the exception is transient and
+    another attempt is scheduled, see `fsm_retry.schedule_retry`
     :param error: The error string
+    :param e: The raised exception
     :return:
     """
     self.update_request.error = error
+    if e and schedule_retry(self.update_request, e):
+      self.save_update_request()
+      return
     self.set_as_failed()
 
   def add_revert_data(self, revert_items: list):
@@ -203,13 +641,171 @@ class FSMDocument(Document):
     """
     self.is_revert = False
     self.update_request.status = 'Reverted'
+    self.update_request.remove_as_head()
+    self.save_update_request()
 
   def has_update_request(self):
     return getattr(self, 'update_request', None)
 
   def standard_revert_data(self) -> list:
+    """
+    Revert data of the changes made on this document since the Update Request started.
+    Only the changed fields and child rows are stored, see `fsm_revert_data.get_revert_delta`
+    :return:
+    """
+    # Name new child rows now so the delta can reference them. Untouched tables have no new rows
+    for fieldname in self.__dict__.get('_tracked_tables') or {}:
+      for d in list.__iter__(self.get(fieldname) or []):
+        if not d.name:
+          d.name = frappe.generate_hash(d.doctype, 10)
     return [{'dt': self.doctype, 'docname': self.name, 'change_type': 'Update',
-             'revert_data': str(self.doc_before_save.as_dict())}]
+             'revert_data': dumps(self.get_tracked_delta())}]
+
+  def __setattr__(self, key, value):
+    if self.__dict__.get('_tracking'):
+      self.track_field(key)
+    super().__setattr__(key, value)
+
+  def set(self, key, value, as_value=False):
+    if self.__dict__.get('_tracking'):
+      self.track_field(key)
+    return super().set(key, value, as_value=as_value)
+
+  def start_tracking(self) -> FSMSnapshot:
+    """
+    Starts recording the original values of the fields and child tables changed by the Update Request.
+    Fields are recorded when set, child tables when they are first used and single rows through `track_row`,
+    so the cost follows the size of the change rather than the size of the document
+    :return: A read-only view of the document before the changes
+    """
+    self.__dict__.update(_tracking=True, _tracked_fields={}, _tracked_tables={}, _tracked_rows={},
+                         _table_fieldnames=set(df.fieldname for df in self.meta.get_table_fields()))
+    for fieldname in self._table_fieldnames:
+      rows = self.__dict__.get(fieldname)
+      self.__dict__[fieldname] = TrackedTable(self, fieldname, list(list.__iter__(rows)) if rows else [])
+    return FSMSnapshot(self)
+
+  def stop_tracking(self):
+    """
+    Stops recording changes. The recorded values stay available to the snapshot until tracking starts again
+    :return:
+    """
+    if not self.__dict__.get('_tracking'):
+      return
+    self.__dict__['_tracking'] = False
+    for fieldname in self._table_fieldnames:
+      rows = self.__dict__.get(fieldname)
+      if isinstance(rows, TrackedTable):
+        self.__dict__[fieldname] = list(list.__iter__(rows))
+
+  def track_field(self, key: str):
+    if key in self._table_fieldnames:
+      self.track_table(key)
+    elif key not in self._tracked_fields and (key == 'docstatus' or self.meta.has_field(key)):
+      self._tracked_fields[key] = self.__dict__.get(key)
+
+  def track_table(self, fieldname: str):
+    """
+    Records the rows of the child table, called the first time the table is used
+    :param fieldname: The child table fieldname
+    :return:
+    """
+    if not self.__dict__.get('_tracking') or fieldname in self._tracked_tables:
+      return
+    tracked_rows = self._tracked_rows.get(fieldname, {})
+    self._tracked_tables[fieldname] = [tracked_rows[d.name] if d.name in tracked_rows else copy.copy(d)
+                                       for d in list.__iter__(self.__dict__.get(fieldname) or [])]
+
+  def track_row(self, fieldname: str, row: Document):
+    """
+    Records a single row before it is changed. Needed for rows obtained without going through the child table,
+    for example from `get_child_row_index`
+    :param fieldname: The child table fieldname
+    :param row: The child row
+    :return:
+    """
+    if not self.__dict__.get('_tracking') or fieldname in self._tracked_tables:
+      return
+    rows = self._tracked_rows.setdefault(fieldname, {})
+    if row.name not in rows:
+      rows[row.name] = copy.copy(row)
+
+  def get_original_value(self, key: str):
+    """
+    The value of the field, or the rows of the child table, before the Update Request
+    :param key: The fieldname
+    :return:
+    """
+    tracked_tables = self.__dict__.get('_tracked_tables') or {}
+    tracked_fields = self.__dict__.get('_tracked_fields') or {}
+    tracked_rows = (self.__dict__.get('_tracked_rows') or {}).get(key)
+    if key in tracked_tables:
+      return tracked_tables[key]
+    if key in tracked_fields:
+      return tracked_fields[key]
+    if tracked_rows:
+      return [tracked_rows.get(d.name, d) for d in list.__iter__(self.__dict__.get(key) or [])]
+    return getattr(self, key, None)
+
+  def get_original_values(self) -> dict:
+    """
+    The recorded fields and child tables before the Update Request, child rows as dicts
+    :return:
+    """
+    values = dict(self.__dict__.get('_tracked_fields') or {})
+    for fieldname in set(self.__dict__.get('_tracked_tables') or {}) | set(self.__dict__.get('_tracked_rows') or {}):
+      values[fieldname] = [d.as_dict() for d in self.get_original_value(fieldname)]
+    return values
+
+  def get_tracked_delta(self) -> dict:
+    """
+    The delta reverting the recorded changes, only the tracked fields and rows are compared
+    :return:
+    """
+    before, after = {}, {}
+    for key, value in (self.__dict__.get('_tracked_fields') or {}).items():
+      before[key] = value
+      after[key] = self.__dict__.get(key)
+
+    tracked_tables = self.__dict__.get('_tracked_tables') or {}
+    for fieldname, rows in tracked_tables.items():
+      before[fieldname] = [d.as_dict() for d in rows]
+      after[fieldname] = [d.as_dict() for d in list.__iter__(self.__dict__.get(fieldname) or [])]
+
+    row_tables = []
+    for fieldname, rows in (self.__dict__.get('_tracked_rows') or {}).items():
+      if fieldname in tracked_tables:
+        continue
+      current = {d.name: d for d in list.__iter__(self.__dict__.get(fieldname) or [])}
+      before[fieldname] = [d.as_dict() for d in rows.values()]
+      after[fieldname] = [current[name].as_dict() for name in rows if name in current]
+      row_tables.append(fieldname)
+
+    delta = get_revert_delta(before, after)
+    # Only some rows were compared and the table was not reordered, the rows keep their `idx` on revert
+    for fieldname in row_tables:
+      if fieldname in delta['tables']:
+        delta['tables'][fieldname].pop('order', None)
+    return delta
+
+  def rollback_changes(self):
+    """
+    Restores the recorded values, discarding the changes made since tracking started
+    :return:
+    """
+    if not self.__dict__.get('_tracking'):
+      return
+    self.__dict__['_tracking'] = False
+    for key, value in self._tracked_fields.items():
+      self.__dict__[key] = value
+    for fieldname, rows in self._tracked_rows.items():
+      if fieldname in self._tracked_tables:
+        continue
+      for d in list.__iter__(self.__dict__.get(fieldname) or []):
+        if d.name in rows:
+          d.__dict__.update(rows[d.name].__dict__)
+    for fieldname, rows in self._tracked_tables.items():
+      self.__dict__[fieldname] = list(rows)
 
   def is_pending(self):
     return self.update_request.status == 'Pending'
@@ -230,23 +826,85 @@ class FSMDocument(Document):
     return self.update_request.type == 'Delete Child Row'
 
   def parse_data(self, data=None):
-    try:
-      return frappe._dict(frappe.parse_json(frappe.parse_json(copy.copy(data or self.update_request.data))))
-    except :
-      import ast
-      return frappe._dict(ast.literal_eval(copy.copy(data or self.update_request.data)))
+    """
+    Parses the given data, or the Update Request's data which is decoded once and cached on the Update Request
+    :param data: The data to parse
+    :return:
+    """
+    if data is None:
+      return self.update_request.get_data()
+    return parse_data(data)
+
+  def is_child_rows_add(self):
+    return self.update_request.type == 'Add Child Rows'
+
+  def is_child_rows_update(self):
+    return self.update_request.type == 'Update Child Rows'
+
+  def is_child_rows_delete(self):
+    return self.update_request.type == 'Delete Child Rows'
+
+  def get_child_row_index(self) -> dict:
+    """
+    Rows of the Update Request's child table keyed by name. Built once per Update Request.
+    Call `track_row` before changing a row obtained from the index
+    :return:
+    """
+    if self.flags.child_row_index is None:
+      rows = self.get(self.update_request.docfield) or []
+      # Reading the rows doesn't count as using the table, see `track_row`
+      self.flags.child_row_index = {d.name: d for d in list.__iter__(rows)}
+    return self.flags.child_row_index
 
   def validate_child_table(self):
+    self.flags.child_row_index = None
     # Validate if `data` field is not provided, raise Error
     if self.update_request.type in child_row_methods:
       if not self.update_request.data:
         raise MissingOrInvalidDataError
       # Check if the data can be parsed to dict
-      try:
-        data = self.parse_data()
-      except:
+      data = self.parse_data()
+      if not isinstance(data, dict):
         raise MissingOrInvalidDataError
       # If we are deleting or updating a child, verify if the child_row exists
       if self.update_request.type in ['Update Child Row', 'Delete Child Row']:
-        if not any([x.name == data.get('name', None) for x in getattr(self, self.update_request.docfield, [])]):
+        if data.get('name', None) not in self.get_child_row_index():
           raise MissingOrInvalidDataError
+    elif self.update_request.type in child_rows_types:
+      if not self.update_request.data:
+        raise MissingOrInvalidDataError
+      rows = self.parse_data()
+      if not isinstance(rows, list) or not len(rows):
+        raise MissingOrInvalidDataError
+      # If we are deleting or updating children, verify if all the child rows exist
+      if self.update_request.type in ['Update Child Rows', 'Delete Child Rows']:
+        index = self.get_child_row_index()
+        if not all(row.get('name', None) in index for row in rows):
+          raise MissingOrInvalidDataError
+
+  def apply_child_rows(self) -> list:
+    """
+    Default handling of the "Add Child Rows", "Update Child Rows" and "Delete Child Rows" types,
+    used when the doctype has no method for the docfield.
+    All the rows are applied on the `docfield` child table and recorded as a single revert item
+    :return: The revert data
+    """
+    fieldname = self.update_request.docfield
+    rows = self.parse_data()
+    if self.is_child_rows_add():
+      for row in rows:
+        self.append(fieldname, row)
+    elif self.is_child_rows_update():
+      index = self.get_child_row_index()
+      for row in rows:
+        self.track_row(fieldname, index[row.get('name')])
+        index[row.get('name')].update(row)
+    elif self.is_child_rows_delete():
+      deleted = set(row.get('name') for row in rows)
+      remaining = [d for d in self.get(fieldname) if d.name not in deleted]
+      for idx, d in enumerate(remaining, start=1):
+        d.idx = idx
+      self.set(fieldname, remaining)
+    self.flags.child_row_index = None
+
+    return self.standard_revert_data()
@@ -37,6 +37,15 @@ class PendingUpdateRequestError(FSMError):
     super().__init__(message="Can't proceed with the update. Previous update request needs to be processed")
 
 
+class DuplicateUpdateRequestError(FSMError):
+  """
+  Error thrown when an update request is created with the idempotency key of an existing update request
+  """
+
+  def __init__(self):
+    super().__init__(message="An update request with the same idempotency key already exists")
+
+
 class MethodNotDefinedError(FSMError):
   """
   Error thrown when a method of a field is not defined
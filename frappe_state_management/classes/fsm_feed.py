@@ -0,0 +1,190 @@
+import frappe
+from frappe.utils import add_days, cint, now_datetime
+from frappe_state_management.classes.fsm_bulk import bulk_insert_documents
+
+# Statuses written to the change feed
+feed_statuses = ('Success', 'Failed', 'Reverted', 'Rejected', 'Pending Approval')
+event_dt = 'Update Request Event'
+event_fields = ['sequence', 'update_request', 'request_type', 'dt', 'docname', 'status', 'event_on']
+sequence_key = 'FSM-CHANGE-FEED'
+stream_key = 'fsm_change_feed'
+realtime_event = 'fsm_change_feed'
+# Set while an `assign_sequences` job is enqueued, the scheduled job catches up if it is lost
+sequencing_key = 'fsm_change_feed_sequencing'
+sequencing_ttl = 60
+
+
+class DBFeed(object):
+  """
+  Change feed stored in the `Update Request Event` table, written in the same transaction as the status change.
+  Events are written without a sequence, and numbered by `assign_sequences` once committed. Only that job locks the
+  `tabSeries` row, so status writes on different documents never wait on each other, and since committed events
+  are numbered by one job at a time, a consumer never skips an event numbered after it read a higher sequence
+  """
+
+  def append(self, events: list):
+    bulk_insert_documents([frappe.get_doc(dict(event, doctype=event_dt, sequence=None)) for event in events])
+    enqueue_assign_sequences()
+
+  def read(self, cursor, limit: int, dt: str = None) -> tuple:
+    values = {'cursor': cint(cursor), 'limit': limit}
+    condition = ''
+    if dt:
+      condition, values['dt'] = 'AND dt = %(dt)s', dt
+    events = frappe.db.sql("""
+      SELECT {fields} FROM `tabUpdate Request Event`
+      WHERE sequence > %(cursor)s {condition}
+      ORDER BY sequence ASC
+      LIMIT %(limit)s
+    """.format(fields=', '.join(event_fields), condition=condition), values, as_dict=True)
+    return events, events[-1].sequence if len(events) else cursor
+
+  def clear(self, before):
+    frappe.db.sql("DELETE FROM `tabUpdate Request Event` WHERE event_on < %s", before)
+
+  @staticmethod
+  def assign_sequences(batch_size: int) -> list:
+    """
+    Numbers the committed events without a sequence, in the order they were written.
+    The `tabSeries` row stays locked until the job's transaction is committed
+    :param batch_size: The maximum number of events to number
+    :return: The numbered events
+    """
+    frappe.db.sql("INSERT IGNORE INTO `tabSeries` (`name`, `current`) VALUES (%s, 0)", sequence_key)
+    current = cint(frappe.db.sql("SELECT `current` FROM `tabSeries` WHERE `name` = %s FOR UPDATE",
+                                 sequence_key)[0][0])
+    frappe.db.sql("SET @fsm_sequence = %s", current)
+    frappe.db.sql("""
+      UPDATE `tabUpdate Request Event` SET sequence = (@fsm_sequence := @fsm_sequence + 1)
+      WHERE sequence IS NULL
+      ORDER BY event_on ASC, creation ASC, name ASC
+      LIMIT %s
+    """, batch_size)
+    last = cint(frappe.db.sql("SELECT @fsm_sequence")[0][0])
+    if last == current:
+      return []
+    frappe.db.sql("UPDATE `tabSeries` SET `current` = %s WHERE `name` = %s", (last, sequence_key))
+    return frappe.db.sql("""
+      SELECT {fields} FROM `tabUpdate Request Event`
+      WHERE sequence > %s AND sequence <= %s
+      ORDER BY sequence ASC
+    """.format(fields=', '.join(event_fields)), (current, last), as_dict=True)
+
+
+class RedisFeed(object):
+  """
+  Change feed stored in a Redis stream, cursors being stream ids. Lighter than the table for local setups and tests,
+  but events are written right away: events of a transaction that is rolled back are still in the feed.
+  The stream is trimmed to `fsm_change_feed_max_length` events, 100000 by default
+  """
+
+  def append(self, events: list):
+    cache = frappe.cache()
+    key = cache.make_key(stream_key)
+    max_length = cint(frappe.conf.get('fsm_change_feed_max_length')) or 100000
+    for event in events:
+      event.sequence = frappe.safe_decode(cache.xadd(key, {k: frappe.as_unicode(v or '') for k, v in event.items()},
+                                                     maxlen=max_length, approximate=True))
+    publish(events)
+
+  def read(self, cursor, limit: int, dt: str = None) -> tuple:
+    cache = frappe.cache()
+    events = []
+    for entries in (cache.xread({cache.make_key(stream_key): cursor or '0-0'}, count=limit) or []):
+      for sequence, values in entries[1]:
+        # Filtered out events still move the cursor
+        cursor = frappe.safe_decode(sequence)
+        event = frappe._dict({frappe.safe_decode(k): frappe.safe_decode(v) for k, v in values.items()})
+        event.sequence = cursor
+        if not dt or event.dt == dt:
+          events.append(event)
+    return events, cursor
+
+  def clear(self, before):
+    # Trimmed by length on append
+    pass
+
+
+def get_feed():
+  """
+  The feed selected by the `fsm_change_feed` site config, "db" (default) or "redis"
+  :return:
+  """
+  return RedisFeed() if frappe.conf.get('fsm_change_feed') == 'redis' else DBFeed()
+
+
+def publish(events: list):
+  """
+  Publishes the events to the `fsm_change_feed` realtime event once committed, if the `fsm_change_feed_realtime`
+  site config is set
+  :param events: Events with their sequence
+  :return:
+  """
+  if len(events) and frappe.conf.get('fsm_change_feed_realtime'):
+    frappe.publish_realtime(realtime_event, {'events': events}, after_commit=True)
+
+
+def enqueue_assign_sequences():
+  """
+  Enqueues `assign_sequences` after the commit, unless a job is already enqueued and not started yet.
+  The job numbers every committed event, so one job serves all the transactions writing events until it starts
+  :return:
+  """
+  cache = frappe.cache()
+  if not cache.set(cache.make_key(sequencing_key), 1, nx=True, ex=sequencing_ttl):
+    return
+  frappe.enqueue('frappe_state_management.classes.fsm_feed.assign_sequences', queue='short',
+                 enqueue_after_commit=True, now=frappe.flags.in_test)
+
+
+def assign_sequences():
+  """
+  Enqueued once by the commits writing events to the table, see `enqueue_assign_sequences`, and scheduled every
+  minute to catch up with the events committed once the job started or whose job was lost.
+  Numbers the new events, see `DBFeed.assign_sequences`, and publishes them
+  :return:
+  """
+  # Events committed from now on need another job
+  frappe.cache().delete_value(sequencing_key)
+  if isinstance(get_feed(), DBFeed):
+    publish(DBFeed.assign_sequences(cint(frappe.conf.get('fsm_change_feed_batch_size')) or 10000))
+
+
+def record(update_requests: list):
+  """
+  Appends the Update Requests in a feed status to the change feed
+  :param update_requests: Update Requests, or rows with the same fields, whose status was just persisted
+  :return:
+  """
+  now = now_datetime()
+  events = [frappe._dict(update_request=x.name, request_type=x.request_type, dt=x.dt,
+                         docname=x.docname or x.get('created_docname'), status=x.status, event_on=now)
+            for x in update_requests if x.name and x.status in feed_statuses]
+  if not len(events):
+    return
+
+  get_feed().append(events)
+
+
+def get_changes(cursor=None, limit=100, dt: str = None) -> frappe._dict:
+  """
+  The events after the cursor, oldest first
+  :param cursor: The `cursor` returned by the previous call, None to read from the start of the feed
+  :param limit: The batch size
+  :param dt: Only return the events of this doctype
+  :return: {events, cursor}
+  """
+  events, cursor = get_feed().read(cursor, max(cint(limit), 1), dt=dt)
+  return frappe._dict(events=events, cursor=cursor)
+
+
+def clear_old_events():
+  """
+  Daily job removing the events older than `fsm_change_feed_retention_days`, 30 by default. 0 keeps every event
+  :return:
+  """
+  retention_days = cint(frappe.conf.get('fsm_change_feed_retention_days', 30))
+  if retention_days <= 0:
+    return
+  get_feed().clear(add_days(now_datetime(), -retention_days))
+  frappe.db.commit()
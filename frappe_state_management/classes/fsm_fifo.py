@@ -0,0 +1,102 @@
+import frappe
+from frappe_state_management.classes.fsm_concurrency import load_target
+
+# Statuses releasing the target document for the requests waiting behind
+released_statuses = ('Success', 'Failed', 'Rejected')
+
+
+def is_fifo(doctype: str) -> bool:
+  """
+  Update Requests of the doctypes listed in the `fsm_fifo_doctypes` hook wait behind the Pending or Pending Approval
+  request of their document instead of failing with `PendingUpdateRequestError`
+  :param doctype: The target doctype
+  :return:
+  """
+  return doctype in (frappe.get_hooks('fsm_fifo_doctypes') or [])
+
+
+def has_waiting(dt: str, docname: str, exclude: str = None) -> bool:
+  return bool(frappe.db.exists('Update Request', {'dt': dt, 'docname': docname, 'waiting': 1, 'docstatus': 1,
+                                                  'name': ['!=', exclude or '']}))
+
+
+def get_queue_position(update_request) -> int:
+  """
+  The position of a waiting Update Request in the queue of its document, 0 if it's not waiting
+  :param update_request: The Update Request
+  :return:
+  """
+  if not update_request.waiting:
+    return 0
+  return frappe.db.count('Update Request', {'dt': update_request.dt, 'docname': update_request.docname, 'waiting': 1,
+                                            'docstatus': 1, 'creation': ['<', update_request.creation]}) + 1
+
+
+def release(update_requests: list):
+  """
+  Enqueues the draining of the documents released by the Update Requests, once the current transaction is committed
+  :param update_requests: Update Requests, or rows with the same fields, whose status was just persisted
+  :return:
+  """
+  released = set((x.dt, x.docname) for x in update_requests
+                 if x.status in released_statuses and x.docname and is_fifo(x.dt))
+  for dt, docname in released:
+    enqueue_drain(dt, docname)
+
+
+def enqueue_drain(dt: str, docname: str):
+  """
+  Enqueues the draining of a document once the current transaction is committed
+  :param dt: The target doctype
+  :param docname: The target docname
+  :return:
+  """
+  frappe.enqueue('frappe_state_management.classes.fsm_fifo.drain_waiting_update_requests', queue='default',
+                 enqueue_after_commit=True, now=frappe.flags.in_test, dt=dt, docname=docname)
+
+
+def drain_unclaimed_documents():
+  """
+  Scheduled every minute. Drains the documents that have waiting Update Requests but no active one, in case both
+  drains of a waiting request and of the request it waited on ran before the other committed
+  :return:
+  """
+  for dt, docname in frappe.db.sql("""
+    SELECT DISTINCT ur.dt, ur.docname FROM `tabUpdate Request` ur
+    WHERE ur.waiting = 1 AND ur.docstatus = 1 AND NOT EXISTS (
+      SELECT 1 FROM `tabUpdate Request` active WHERE active.pending_key = CONCAT(ur.dt, '::', ur.docname)
+    )
+  """):
+    enqueue_drain(dt, docname)
+
+
+def drain_waiting_update_requests(dt: str, docname: str):
+  """
+  Applies the Update Requests waiting on a document in the order they were created, loading and saving the document
+  once. Draining stops at the first request that goes Pending Approval, the ones behind it keep waiting.
+  Does nothing while another request holds the document
+  :param dt: The target doctype
+  :param docname: The target docname
+  :return:
+  """
+  from frappe_state_management.frappe_state_management.doctype.update_request.update_request import \
+    save_update_requests
+
+  rows = frappe.db.sql("""
+    SELECT * FROM `tabUpdate Request`
+    WHERE waiting = 1 AND docstatus = 1 AND dt = %s AND docname = %s
+    ORDER BY creation ASC
+    FOR UPDATE
+  """, (dt, docname), as_dict=True)
+  if not rows or frappe.db.exists('Update Request', {'pending_key': '{}::{}'.format(dt, docname)}):
+    return
+
+  update_requests = [frappe.get_doc(dict(row, doctype='Update Request')) for row in rows]
+  target = load_target(dt, docname)
+  target.apply_update_requests(update_requests, stop_on_approval=True)
+
+  # Requests left behind a Pending Approval one are still Pending
+  processed = [x for x in update_requests if x.status != 'Pending']
+  for update_request in processed:
+    update_request.waiting = 0
+  save_update_requests(processed)
@@ -0,0 +1,92 @@
+import frappe
+from frappe.utils import cint
+
+counts_key = 'fsm_approval_counts'
+inbox_fields = ['name', 'creation', 'owner', 'request_type', 'dt', 'docname', 'docfield', 'type', 'custom_call',
+                'party_type', 'approval_party']
+
+
+def get_inbox(approval_party: str, limit=20, cursor: str = None, dt: str = None, group_by_dt=False) -> frappe._dict:
+  """
+  The Update Requests Pending Approval of a party, oldest first.
+  Pages are read with keyset pagination on (creation, name), pass the returned `next_cursor` to read the next page
+  :param approval_party: The FSM Party Type
+  :param limit: The page size
+  :param cursor: The `next_cursor` of the previous page
+  :param dt: Only return the Update Requests of this doctype
+  :param group_by_dt: Group the page by doctype
+  :return: {items, next_cursor, counts} or {groups, next_cursor, counts} when grouped
+  """
+  limit = max(cint(limit), 1)
+  values = {'approval_party': approval_party, 'limit': limit}
+  conditions = ["approval_party = %(approval_party)s", "status = 'Pending Approval'", "docstatus = 1"]
+  if dt:
+    conditions.append("dt = %(dt)s")
+    values['dt'] = dt
+  if cursor:
+    values['creation'], _, values['name'] = cursor.partition('|')
+    conditions.append("(creation > %(creation)s OR (creation = %(creation)s AND name > %(name)s))")
+
+  items = frappe.db.sql("""
+    SELECT {fields} FROM `tabUpdate Request`
+    WHERE {conditions}
+    ORDER BY creation ASC, name ASC
+    LIMIT %(limit)s
+  """.format(fields=', '.join(inbox_fields), conditions=' AND '.join(conditions)), values, as_dict=True)
+
+  inbox = frappe._dict(next_cursor=None, counts=get_pending_counts(approval_party))
+  if len(items) == limit:
+    inbox.next_cursor = '{}|{}'.format(items[-1].creation, items[-1].name)
+
+  if group_by_dt:
+    groups = {}
+    for item in items:
+      groups.setdefault(item.dt, frappe._dict(dt=item.dt, count=inbox.counts.get(item.dt, 0), items=[]))
+      groups[item.dt]['items'].append(item)
+    inbox.groups = list(groups.values())
+  else:
+    inbox.items = items
+  return inbox
+
+
+def get_pending_counts(approval_party: str) -> dict:
+  """
+  The number of Update Requests Pending Approval of a party per doctype, cached until `clear_pending_counts` and for
+  `fsm_approval_counts_ttl` seconds at most (site config, 60 by default)
+  :param approval_party: The FSM Party Type
+  :return: {dt: count}
+  """
+  cache = frappe.cache()
+  key = '{}:{}'.format(counts_key, approval_party)
+  counts = cache.get_value(key)
+  if counts is None:
+    counts = dict(frappe.db.sql("""
+      SELECT dt, COUNT(*) FROM `tabUpdate Request`
+      WHERE approval_party = %s AND status = 'Pending Approval' AND docstatus = 1
+      GROUP BY dt
+    """, approval_party))
+    cache.set_value(key, counts, expires_in_sec=cint(frappe.conf.get('fsm_approval_counts_ttl')) or 60)
+  return counts
+
+
+def clear_pending_counts(*approval_parties):
+  """
+  Clears the cached counts of the parties, to be called whenever an Update Request enters or leaves Pending Approval.
+  The counts are cleared again once the transaction is committed, so a count cached from a read made in between
+  does not outlive the change
+  :param approval_parties: The FSM Party Types
+  :return:
+  """
+  keys = ['{}:{}'.format(counts_key, x) for x in set(approval_parties) if x]
+  if not len(keys):
+    return
+
+  def clear():
+    cache = frappe.cache()
+    for key in keys:
+      cache.delete_value(key)
+
+  clear()
+  after_commit = getattr(frappe.db, 'after_commit', None)
+  if after_commit is not None:
+    after_commit.add(clear)
@@ -0,0 +1,138 @@
+import frappe
+from frappe.utils import add_to_date, cint, now_datetime, time_diff_in_seconds
+from frappe_state_management.classes.fsm_retry import schedule_retry
+
+
+def is_queued(doctype: str) -> bool:
+  """
+  Update Requests of the doctypes listed in the `fsm_queued_doctypes` hook are applied by a background worker
+  :param doctype: The target doctype
+  :return:
+  """
+  return doctype in (frappe.get_hooks('fsm_queued_doctypes') or [])
+
+
+def enqueue_update_request(update_request):
+  """
+  Marks the Update Request as queued and enqueues the application of its document's queue.
+  The job runs once the current transaction is committed, synchronously in tests
+  :param update_request: The submitted or approved Update Request
+  :return:
+  """
+  update_request.db_set({'queued': 1, 'enqueued_on': now_datetime()}, update_modified=False)
+  if update_request.request_type == 'Create':
+    enqueue_document_queue(update_request.dt, update_request=update_request.name)
+  else:
+    enqueue_document_queue(update_request.dt, update_request.docname)
+
+
+def enqueue_document_queue(dt: str, docname: str = None, update_request: str = None):
+  """
+  Enqueues the application of the queued Update Requests of a document, see `apply_queued_update_requests`
+  :return:
+  """
+  kwargs = {'dt': dt}
+  if update_request:
+    kwargs['update_request'] = update_request
+  else:
+    kwargs['docname'] = docname
+
+  frappe.enqueue('frappe_state_management.classes.fsm_queue.apply_queued_update_requests', queue='default',
+                 enqueue_after_commit=True, now=frappe.flags.in_test, **kwargs)
+
+
+def apply_queued_update_requests(dt: str, docname: str = None, update_request: str = None):
+  """
+  Applies the queued Update Requests of a document in the order they were created.
+  The rows are locked, so jobs of the same document run one after the other while other documents run in parallel
+  :param dt: The target doctype
+  :param docname: The target docname
+  :param update_request: The Update Request name, for Create requests which have no docname yet
+  :return:
+  """
+  if update_request:
+    condition, value = 'name = %s', update_request
+  else:
+    condition, value = 'docname = %s', docname
+
+  names = frappe.db.sql_list("""
+    SELECT name FROM `tabUpdate Request`
+    WHERE queued = 1 AND docstatus = 1 AND dt = %s AND {condition}
+    ORDER BY creation ASC
+    FOR UPDATE
+  """.format(condition=condition), (dt, value))
+
+  for name in names:
+    update_request_doc = frappe.get_doc('Update Request', name)
+    update_request_doc.db_set('queued', 0, update_modified=False)
+    savepoint = 'fsm_queued_{}'.format(frappe.generate_hash(length=8))
+    frappe.db.savepoint(savepoint)
+    try:
+      update_request_doc.apply_update_request()
+    except Exception as e:
+      try:
+        frappe.db.rollback(save_point=savepoint)
+      except Exception:
+        # A deadlock rolled back the job, the requests are still queued and `requeue_stale_update_requests`
+        # enqueues them again
+        raise e
+      fail_queued_update_request(update_request_doc, e)
+
+
+def fail_queued_update_request(update_request_doc, e: Exception):
+  """
+  Marks a queued Update Request as "Failed", or schedules another attempt, when its application raised before
+  `FSMDocument` could handle the failure, for example because the target document was deleted
+  :param update_request_doc: The Update Request
+  :param e: The raised exception
+  :return:
+  """
+  from frappe_state_management.frappe_state_management.doctype.update_request.update_request import \
+    persist_update_requests
+
+  frappe.log_error(frappe.get_traceback(), 'FSM queued Update Request {} failed'.format(update_request_doc.name))
+  update_request_doc.error = "Exception Name: {name}\nException Message: {message}".format(name=type(e).__name__,
+                                                                                            message=str(e))
+  if not schedule_retry(update_request_doc, e):
+    update_request_doc.status = 'Failed'
+  persist_update_requests([update_request_doc])
+
+
+def requeue_stale_update_requests():
+  """
+  Scheduled every minute. Enqueues again the documents whose queued Update Requests were enqueued more than
+  `fsm_queue_stale_after` seconds ago (site config, 600 by default), in case their job was lost or rolled back
+  :return:
+  """
+  stale_before = add_to_date(now_datetime(), seconds=-(cint(frappe.conf.get('fsm_queue_stale_after')) or 600))
+  queues = []
+  for name, dt, docname, request_type in frappe.db.sql("""
+    SELECT name, dt, docname, request_type FROM `tabUpdate Request`
+    WHERE queued = 1 AND docstatus = 1 AND enqueued_on < %s
+    ORDER BY enqueued_on ASC
+  """, stale_before):
+    # Create requests have their own queue, see `enqueue_update_request`
+    key = (dt, None, name) if request_type == 'Create' else (dt, docname, None)
+    if key not in queues:
+      queues.append(key)
+
+  for dt, docname, update_request in queues:
+    enqueue_document_queue(dt, docname, update_request)
+
+
+def get_queue_stats() -> list:
+  """
+  Depth and lag of the queue per doctype
+  :return: List of {dt, depth, oldest, lag} where lag is the age in seconds of the oldest queued request
+  """
+  stats = frappe.db.sql("""
+    SELECT dt, COUNT(*) AS depth, MIN(enqueued_on) AS oldest
+    FROM `tabUpdate Request`
+    WHERE queued = 1 AND docstatus = 1
+    GROUP BY dt
+  """, as_dict=True)
+
+  now = now_datetime()
+  for row in stats:
+    row.lag = time_diff_in_seconds(now, row.oldest) if row.oldest else 0
+  return stats
@@ -0,0 +1,118 @@
+import random
+
+import frappe
+from frappe.utils import add_to_date, cint, now_datetime
+
+# Upper bound of the delay between two attempts, in seconds
+max_delay = 3600
+
+
+def is_transient(e: Exception) -> bool:
+  """
+  Failures that can succeed if the Update Request is applied again later: deadlocks, lock wait timeouts and
+  concurrent writes left after the optimistic retries
+  :param e: The raised exception
+  :return:
+  """
+  if isinstance(e, frappe.TimestampMismatchError) or is_deadlock(e):
+    return True
+  exc = getattr(frappe, 'QueryTimeoutError', None)
+  if exc and isinstance(e, exc):
+    return True
+  # The database checks read the error code from the first argument
+  return bool(e.args and hasattr(frappe.db, 'is_timedout') and frappe.db.is_timedout(e))
+
+
+def is_deadlock(e: Exception) -> bool:
+  """
+  Deadlocks roll back the whole transaction, not only the failing statement
+  :param e: The raised exception
+  :return:
+  """
+  exc = getattr(frappe, 'QueryDeadlockError', None)
+  if exc and isinstance(e, exc):
+    return True
+  return bool(e.args and hasattr(frappe.db, 'is_deadlocked') and frappe.db.is_deadlocked(e))
+
+
+def schedule_retry(update_request, e: Exception) -> bool:
+  """
+  Schedules another attempt of the Update Request if the failure is transient and the attempts of
+  `fsm_retry_max_attempts` (site config, 5 by default, 1 disables retries) are not used up.
+  The delay doubles with every retry from `fsm_retry_base_delay` seconds (30 by default), up to an hour, and is
+  randomized so requests that failed together are not retried together.
+  The status is left as is, and the target document stays claimed until the retry
+  :param update_request: The Update Request that failed
+  :param e: The raised exception
+  :return: True if a retry was scheduled
+  """
+  max_attempts = cint(frappe.conf.get('fsm_retry_max_attempts', 5))
+  if cint(update_request.retry_count) + 1 >= max_attempts or not is_transient(e):
+    return False
+
+  base_delay = cint(frappe.conf.get('fsm_retry_base_delay')) or 30
+  delay = min(base_delay * 2 ** cint(update_request.retry_count), max_delay)
+  update_request.retry_count = cint(update_request.retry_count) + 1
+  # Revert items collected by the failed attempt
+  update_request.revert_items = [x for x in update_request.revert_items if x.name and not x.get('__islocal')]
+  update_request.next_attempt_on = add_to_date(now_datetime(), seconds=random.uniform(delay / 2, delay))
+  return True
+
+
+def retry_update_requests():
+  """
+  Scheduled every minute. Applies again the Update Requests whose retry is due, in the order they are due.
+  Each one is committed on its own
+  :return:
+  """
+  names = frappe.db.sql_list("""
+    SELECT name FROM `tabUpdate Request`
+    WHERE next_attempt_on <= %s AND docstatus = 1 AND status IN ('Pending', 'Approved')
+    ORDER BY next_attempt_on ASC
+    LIMIT %s
+  """, (now_datetime(), cint(frappe.conf.get('fsm_retry_batch_size')) or 100))
+
+  for name in names:
+    try:
+      update_request = frappe.get_doc('Update Request', name, for_update=True)
+      # Another worker may have retried it already
+      if not update_request.next_attempt_on or update_request.status not in ('Pending', 'Approved'):
+        frappe.db.rollback()
+        continue
+      update_request.db_set('next_attempt_on', None, update_modified=False)
+      update_request.apply_or_enqueue()
+      frappe.db.commit()
+    except Exception as e:
+      frappe.db.rollback()
+      frappe.log_error(frappe.get_traceback(), 'FSM retry failed')
+      # The deadlock rolled back the attempt before it could be rescheduled, see `FSMDocument.fail_attempt`
+      if is_deadlock(e):
+        reschedule_update_request(name, e)
+
+
+def reschedule_update_request(name: str, e: Exception):
+  """
+  Schedules another attempt of an Update Request whose attempt was rolled back with its transaction, or marks it as
+  "Failed" once its attempts are used up. Committed on its own
+  :param name: The Update Request name
+  :param e: The raised exception
+  :return:
+  """
+  from frappe_state_management.frappe_state_management.doctype.update_request.update_request import \
+    persist_update_requests
+
+  try:
+    update_request = frappe.get_doc('Update Request', name, for_update=True)
+    if update_request.status not in ('Pending', 'Approved'):
+      frappe.db.rollback()
+      return
+    update_request.error = "Exception Name: {name}\nException Message: {message}".format(name=type(e).__name__,
+                                                                                        message=str(e))
+    if not schedule_retry(update_request, e):
+      update_request.status = 'Failed'
+      update_request.next_attempt_on = None
+    persist_update_requests([update_request])
+    frappe.db.commit()
+  except Exception:
+    frappe.db.rollback()
+    frappe.log_error(frappe.get_traceback(), 'FSM retry failed')
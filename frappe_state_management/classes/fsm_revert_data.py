@@ -0,0 +1,131 @@
+import json
+
+from frappe.model.document import Document
+from frappe.utils.response import json_handler
+
+# Version of the delta format stored in `Update Request Revert Item.revert_data`.
+# Revert data without a version is the legacy full document dump
+REVERT_DATA_VERSION = 2
+
+# Fields that are maintained by the framework and never reverted
+ignored_fields = ('name', 'owner', 'creation', 'modified', 'modified_by', 'idx', 'parent', 'parentfield',
+                  'parenttype', 'doctype', '__islocal', '__unsaved')
+
+
+def get_revert_delta(before: dict, after: dict) -> dict:
+  """
+  Computes the data needed to bring a document from `after` back to `before`.
+  Format:
+  {
+    "version": 2,
+    "fields": {fieldname: old_value},
+    "tables": {
+      table_fieldname: {
+        "added": [row names added by the update],
+        "removed": [full rows removed by the update],
+        "modified": {row name: {fieldname: old_value}},
+        "order": [row names in their order before the update]
+      }
+    }
+  }
+  :param before: The document as a dict before the update
+  :param after: The document as a dict after the update
+  :return: The delta
+  """
+  fields = {}
+  tables = {}
+  for key in set(before.keys()) | set(after.keys()):
+    if key in ignored_fields:
+      continue
+    old_value, new_value = before.get(key), after.get(key)
+    if isinstance(old_value, list) or isinstance(new_value, list):
+      table = get_table_delta(old_value or [], new_value or [])
+      if table:
+        tables[key] = table
+    elif old_value != new_value:
+      fields[key] = old_value
+
+  return {'version': REVERT_DATA_VERSION, 'fields': fields, 'tables': tables}
+
+
+def get_table_delta(before: list, after: list) -> dict:
+  """
+  Computes the added, removed and modified rows of a child table, keyed by row name
+  :param before: The rows before the update
+  :param after: The rows after the update
+  :return: The table delta or None if the table is unchanged
+  """
+  before_rows = {row.get('name'): row for row in before}
+  after_rows = {row.get('name'): row for row in after}
+
+  added = [name for name in after_rows if name not in before_rows]
+  removed = [strip_row(row) for name, row in before_rows.items() if name not in after_rows]
+  modified = {}
+  for name, row in after_rows.items():
+    if name not in before_rows:
+      continue
+    old_row = before_rows[name]
+    changes = {k: old_row.get(k) for k in set(old_row.keys()) | set(row.keys())
+               if k not in ignored_fields and old_row.get(k) != row.get(k)}
+    if changes:
+      modified[name] = changes
+
+  if not (added or removed or modified) and [r.get('name') for r in before] == [r.get('name') for r in after]:
+    return None
+  # `idx` is renumbered by the framework, the order is kept by name
+  return {'added': added, 'removed': removed, 'modified': modified, 'order': [row.get('name') for row in before]}
+
+
+def strip_row(row: dict) -> dict:
+  return {k: v for k, v in row.items() if k not in ('parent', 'parentfield', 'parenttype', 'doctype')}
+
+
+def dumps(delta: dict) -> str:
+  """
+  Serializes the delta to compact JSON
+  :param delta: The delta returned by `get_revert_delta`
+  :return:
+  """
+  return json.dumps(delta, default=json_handler, separators=(',', ':'))
+
+
+def is_revert_delta(revert_data: dict) -> bool:
+  return isinstance(revert_data, dict) and revert_data.get('version') == REVERT_DATA_VERSION
+
+
+def apply_revert_delta(doc: Document, delta: dict) -> Document:
+  """
+  Reverts the document in place using the delta. The document is not saved
+  :param doc: The document to revert
+  :param delta: The delta returned by `get_revert_delta`
+  :return: The document
+  """
+  doc.update(delta.get('fields') or {})
+
+  for fieldname, table in (delta.get('tables') or {}).items():
+    added = set(table.get('added') or [])
+    modified = table.get('modified') or {}
+    rows = []
+    for row in doc.get(fieldname) or []:
+      if row.name in added:
+        continue
+      if row.name in modified:
+        row.update(modified[row.name])
+      rows.append(row)
+
+    # Removed rows are inserted again under their original names
+    for row in table.get('removed') or []:
+      rows.append(doc.append(fieldname, dict(row, __islocal=1)))
+
+    # Deltas stored before the order was recorded fall back to `idx`
+    order = table.get('order')
+    if order is not None:
+      position = {name: i for i, name in enumerate(order)}
+      rows.sort(key=lambda r: (position.get(r.name, len(order)), r.idx or 0))
+    else:
+      rows.sort(key=lambda r: r.idx or 0)
+    for idx, row in enumerate(rows, start=1):
+      row.idx = idx
+    doc.set(fieldname, rows)
+
+  return doc
@@ -0,0 +1,165 @@
+import random
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import flt
+
+metrics_key = 'fsm_trace_metrics'
+
+
+class Trace(object):
+  """
+  Durations and query counts of the stages of one Update Request operation.
+  Queries are counted by wrapping `frappe.db.sql` while the trace is running
+  """
+
+  def __init__(self, name: str, update_request=None, store_duration=False):
+    self.name = name
+    self.update_request = update_request
+    self.store_duration = store_duration
+    self.stages = OrderedDict()
+    self.queries = 0
+    self.duration_ms = 0
+    self._start = None
+    self._sql = None
+
+  def start(self):
+    db = frappe.db
+    self._sql = db.__dict__.get('sql')
+    sql = db.sql
+
+    def counted_sql(*args, **kwargs):
+      self.queries += 1
+      return sql(*args, **kwargs)
+
+    db.sql = counted_sql
+    self._start = time.perf_counter()
+
+  def stop(self):
+    self.duration_ms = (time.perf_counter() - self._start) * 1000
+    if self._sql:
+      frappe.db.sql = self._sql
+    else:
+      frappe.db.__dict__.pop('sql', None)
+
+  def add_stage(self, name: str, duration_ms: float, queries: int):
+    stage = self.stages.setdefault(name, frappe._dict(duration_ms=0, queries=0, calls=0))
+    stage.duration_ms += duration_ms
+    stage.queries += queries
+    stage.calls += 1
+
+  def as_dict(self) -> frappe._dict:
+    update_request = self.update_request
+    return frappe._dict(trace=self.name, update_request=update_request.name if update_request else None,
+                        dt=update_request.dt if update_request else None,
+                        status=update_request.status if update_request else None,
+                        duration_ms=self.duration_ms, queries=self.queries, stages=self.stages)
+
+  def emit(self):
+    """
+    Sends the trace to the sinks listed in the `fsm_trace_sinks` hook, `log_sink` by default,
+    and stores the duration on the Update Request if requested
+    :return:
+    """
+    data = self.as_dict()
+    for sink in frappe.get_hooks('fsm_trace_sinks') or ['frappe_state_management.classes.fsm_trace.log_sink']:
+      try:
+        frappe.get_attr(sink)(data)
+      except Exception:
+        frappe.log_error(frappe.get_traceback(), 'FSM trace sink failed')
+
+    update_request = self.update_request
+    if self.store_duration and update_request and update_request.name and update_request.docstatus == 1:
+      update_request.db_set('duration_ms', flt(self.duration_ms, 3), update_modified=False)
+
+
+def is_sampled() -> bool:
+  """
+  Traces are sampled with the `fsm_trace_sample_rate` site config, from 0 (default, disabled) to 1
+  :return:
+  """
+  rate = flt(frappe.conf.get('fsm_trace_sample_rate'))
+  return rate > 0 and random.random() < rate
+
+
+def get_current_trace():
+  return getattr(frappe.local, 'fsm_trace', None)
+
+
+@contextmanager
+def trace(name: str, update_request=None, store_duration=False):
+  """
+  Traces an operation. Nested traces are merged into the outermost one, which is the one emitted
+  :param name: The name of the operation
+  :param update_request: The Update Request being processed
+  :param store_duration: Store the duration in the Update Request's `duration_ms`
+  :return:
+  """
+  current = get_current_trace()
+  if current or not is_sampled():
+    yield current
+    return
+
+  current = Trace(name, update_request, store_duration)
+  frappe.local.fsm_trace = current
+  current.start()
+  try:
+    yield current
+  finally:
+    current.stop()
+    frappe.local.fsm_trace = None
+    current.emit()
+
+
+@contextmanager
+def stage(name: str):
+  """
+  Records the duration and query count of a stage of the current trace. Does nothing if no trace is running
+  :param name: The name of the stage
+  :return:
+  """
+  current = get_current_trace()
+  if not current:
+    yield
+    return
+
+  start, queries = time.perf_counter(), current.queries
+  try:
+    yield
+  finally:
+    current.add_stage(name, (time.perf_counter() - start) * 1000, current.queries - queries)
+
+
+def log_sink(data: frappe._dict):
+  frappe.logger('frappe_state_management').info(frappe.as_json(data, indent=None))
+
+
+def cache_sink(data: frappe._dict):
+  """
+  Aggregates the stage durations and query counts in the cache, read back through `get_metrics`
+  :param data: The trace
+  :return:
+  """
+  cache = frappe.cache()
+  key = cache.make_key(metrics_key)
+  stages = dict(data.stages, total=frappe._dict(duration_ms=data.duration_ms, queries=data.queries, calls=1))
+  for name, values in stages.items():
+    prefix = '{}|{}'.format(data.trace, name)
+    cache.hincrbyfloat(key, prefix + '|duration_ms', values.duration_ms)
+    cache.hincrby(key, prefix + '|queries', values.queries)
+    cache.hincrby(key, prefix + '|calls', values.calls)
+
+
+def get_metrics() -> dict:
+  """
+  The metrics aggregated by `cache_sink`
+  :return: {trace: {stage: {duration_ms, queries, calls}}}
+  """
+  cache = frappe.cache()
+  metrics = {}
+  for field, value in (cache.hgetall(cache.make_key(metrics_key)) or {}).items():
+    trace_name, stage_name, metric = frappe.safe_decode(field).split('|')
+    metrics.setdefault(trace_name, {}).setdefault(stage_name, {})[metric] = flt(frappe.safe_decode(value))
+  return metrics
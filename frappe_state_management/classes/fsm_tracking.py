@@ -0,0 +1,97 @@
+class TrackedTable(list):
+  """
+  Child table of a document being tracked.
+  The rows are copied the first time the table is used, so untouched tables cost nothing
+  """
+
+  def __init__(self, doc, fieldname: str, rows: list):
+    super().__init__(rows)
+    self.doc = doc
+    self.fieldname = fieldname
+    # An empty table may be replaced on `append`, record it right away
+    if not rows:
+      self.touch()
+
+  def touch(self):
+    self.doc.track_table(self.fieldname)
+
+  def __iter__(self):
+    self.touch()
+    return super().__iter__()
+
+  def __getitem__(self, item):
+    self.touch()
+    return super().__getitem__(item)
+
+  def __setitem__(self, key, value):
+    self.touch()
+    super().__setitem__(key, value)
+
+  def __delitem__(self, key):
+    self.touch()
+    super().__delitem__(key)
+
+  def __iadd__(self, other):
+    self.touch()
+    return super().__iadd__(other)
+
+  def append(self, value):
+    self.touch()
+    super().append(value)
+
+  def extend(self, values):
+    self.touch()
+    super().extend(values)
+
+  def insert(self, index, value):
+    self.touch()
+    super().insert(index, value)
+
+  def remove(self, value):
+    self.touch()
+    super().remove(value)
+
+  def pop(self, *args):
+    self.touch()
+    return super().pop(*args)
+
+  def clear(self):
+    self.touch()
+    super().clear()
+
+  def sort(self, *args, **kwargs):
+    self.touch()
+    super().sort(*args, **kwargs)
+
+  def reverse(self):
+    self.touch()
+    super().reverse()
+
+
+class FSMSnapshot(object):
+  """
+  Read-only view of a document before the Update Request, backed by the original values recorded while tracking.
+  Values that were not changed are read from the document itself
+  """
+
+  def __init__(self, doc):
+    self.__dict__['_doc'] = doc
+
+  def __getattr__(self, key):
+    return self._doc.get_original_value(key)
+
+  def __setattr__(self, key, value):
+    raise AttributeError('The snapshot of the document is read-only')
+
+  def get(self, key, default=None):
+    value = self._doc.get_original_value(key)
+    return default if value is None else value
+
+  def as_dict(self) -> dict:
+    """
+    The whole document before the Update Request. Costs as much as `Document.as_dict`
+    :return:
+    """
+    doc = self._doc.as_dict()
+    doc.update(self._doc.get_original_values())
+    return doc
@@ -0,0 +1,55 @@
+import frappe
+from frappe.utils import cstr
+from frappe_state_management.classes.fsm_error import InvalidFieldTransitionError
+
+# Source state matching every value of the field
+any_state = '*'
+
+
+class TransitionGraph(object):
+  """
+  Allowed transitions of the fields of a doctype, compiled into an adjacency lookup {field: {from: {to}}}.
+  Values are compared as strings so Check and Docstatus values can be declared either as int or str.
+  Fields without declared transitions accept any value
+  """
+
+  def __init__(self, declarations: dict):
+    self.edges = {}
+    for field, states in (declarations or {}).items():
+      edges = self.edges[field] = {}
+      for from_state, to_states in (states or {}).items():
+        if not isinstance(to_states, (list, tuple, set)):
+          to_states = [to_states]
+        edges.setdefault(cstr(from_state), set()).update(cstr(x) for x in to_states)
+
+  def has_field(self, field: str) -> bool:
+    return field in self.edges
+
+  def is_allowed(self, field: str, from_value, to_value) -> bool:
+    edges = self.edges.get(field)
+    from_value, to_value = cstr(from_value), cstr(to_value)
+    if edges is None or from_value == to_value:
+      return True
+    return to_value in edges.get(from_value, ()) or to_value in edges.get(any_state, ())
+
+  def validate(self, field: str, from_value, to_value):
+    if not self.is_allowed(field, from_value, to_value):
+      raise InvalidFieldTransitionError(field)
+
+  def as_dict(self) -> dict:
+    return {field: {from_state: sorted(to_states) for from_state, to_states in edges.items()}
+            for field, edges in self.edges.items()}
+
+
+def compile_transitions(doctype: str, controller) -> TransitionGraph:
+  """
+  Merges the `fsm_transitions` attribute of the controller with the `fsm_transitions` hook of the doctype,
+  the hook taking precedence per field. Both are declared as {field: {from: [to, ...]}}, for example
+    fsm_transitions = {"Order": {"status": {"Ordered": ["Shipped", "Cancelled"], "Shipped": ["Delivered"]}}}
+  :param doctype: The doctype
+  :param controller: The doctype's controller class
+  :return:
+  """
+  declarations = dict(getattr(controller, 'fsm_transitions', None) or {})
+  declarations.update(frappe.get_hooks('fsm_transitions', {}).get(doctype, {}))
+  return TransitionGraph(declarations)
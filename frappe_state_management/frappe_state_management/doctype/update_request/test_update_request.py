@@ -3,8 +3,989 @@
 # See license.txt
 from __future__ import unicode_literals
 
-# import frappe
+import time
 import unittest
+from unittest.mock import patch
 
-class TestUpdateRequest(unittest.TestCase):
-	pass
+import frappe
+from frappe.utils import add_to_date, now_datetime
+from frappe_state_management.api import update_request as api
+from frappe_state_management.benchmarks import fixtures
+from frappe_state_management.benchmarks.fixtures import FSMBenchDocument, bench_dt
+from frappe_state_management.classes import fsm_concurrency, fsm_dispatch, fsm_inbox, fsm_queue, fsm_retry, \
+  fsm_trace
+from frappe_state_management.classes.fsm_bulk import bulk_load_documents
+from frappe_state_management.classes.fsm_data import parse_data
+from frappe_state_management.classes.fsm_error import InvalidFieldTransitionError, MethodNotDefinedError, \
+  MissingOrInvalidDataError, PendingUpdateRequestError
+from frappe_state_management.classes.fsm_revert_data import apply_revert_delta, get_revert_delta
+from frappe_state_management.frappe_state_management.doctype.update_request.update_request import UpdateRequest, \
+  clear_expired_idempotency_keys
+
+try:
+  from frappe.tests.utils import FrappeTestCase
+except ImportError:
+  FrappeTestCase = unittest.TestCase
+
+
+def set_title_from_hook(doc):
+  # Handler declared through the `fsm_fields` hook in `TestDispatch`
+  doc.title = 'From hook'
+  return doc.standard_revert_data()
+
+
+# Traces sent to `record_trace` through the `fsm_trace_sinks` hook in `TestTrace`
+recorded_traces = []
+
+
+def record_trace(data):
+  recorded_traces.append(data)
+
+
+class UpdateRequestTestCase(FrappeTestCase):
+  """
+  Runs against the benchmark doctypes, every test is rolled back
+  """
+
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    frappe.set_user('Administrator')
+    fixtures.setup()
+
+  @classmethod
+  def tearDownClass(cls):
+    fixtures.teardown()
+    super().tearDownClass()
+
+  def setUp(self):
+    fsm_dispatch.clear_registry()
+    self.conf = patch.dict(frappe.local.conf, {})
+    self.conf.start()
+
+  def tearDown(self):
+    self.conf.stop()
+    fsm_dispatch.clear_registry()
+    frappe.db.rollback()
+
+  def submit(self, doc, docfield, type, data=None, **values):
+    update_request = fixtures.make_update_request(doc, docfield, type, data, **values)
+    update_request.insert(ignore_permissions=True)
+    update_request.submit()
+    return update_request
+
+  @staticmethod
+  def request(doc, docfield, type, data=None, **values) -> dict:
+    """
+    An Update Request as passed to the API
+    :return:
+    """
+    return dict({'request_type': 'Update', 'dt': bench_dt, 'docname': doc.name, 'docfield': docfield, 'type': type,
+                 'data': frappe.as_json(data) if data is not None else None, 'party_type': fixtures.party_type},
+                **values)
+
+  def patch_controller(self, name: str, value):
+    """
+    Replaces an attribute of the benchmark controller until the end of the test
+    """
+    patcher = patch.object(FSMBenchDocument, name, value, create=True)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.addCleanup(fsm_dispatch.clear_registry)
+    fsm_dispatch.clear_registry()
+
+  def patch_hooks(self, **hooks):
+    """
+    Overrides hooks until the end of the test
+    """
+    get_hooks = frappe.get_hooks
+
+    def patched(hook=None, default=None, *args, **kwargs):
+      if hook in hooks:
+        return hooks[hook]
+      return get_hooks(hook, default, *args, **kwargs)
+
+    patcher = patch('frappe.get_hooks', patched)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    fsm_dispatch.clear_registry()
+
+  def require_approval(self):
+    """
+    Requests on `approved` go Pending Approval when submitted and set the value once approved
+    """
+    def approved(target):
+      if target.is_pending():
+        target.set_as_pending_approval(fixtures.party_type)
+        return None
+      return target.set_from_data('approved')
+
+    self.patch_controller('_approved', approved)
+
+  def submit_for_approval(self, doc):
+    update_request = self.submit(doc, 'approved', 'Check', {'value': 1})
+    self.assertEqual(update_request.status, 'Pending Approval', update_request.error)
+    return update_request
+
+  @staticmethod
+  def get_status(update_request) -> str:
+    return frappe.db.get_value('Update Request', update_request.name, 'status')
+
+
+class TestApplyBulk(UpdateRequestTestCase):
+
+  def test_apply_bulk_groups_by_document_and_isolates_failures(self):
+    first, second = fixtures.make_document(0), fixtures.make_document(0)
+    title = FSMBenchDocument._title
+
+    def failing_title(target):
+      if target.parse_data().get('value') == 'Boom':
+        # A write of the failing handler, rolled back with it
+        frappe.get_doc({'doctype': 'ToDo', 'description': 'fsm-test-boom'}).insert(ignore_permissions=True)
+        frappe.throw('Boom')
+      return title(target)
+
+    self.patch_controller('_title', failing_title)
+    with patch('frappe_state_management.api.update_request.load_target', wraps=api.load_target) as load_target:
+      results = api.apply_bulk([
+        self.request(first, 'title', 'Field', {'value': 'First'}),
+        self.request(second, 'title', 'Field', {'value': 'Second'}),
+        self.request(first, 'title', 'Field', {'value': 'Boom'}),
+        self.request(first, 'status', 'Select', {'value': 'Closed'}),
+      ])
+
+    self.assertEqual([x.status for x in results], ['Success', 'Success', 'Failed', 'Success'])
+    self.assertIn('Boom', results[2].error)
+    # One load per target document
+    self.assertEqual(load_target.call_count, 2)
+    first.reload()
+    second.reload()
+    self.assertEqual((first.title, first.status), ('First', 'Closed'))
+    self.assertEqual(second.title, 'Second')
+    self.assertFalse(frappe.db.exists('ToDo', {'description': 'fsm-test-boom'}))
+
+  def test_apply_bulk_reports_invalid_requests(self):
+    doc = fixtures.make_document(0)
+    results = api.apply_bulk([
+      self.request(doc, 'title', 'Field', {'value': 'Valid'}),
+      self.request(doc, 'missing_field', 'Field', {'value': 'Invalid'}),
+      self.request(frappe._dict(name='missing-document'), 'title', 'Field', {'value': 'Invalid'}),
+    ])
+    self.assertEqual([x.status for x in results], ['Success', 'Failed', 'Failed'])
+    # Invalid requests are not stored
+    self.assertEqual(frappe.db.count('Update Request', {'dt': bench_dt, 'docname': doc.name}), 1)
+    self.assertEqual(frappe.db.get_value(bench_dt, doc.name, 'title'), 'Valid')
+
+
+class TestRevertData(UpdateRequestTestCase):
+
+  def test_delta_round_trip(self):
+    rows = [{'name': x, 'item': x.upper(), 'qty': i} for i, x in enumerate(('a', 'b', 'c'))]
+    before = {'title': 'Before', 'status': 'Open', 'items': rows}
+    # "b" removed, "c" modified, "d" added
+    after = {'title': 'After', 'status': 'Open',
+             'items': [rows[0], dict(rows[2], qty=10), {'name': 'd', 'item': 'D', 'qty': 3}]}
+    delta = get_revert_delta(before, after)
+    # Only the changes are stored
+    self.assertEqual(delta['fields'], {'title': 'Before'})
+    self.assertEqual(delta['tables']['items']['added'], ['d'])
+    self.assertEqual(delta['tables']['items']['modified'], {'c': {'qty': 2}})
+    self.assertEqual([x['name'] for x in delta['tables']['items']['removed']], ['b'])
+
+    doc = frappe.get_doc(dict(after, doctype=bench_dt))
+    apply_revert_delta(doc, frappe.parse_json(frappe.as_json(delta)))
+    self.assertEqual(doc.title, 'Before')
+    self.assertEqual(sorted((d.name, d.item, d.qty) for d in doc.items), [('a', 'A', 0), ('b', 'B', 1), ('c', 'C', 2)])
+    self.assertEqual(get_revert_delta(before, before), {'version': delta['version'], 'fields': {}, 'tables': {}})
+
+  def test_child_row_revert(self):
+    def items(target):
+      data = target.parse_data()
+      if target.is_child_add():
+        target.append('items', data)
+      else:
+        row = target.get_child_row_index()[data['name']]
+        target.track_row('items', row)
+        row.update(data)
+      return target.standard_revert_data()
+
+    self.patch_controller('_items', items)
+    doc = fixtures.make_document(2)
+    names = [d.name for d in doc.items]
+    self.submit(doc, 'items', 'Update Child Row', {'name': names[1], 'qty': 7})
+    update_request = self.submit(doc, 'items', 'Add Child Row', {'item': 'Added', 'qty': 9})
+    doc.reload()
+    self.assertEqual([(d.item, d.qty) for d in doc.items], [('Item 0', 0), ('Item 1', 7), ('Added', 9)])
+
+    update_request.reload()
+    update_request.revert()
+    doc.reload()
+    self.assertEqual([(d.name, d.qty) for d in doc.items], [(names[0], 0), (names[1], 7)])
+
+
+class TestPendingGuard(UpdateRequestTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.require_approval()
+
+  def test_pending_key_race(self):
+    doc = fixtures.make_document(0)
+    pending = self.submit_for_approval(doc)
+    self.assertEqual(frappe.db.get_value('Update Request', pending.name, 'pending_key'),
+                     '{}::{}'.format(bench_dt, doc.name))
+    self.assertRaises(PendingUpdateRequestError, self.submit, doc, 'title', 'Field', {'value': 'Second'})
+
+    # A request that passed the check before the document was claimed fails on the unique pending key
+    with patch.object(UpdateRequest, 'validate'):
+      self.assertRaises(PendingUpdateRequestError, self.submit, doc, 'title', 'Field', {'value': 'Raced'})
+
+  def test_processed_request_releases_the_document(self):
+    doc = fixtures.make_document(0)
+    update_request = self.submit(doc, 'title', 'Field', {'value': 'First'})
+    self.assertIsNone(frappe.db.get_value('Update Request', update_request.name, 'pending_key'))
+    self.assertEqual(self.submit(doc, 'title', 'Field', {'value': 'Second'}).status, 'Success')
+
+
+class TestDispatch(UpdateRequestTestCase):
+
+  def test_handlers_are_resolved_once(self):
+    table = fsm_dispatch.get_dispatch_table(bench_dt)
+    handler = fsm_dispatch.get_handler(bench_dt, 'title')
+    self.assertIs(handler.fn, FSMBenchDocument._title)
+    self.assertIs(fsm_dispatch.get_dispatch_table(bench_dt), table)
+    self.assertIs(fsm_dispatch.get_handler(bench_dt, 'title'), handler)
+
+    # Rebuilt when the cache is cleared or the controller is reloaded
+    fsm_dispatch.clear_registry()
+    self.assertIsNot(fsm_dispatch.get_dispatch_table(bench_dt), table)
+    table = fsm_dispatch.get_dispatch_table(bench_dt)
+    reloaded = type('FSMBenchDocument', (FSMBenchDocument,), {})
+    with patch.dict(frappe.controllers[frappe.local.site], {bench_dt: reloaded}):
+      self.assertIs(fsm_dispatch.get_dispatch_table(bench_dt).controller, reloaded)
+
+  def test_hook_takes_precedence(self):
+    self.patch_hooks(fsm_fields={bench_dt: {'title': [__name__ + '.set_title_from_hook']}})
+    doc = fixtures.make_document(0)
+    self.assertEqual(self.submit(doc, 'title', 'Field', {'value': 'Ignored'}).status, 'Success')
+    self.assertEqual(frappe.db.get_value(bench_dt, doc.name, 'title'), 'From hook')
+
+  def test_failed_resolution_is_logged_and_not_memoized(self):
+    with patch('frappe.log_error') as log_error:
+      self.assertIsNone(fsm_dispatch.get_handler(bench_dt, custom_call=__name__ + '.missing_handler'))
+    log_error.assert_called_once()
+    table = fsm_dispatch.get_dispatch_table(bench_dt)
+    self.assertIsNone(table.get('approved_on'))
+
+    # Deployed after the first lookup
+    with patch.object(FSMBenchDocument, '_approved_on', lambda doc: doc.standard_revert_data(), create=True):
+      self.assertIsNotNone(table.get('approved_on'))
+
+  def test_errors_raised_by_the_handler_module_are_not_swallowed(self):
+    with patch('frappe.get_attr', side_effect=ZeroDivisionError):
+      self.assertRaises(ZeroDivisionError, fsm_dispatch.get_handler, bench_dt, custom_call='any.module.handler')
+
+
+class TestData(UpdateRequestTestCase):
+
+  def test_parse_data(self):
+    self.assertEqual(parse_data('{"value": 1}'), {'value': 1})
+    # Double encoded
+    self.assertEqual(parse_data(frappe.as_json('{"value": 1}')), {'value': 1})
+    self.assertEqual(parse_data('[{"name": "a"}, {"name": "b"}]'), [{'name': 'a'}, {'name': 'b'}])
+    self.assertEqual(parse_data({'value': 1}).value, 1)
+    # Python literals written by older versions, rejected in strict mode
+    self.assertEqual(parse_data("{'value': True}"), {'value': True})
+    self.assertRaises(MissingOrInvalidDataError, parse_data, "{'value': True}", strict=True)
+    for data in (None, '', 'not a payload', '1', '[1, 2]'):
+      self.assertRaises(MissingOrInvalidDataError, parse_data, data)
+
+  def test_data_is_parsed_once(self):
+    update_request = fixtures.make_update_request(fixtures.make_document(0), 'title', 'Field', {'value': 'Parsed'})
+    with patch('frappe_state_management.frappe_state_management.doctype.update_request.update_request.parse_data',
+               wraps=parse_data) as parse:
+      update_request.insert(ignore_permissions=True)
+      update_request.submit()
+    self.assertEqual(update_request.status, 'Success', update_request.error)
+    self.assertEqual(parse.call_count, 1)
+
+    # Parsed again when the payload changes
+    update_request.data = frappe.as_json({'value': 'Changed'})
+    self.assertEqual(update_request.get_data().value, 'Changed')
+
+  def test_strict_data(self):
+    doc = fixtures.make_document(0)
+
+    def submit_literal():
+      update_request = fixtures.make_update_request(doc, 'title', 'Field')
+      update_request.data = "{'value': 'Literal'}"
+      update_request.insert(ignore_permissions=True)
+      update_request.submit()
+      return update_request
+
+    self.assertEqual(submit_literal().status, 'Success')
+    frappe.local.conf.fsm_strict_data = 1
+    self.assertRaises(frappe.ValidationError, submit_literal)
+    self.assertEqual(self.submit(doc, 'title', 'Field', {'value': 'Json'}).status, 'Success')
+
+
+class TestChildRows(UpdateRequestTestCase):
+
+  def test_delete_child_rows_revert_restores_the_order(self):
+    doc = fixtures.make_document(3)
+    names = [d.name for d in doc.items]
+    update_request = self.submit(doc, 'items', 'Delete Child Rows', [{'name': names[0]}, {'name': names[2]}])
+    self.assertEqual(update_request.status, 'Success', update_request.error)
+    doc.reload()
+    self.assertEqual([(d.name, d.idx) for d in doc.items], [(names[1], 1)])
+
+    update_request.reload()
+    update_request.revert()
+    doc.reload()
+    self.assertEqual([(d.name, d.idx) for d in doc.items], [(names[0], 1), (names[1], 2), (names[2], 3)])
+
+  def test_add_and_update_child_rows_revert(self):
+    doc = fixtures.make_document(2)
+    names = [d.name for d in doc.items]
+    self.submit(doc, 'items', 'Update Child Rows', [{'name': names[0], 'qty': 5}, {'name': names[1], 'qty': 7}])
+    update_request = self.submit(doc, 'items', 'Add Child Rows', [{'item': 'Added', 'qty': 9}, {'item': 'More'}])
+    self.assertEqual(len(update_request.revert_items), 1)
+    doc.reload()
+    self.assertEqual([(d.item, d.qty) for d in doc.items], [('Item 0', 5), ('Item 1', 7), ('Added', 9), ('More', 0)])
+
+    update_request.reload()
+    update_request.revert()
+    doc.reload()
+    self.assertEqual([(d.name, d.qty) for d in doc.items], [(names[0], 5), (names[1], 7)])
+
+  def test_update_child_rows_revert_keeps_the_order(self):
+    doc = fixtures.make_document(3)
+    names = [d.name for d in doc.items]
+    update_request = self.submit(doc, 'items', 'Update Child Rows', [{'name': names[2], 'qty': 9}])
+    update_request.reload()
+    update_request.revert()
+    doc.reload()
+    self.assertEqual([(d.name, d.qty, d.idx) for d in doc.items],
+                     [(names[0], 0, 1), (names[1], 1, 2), (names[2], 2, 3)])
+
+  def test_missing_rows_are_rejected(self):
+    doc = fixtures.make_document(1)
+    self.assertRaises(MissingOrInvalidDataError, self.submit, doc, 'items', 'Update Child Rows',
+                      [{'name': doc.items[0].name}, {'name': 'missing'}])
+    self.assertRaises(MissingOrInvalidDataError, self.submit, doc, 'items', 'Delete Child Rows', [])
+
+  def test_delta_keeps_the_row_order(self):
+    rows = [{'name': x, 'qty': i} for i, x in enumerate(('a', 'b', 'c'))]
+    # Reordered only
+    delta = get_revert_delta({'items': rows}, {'items': list(reversed(rows))})
+    self.assertEqual(delta['tables']['items']['order'], ['a', 'b', 'c'])
+
+    doc = frappe.get_doc({'doctype': bench_dt, 'items': list(reversed(rows))})
+    apply_revert_delta(doc, delta)
+    self.assertEqual([(d.name, d.idx) for d in doc.items], [('a', 1), ('b', 2), ('c', 3)])
+
+
+class TestQueue(UpdateRequestTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.patch_hooks(fsm_queued_doctypes=[bench_dt])
+
+  def test_queued_requests_are_applied_by_the_job(self):
+    doc = fixtures.make_document(0)
+    # Jobs run right away in tests
+    update_request = self.submit(doc, 'title', 'Field', {'value': 'Queued'})
+    update_request.reload()
+    self.assertEqual((update_request.status, update_request.queued), ('Success', 0))
+    self.assertTrue(update_request.enqueued_on)
+    self.assertEqual(frappe.db.get_value(bench_dt, doc.name, 'title'), 'Queued')
+
+  def test_queue_stats(self):
+    docs = [fixtures.make_document(0) for i in range(2)]
+    with patch.object(fsm_queue, 'enqueue_document_queue') as enqueue:
+      update_requests = [self.submit(x, 'title', 'Field', {'value': 'Queued'}) for x in docs]
+    self.assertEqual(enqueue.call_count, 2)
+    frappe.db.set_value('Update Request', update_requests[0].name, 'enqueued_on',
+                        add_to_date(now_datetime(), seconds=-30), update_modified=False)
+
+    stats = [x for x in api.get_queue_stats() if x.dt == bench_dt]
+    self.assertEqual(len(stats), 1)
+    self.assertEqual(stats[0].depth, 2)
+    self.assertGreaterEqual(stats[0].lag, 30)
+
+    fsm_queue.apply_queued_update_requests(bench_dt, docs[0].name)
+    self.assertEqual(self.get_status(update_requests[0]), 'Success')
+    self.assertEqual(self.get_status(update_requests[1]), 'Pending')
+    self.assertEqual([x.depth for x in api.get_queue_stats() if x.dt == bench_dt], [1])
+
+  def test_failure_outside_the_document_releases_the_request(self):
+    doc = fixtures.make_document(0)
+    with patch.object(fsm_queue, 'enqueue_document_queue'):
+      update_request = self.submit(doc, 'title', 'Field', {'value': 'Queued'})
+    # Deleted while the request was queued
+    frappe.db.delete(bench_dt, {'name': doc.name})
+
+    with patch('frappe.log_error'):
+      fsm_queue.apply_queued_update_requests(bench_dt, doc.name)
+    update_request.reload()
+    self.assertEqual((update_request.status, update_request.queued), ('Failed', 0))
+    self.assertIn('DoesNotExistError', update_request.error)
+    self.assertIsNone(update_request.pending_key)
+
+  def test_stale_requests_are_enqueued_again(self):
+    doc = fixtures.make_document(0)
+    with patch.object(fsm_queue, 'enqueue_document_queue'):
+      update_request = self.submit(doc, 'title', 'Field', {'value': 'Queued'})
+
+    with patch.object(fsm_queue, 'enqueue_document_queue') as enqueue:
+      fsm_queue.requeue_stale_update_requests()
+      enqueue.assert_not_called()
+      update_request.db_set('enqueued_on', add_to_date(now_datetime(), hours=-1), update_modified=False)
+      fsm_queue.requeue_stale_update_requests()
+    enqueue.assert_called_once_with(bench_dt, doc.name, None)
+
+    fsm_queue.requeue_stale_update_requests()
+    self.assertEqual(self.get_status(update_request), 'Success')
+
+
+class TestRevertPlan(UpdateRequestTestCase):
+
+  def test_dry_run_plans_without_writing(self):
+    doc = fixtures.make_document(0)
+    update_requests = [self.submit(doc, x, 'Field' if x == 'title' else 'Select', {'value': value})
+                       for x, value in (('title', 'One'), ('status', 'Closed'), ('title', 'Two'))]
+    first = update_requests[0]
+    first.reload()
+
+    plan = first.revert_to(dry_run=True)
+    # The updates of the document are merged into one save
+    self.assertEqual(plan.operations, [{'operation': 'Update', 'dt': bench_dt, 'docname': doc.name, 'items': 3}])
+    self.assertEqual((plan.cost.loads, plan.cost.writes, plan.cost.queries), (1, 1, 2))
+    self.assertEqual(api.revert(update_requests[-1].name, dry_run=1).operations[0].items, 1)
+    self.assertEqual([self.get_status(x) for x in update_requests], ['Success'] * 3)
+    self.assertEqual(frappe.db.get_value(bench_dt, doc.name, ['title', 'status']), ('Two', 'Closed'))
+
+    first.revert_to()
+    self.assertEqual(frappe.db.get_value(bench_dt, doc.name, ['title', 'status']), ('Benchmark', 'Open'))
+
+  def test_documents_are_loaded_in_batch(self):
+    docs = [fixtures.make_document(2), fixtures.make_document(0)]
+    frappe.get_meta(bench_dt)
+    with patch.object(frappe.db, 'sql', wraps=frappe.db.sql) as sql:
+      loaded = bulk_load_documents(bench_dt, [x.name for x in docs] + ['missing'])
+    # One query for the documents and one for their rows
+    self.assertEqual(sql.call_count, 2)
+    self.assertEqual(set(loaded), set(x.name for x in docs))
+    first = loaded[docs[0].name]
+    self.assertIsInstance(first, FSMBenchDocument)
+    self.assertEqual([(d.name, d.idx) for d in first.items], [(d.name, d.idx) for d in docs[0].items])
+    self.assertEqual(loaded[docs[1].name].items, [])
+
+    # Saved like a document loaded with `frappe.get_doc`
+    first.title = 'Saved'
+    first.items[1].qty = 5
+    first.save()
+    docs[0].reload()
+    self.assertEqual((docs[0].title, docs[0].items[1].qty), ('Saved', 5))
+
+  def test_missing_documents_fail_the_revert(self):
+    self.patch_controller('_create_', lambda target: target.insert(ignore_permissions=True))
+    update_request = frappe.get_doc({
+      'doctype': 'Update Request', 'request_type': 'Create', 'dt': bench_dt, 'party_type': fixtures.party_type,
+      'data': frappe.as_json([{'title': 'Created 1'}, {'title': 'Created 2'}])
+    })
+    update_request.insert(ignore_permissions=True)
+    update_request.submit()
+    frappe.db.delete(bench_dt, {'name': update_request.revert_items[0].docname})
+
+    update_request.reload()
+    self.assertRaises(frappe.DoesNotExistError, update_request.revert)
+    self.assertTrue(frappe.db.exists(bench_dt, update_request.revert_items[1].docname))
+
+
+class TestTracking(UpdateRequestTestCase):
+
+  def test_tracking_and_rollback_changes(self):
+    doc = frappe.get_doc(bench_dt, fixtures.make_document(2).name)
+    names = [d.name for d in doc.items]
+    snapshot = doc.start_tracking()
+    doc.title = 'Changed'
+    doc.items[1].qty = 50
+    doc.append('items', {'item': 'Added', 'qty': 2})
+    self.assertEqual((snapshot.title, snapshot.status), ('Benchmark', 'Open'))
+    self.assertEqual([d.qty for d in snapshot.items], [0, 1])
+
+    delta = doc.get_tracked_delta()
+    # Only the changed field is compared
+    self.assertEqual(delta['fields'], {'title': 'Benchmark'})
+    self.assertEqual(delta['tables']['items']['modified'], {names[1]: {'qty': 1}})
+
+    doc.rollback_changes()
+    doc.stop_tracking()
+    self.assertEqual(doc.title, 'Benchmark')
+    self.assertEqual([(d.name, d.qty) for d in doc.items], [(names[0], 0), (names[1], 1)])
+    # Changes made once tracking stopped are not recorded
+    doc.status = 'Closed'
+    self.assertNotIn('status', doc.get_original_values())
+
+  def test_rows_tracked_one_by_one(self):
+    doc = frappe.get_doc(bench_dt, fixtures.make_document(3).name)
+    doc.start_tracking()
+    # Reading the rows without going through the table, as `get_child_row_index` does
+    row = list(list.__iter__(doc.__dict__['items']))[2]
+    doc.track_row('items', row)
+    row.qty = 20
+    self.assertNotIn('items', doc.__dict__['_tracked_tables'])
+    # Only the tracked row is compared
+    self.assertEqual(doc.get_tracked_delta()['tables']['items'], {'added': [], 'removed': [],
+                                                                  'modified': {row.name: {'qty': 2}}})
+    doc.rollback_changes()
+    self.assertEqual([d.qty for d in doc.items], [0, 1, 2])
+
+
+class TestTrace(UpdateRequestTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.patch_hooks(fsm_trace_sinks=[__name__ + '.record_trace'])
+    del recorded_traces[:]
+
+  def test_traces_are_sampled(self):
+    doc = fixtures.make_document(0)
+    update_request = self.submit(doc, 'title', 'Field', {'value': 'Untraced'})
+    self.assertEqual(recorded_traces, [])
+    self.assertFalse(frappe.db.get_value('Update Request', update_request.name, 'duration_ms'))
+
+  def test_stages_and_duration(self):
+    frappe.local.conf.fsm_trace_sample_rate = 1
+    doc = fixtures.make_document(0)
+    update_request = self.submit(doc, 'title', 'Field', {'value': 'Traced'})
+
+    traces = {x.trace: x for x in recorded_traces}
+    self.assertIn('UpdateRequest.validate', traces)
+    # The traces of FSMDocument are merged into the outermost one
+    applied = traces['UpdateRequest.apply_update_request']
+    self.assertEqual((applied.update_request, applied.dt, applied.status), (update_request.name, bench_dt, 'Success'))
+    self.assertTrue({'load_target', 'handler', 'save', 'status_write'} <= set(applied.stages))
+    self.assertGreater(applied.queries, 0)
+    self.assertGreaterEqual(applied.queries, sum(x.queries for x in applied.stages.values()))
+    self.assertGreater(frappe.db.get_value('Update Request', update_request.name, 'duration_ms'), 0)
+    # Queries are no longer counted
+    self.assertNotIn('sql', frappe.db.__dict__)
+
+  def test_cache_sink(self):
+    cache = frappe.cache()
+    cache.delete_value(fsm_trace.metrics_key)
+    self.addCleanup(cache.delete_value, fsm_trace.metrics_key)
+    data = frappe._dict(trace='fsm-test', duration_ms=3.5, queries=4,
+                        stages={'handler': frappe._dict(duration_ms=1.5, queries=1, calls=2)})
+    fsm_trace.cache_sink(data)
+    fsm_trace.cache_sink(data)
+    metrics = fsm_trace.get_metrics()['fsm-test']
+    self.assertEqual(metrics['total'], {'duration_ms': 7, 'queries': 8, 'calls': 2})
+    self.assertEqual(metrics['handler'], {'duration_ms': 3, 'queries': 2, 'calls': 4})
+
+
+class TestApproveMany(UpdateRequestTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.require_approval()
+
+  def test_approve_many_and_reject_many(self):
+    docs = [fixtures.make_document(0) for i in range(4)]
+    approved, forbidden, rejected, other = [self.submit_for_approval(x) for x in docs]
+    has_permission = frappe.has_permission
+
+    def denied(doctype, ptype='read', doc=None, *args, **kwargs):
+      if getattr(doc, 'name', doc) == forbidden.name:
+        return False
+      return has_permission(doctype, ptype, doc, *args, **kwargs)
+
+    with patch('frappe.has_permission', denied):
+      results = api.approve_many([approved.name, forbidden.name, 'missing'])
+      self.assertEqual([x.status for x in results], ['Success', 'Pending Approval', None])
+      self.assertEqual(results[1].error, 'Not permitted')
+
+      results = api.reject_many([rejected.name, forbidden.name, approved.name])
+      self.assertEqual([x.status for x in results], ['Rejected', 'Pending Approval', 'Success'])
+      self.assertEqual(results[1].error, 'Not permitted')
+
+    self.assertEqual([self.get_status(x) for x in (approved, forbidden, rejected, other)],
+                     ['Success', 'Pending Approval', 'Rejected', 'Pending Approval'])
+    self.assertEqual(frappe.db.get_value(bench_dt, docs[0].name, 'approved'), 1)
+    self.assertEqual(frappe.db.get_value(bench_dt, docs[2].name, 'approved'), 0)
+    # The rejected request released its document
+    self.assertEqual(self.submit(docs[2], 'title', 'Field', {'value': 'Free'}).status, 'Success')
+
+
+class TestInbox(UpdateRequestTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.require_approval()
+
+  def test_inbox_cursor(self):
+    update_requests = [self.submit_for_approval(fixtures.make_document(0)) for i in range(3)]
+    names = []
+    cursor, pages = None, 0
+    while True:
+      inbox = fsm_inbox.get_inbox(fixtures.party_type, limit=2, cursor=cursor, dt=bench_dt)
+      names.extend(x.name for x in inbox['items'])
+      pages += 1
+      cursor = inbox.next_cursor
+      if not cursor:
+        break
+
+    self.assertEqual(names, [x.name for x in update_requests])
+    self.assertEqual(pages, 2)
+    self.assertEqual(inbox.counts.get(bench_dt), 3)
+
+    api.reject(update_requests[0].name)
+    inbox = fsm_inbox.get_inbox(fixtures.party_type, dt=bench_dt, group_by_dt=True)
+    self.assertEqual(inbox.groups[0]['count'], 2)
+    self.assertEqual([x.name for x in inbox.groups[0]['items']], names[1:])
+
+
+class TestTransitions(UpdateRequestTestCase):
+
+  def test_illegal_transitions(self):
+    self.patch_controller('fsm_transitions', {'status': {'Open': ['Closed']}})
+    doc = fixtures.make_document(0)
+    self.assertEqual(self.submit(doc, 'status', 'Select', {'value': 'Closed'}).status, 'Success')
+    # Rejected when inserted, from the value in the database
+    self.assertRaises(InvalidFieldTransitionError, self.submit, doc, 'status', 'Select', {'value': 'Open'})
+
+    # Rejected after the handler ran when an earlier request of the batch changed the value
+    other = fixtures.make_document(0)
+    results = api.apply_bulk([
+      self.request(other, 'status', 'Select', {'value': 'Closed'}),
+      self.request(other, 'status', 'Select', {'value': 'Open'}),
+    ])
+    self.assertEqual([x.status for x in results], ['Success', 'Failed'])
+    self.assertIn('InvalidFieldTransitionError', results[1].error)
+    self.assertEqual(frappe.db.get_value(bench_dt, other.name, 'status'), 'Closed')
+
+  def test_hook_declarations(self):
+    self.patch_hooks(fsm_transitions={bench_dt: {'status': {'Open': []}}})
+    doc = fixtures.make_document(0)
+    self.assertRaises(InvalidFieldTransitionError, self.submit, doc, 'status', 'Select', {'value': 'Closed'})
+    self.assertEqual(api.get_transition_graph(bench_dt), {'status': {'Open': []}})
+
+
+class TestValidate(UpdateRequestTestCase):
+
+  def test_validate_does_not_load_the_target(self):
+    doc = fixtures.make_document(2)
+    get_doc = frappe.get_doc
+    with patch('frappe.get_doc', side_effect=get_doc) as loads:
+      update_request = fixtures.make_update_request(doc, 'title', 'Field', {'value': 'Validated'})
+      update_request.insert(ignore_permissions=True)
+    self.assertFalse([x for x in loads.call_args_list if x.args[:1] == (bench_dt,)])
+
+  def test_validate_rejects_invalid_requests(self):
+    doc = fixtures.make_document(0)
+    self.assertRaises(frappe.DoesNotExistError, self.submit, frappe._dict(name='missing'), 'title', 'Field',
+                      {'value': 'Missing'})
+    self.assertRaises(MethodNotDefinedError, self.submit, doc, 'undefined', 'Field', {'value': 'Undefined'})
+    self.assertRaises(frappe.ValidationError, self.submit, doc, 'title', None, {'value': 'No type'})
+
+
+class TestIdempotency(UpdateRequestTestCase):
+
+  def test_resubmission_with_the_same_idempotency_key(self):
+    doc = fixtures.make_document(0)
+    request = self.request(doc, 'title', 'Field', {'value': 'Once'}, idempotency_key='fsm-test-key')
+    result = api.submit_update_request(request)
+    self.assertEqual(result.status, 'Success', result.error)
+
+    self.assertEqual(api.submit_update_request(request).name, result.name)
+    self.assertEqual(api.apply_bulk([request, request])[1].name, result.name)
+    self.assertEqual(frappe.db.count('Update Request', {'dt': bench_dt, 'docname': doc.name}), 1)
+    # Keys are scoped to the target document
+    other = fixtures.make_document(0)
+    self.assertNotEqual(api.submit_update_request(dict(request, docname=other.name)).name, result.name)
+
+  def test_expired_keys_are_released(self):
+    doc = fixtures.make_document(0)
+    request = self.request(doc, 'title', 'Field', {'value': 'Once'}, idempotency_key='fsm-test-key')
+    result = api.submit_update_request(request)
+    frappe.db.set_value('Update Request', result.name, 'creation', add_to_date(now_datetime(), hours=-25),
+                        update_modified=False)
+    with patch.object(frappe.db, 'commit'):
+      clear_expired_idempotency_keys()
+
+    self.assertEqual(frappe.db.get_value('Update Request', result.name, 'idempotency_key'), 'fsm-test-key')
+    self.assertNotEqual(api.submit_update_request(request).name, result.name)
+
+
+class TestFifo(UpdateRequestTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.require_approval()
+    self.patch_hooks(fsm_fifo_doctypes=[bench_dt])
+
+  def test_fifo_waits_and_drains(self):
+    doc = fixtures.make_document(0)
+    pending = self.submit_for_approval(doc)
+    waiting = self.submit(doc, 'title', 'Field', {'value': 'Queued'})
+    self.assertEqual((waiting.status, waiting.waiting), ('Pending', 1))
+    self.assertEqual(waiting.get_queue_position(), 1)
+
+    # Lost the race for the claim, stored as waiting instead of failing
+    with patch.object(UpdateRequest, 'validate'):
+      raced = self.submit(doc, 'status', 'Select', {'value': 'Closed'})
+    self.assertEqual((raced.waiting, raced.pending_key), (1, None))
+
+    api.approve(pending.name)
+    self.assertEqual(self.get_status(pending), 'Success')
+    self.assertEqual([self.get_status(x) for x in (waiting, raced)], ['Success', 'Success'])
+    self.assertFalse(frappe.db.exists('Update Request', {'dt': bench_dt, 'docname': doc.name, 'waiting': 1}))
+    doc.reload()
+    self.assertEqual((doc.approved, doc.title, doc.status), (1, 'Queued', 'Closed'))
+
+  def test_apply_bulk_waits_behind_approval(self):
+    doc = fixtures.make_document(0)
+    results = api.apply_bulk([
+      self.request(doc, 'title', 'Field', {'value': 'Before'}),
+      self.request(doc, 'approved', 'Check', {'value': 1}),
+      self.request(doc, 'title', 'Field', {'value': 'After'}),
+    ])
+    self.assertEqual([x.status for x in results], ['Success', 'Pending Approval', 'Pending'])
+    self.assertEqual(frappe.db.get_value('Update Request', results[2].name, ['waiting', 'pending_key']), (1, None))
+
+    api.approve(results[1].name)
+    self.assertEqual(self.get_status(results[2]), 'Success')
+    doc.reload()
+    self.assertEqual((doc.approved, doc.title), (1, 'After'))
+
+
+class TestCreate(UpdateRequestTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.patch_controller('_create_', lambda target: target.insert(ignore_permissions=True))
+
+  def test_bulk_create_partial_failure_and_revert(self):
+    update_request = frappe.get_doc({
+      'doctype': 'Update Request', 'request_type': 'Create', 'dt': bench_dt, 'party_type': fixtures.party_type,
+      'data': frappe.as_json([{'title': 'Created 1', 'status': 'Open'}, {'title': 'Invalid', 'status': 'Bogus'},
+                              {'title': 'Created 3', 'status': 'Open'}])
+    })
+    update_request.insert(ignore_permissions=True)
+    update_request.submit()
+
+    self.assertEqual(update_request.status, 'Success', update_request.error)
+    self.assertEqual((update_request.created_count, update_request.failed_count), (2, 1))
+    self.assertIn('Row 2:', update_request.error)
+    created = [x.docname for x in update_request.revert_items]
+    self.assertEqual(frappe.get_all(bench_dt, filters={'name': ['in', created]}, pluck='title', order_by='title'),
+                     ['Created 1', 'Created 3'])
+    self.assertFalse(frappe.db.exists(bench_dt, {'title': 'Invalid'}))
+
+    update_request.reload()
+    update_request.revert()
+    self.assertEqual(self.get_status(update_request), 'Reverted')
+    self.assertFalse(frappe.get_all(bench_dt, filters={'name': ['in', created]}))
+
+  def test_custom_call_must_insert_the_document(self):
+    update_request = frappe.get_doc({
+      'doctype': 'Update Request', 'request_type': 'Create', 'dt': bench_dt, 'party_type': fixtures.party_type,
+      'custom_call': 'frappe.get_doc', 'data': frappe.as_json([{'doctype': bench_dt, 'title': 'Not inserted'}])
+    })
+    update_request.insert(ignore_permissions=True)
+    update_request.submit()
+    self.assertEqual(update_request.status, 'Failed')
+    self.assertEqual(update_request.created_count, 0)
+    self.assertIn('Document was not inserted', update_request.error)
+
+
+
+class TestConcurrency(UpdateRequestTestCase):
+
+  def test_optimistic_retry_recovers_a_conflicting_write(self):
+    frappe.local.conf.fsm_concurrency_mode = 'optimistic'
+    doc = fixtures.make_document(2)
+    # The other connection only sees committed documents
+    frappe.db.commit()
+    self.addCleanup(self.delete_committed, doc)
+    title = FSMBenchDocument._title
+    calls = []
+
+    def concurrent_title(target):
+      # Another transaction commits a change between the load and the save of the first attempt
+      if not calls:
+        other = frappe.database.get_db()
+        try:
+          other.sql("UPDATE `tab{}` SET status = 'Closed', modified = %s WHERE name = %s".format(bench_dt),
+                    (now_datetime(), target.name))
+          other.commit()
+        finally:
+          other.close()
+      calls.append(target.name)
+      return title(target)
+
+    with patch.object(FSMBenchDocument, '_title', concurrent_title):
+      update_request = self.submit(doc, 'title', 'Field', {'value': 'Retried'})
+
+    self.assertEqual(update_request.status, 'Success', update_request.error)
+    self.assertEqual(len(calls), 2)
+    doc.reload()
+    self.assertEqual(doc.title, 'Retried')
+    # The concurrent change is kept
+    self.assertEqual(doc.status, 'Closed')
+
+  @staticmethod
+  def delete_committed(doc):
+    frappe.db.rollback()
+    frappe.db.sql("DELETE FROM `tab{}` WHERE parent = %s".format(fixtures.bench_item_dt), doc.name)
+    frappe.db.sql("DELETE FROM `tab{}` WHERE name = %s".format(bench_dt), doc.name)
+    frappe.db.commit()
+
+  def test_optimistic_retry_gives_up_after_the_limit(self):
+    frappe.local.conf.fsm_concurrency_mode = 'optimistic'
+    frappe.local.conf.fsm_optimistic_retries = 0
+    frappe.local.conf.fsm_retry_max_attempts = 1
+    doc = fixtures.make_document(0)
+    title = FSMBenchDocument._title
+
+    def concurrent_title(target):
+      frappe.db.sql("UPDATE `tab{}` SET modified = %s WHERE name = %s".format(bench_dt),
+                    (now_datetime(), target.name))
+      return title(target)
+
+    with patch.object(FSMBenchDocument, '_title', concurrent_title):
+      update_request = self.submit(doc, 'title', 'Field', {'value': 'Lost'})
+
+    self.assertEqual(update_request.status, 'Failed')
+    self.assertIn('TimestampMismatchError', update_request.error)
+
+  def test_lock_waits_exclude_the_document_load(self):
+    doc = fixtures.make_document(2)
+    get_doc = frappe.get_doc
+
+    def slow_get_doc(*args, **kwargs):
+      time.sleep(fsm_concurrency.lock_wait_threshold_ms * 2 / 1000)
+      return get_doc(*args, **kwargs)
+
+    with patch('frappe.get_doc', slow_get_doc), patch.object(fsm_concurrency, 'record_contention') as record:
+      target = fsm_concurrency.load_target(bench_dt, doc.name)
+    self.assertEqual((target.name, len(target.items)), (doc.name, 2))
+    self.assertFalse(record.called)
+    self.assertRaises(frappe.DoesNotExistError, fsm_concurrency.load_target, bench_dt, 'missing')
+
+
+class TestRetry(UpdateRequestTestCase):
+
+  def test_retry_classifier(self):
+    self.assertTrue(fsm_retry.is_transient(frappe.TimestampMismatchError()))
+    self.assertTrue(fsm_retry.is_transient(self.deadlock()))
+    self.assertTrue(fsm_retry.is_deadlock(self.deadlock()))
+    self.assertFalse(fsm_retry.is_deadlock(frappe.TimestampMismatchError()))
+    self.assertFalse(fsm_retry.is_transient(frappe.ValidationError()))
+    self.assertFalse(fsm_retry.is_transient(PendingUpdateRequestError()))
+
+  def test_schedule_retry_backs_off(self):
+    frappe.local.conf.update(fsm_retry_max_attempts=3, fsm_retry_base_delay=10)
+    update_request = frappe._dict(retry_count=0, revert_items=[])
+    start = now_datetime()
+    self.assertTrue(fsm_retry.schedule_retry(update_request, frappe.TimestampMismatchError()))
+    self.assertEqual(update_request.retry_count, 1)
+    self.assertTrue(add_to_date(start, seconds=5) <= update_request.next_attempt_on <= add_to_date(now_datetime(),
+                                                                                                    seconds=10))
+    self.assertTrue(fsm_retry.schedule_retry(update_request, frappe.TimestampMismatchError()))
+    self.assertTrue(add_to_date(start, seconds=10) <= update_request.next_attempt_on)
+    # The attempts are used up
+    self.assertFalse(fsm_retry.schedule_retry(update_request, frappe.TimestampMismatchError()))
+    self.assertEqual(update_request.retry_count, 2)
+    self.assertFalse(fsm_retry.schedule_retry(frappe._dict(retry_count=0), frappe.ValidationError()))
+
+  def test_transient_failure_is_rolled_back_and_retried(self):
+    doc = fixtures.make_document(0)
+    title = FSMBenchDocument._title
+
+    def deadlocked_title(target):
+      frappe.get_doc({'doctype': 'ToDo', 'description': 'fsm-test-retry'}).insert(ignore_permissions=True)
+      raise frappe.TimestampMismatchError
+
+    self.patch_controller('_title', deadlocked_title)
+    update_request = self.submit(doc, 'title', 'Field', {'value': 'Retried'})
+    self.assertEqual((update_request.status, update_request.retry_count), ('Pending', 1))
+    self.assertTrue(update_request.next_attempt_on)
+    self.assertFalse(frappe.db.exists('ToDo', {'description': 'fsm-test-retry'}))
+    # The document stays claimed until the retry
+    self.assertRaises(PendingUpdateRequestError, self.submit, doc, 'status', 'Select', {'value': 'Closed'})
+
+    self.patch_controller('_title', title)
+    update_request.db_set('next_attempt_on', add_to_date(now_datetime(), seconds=-1), update_modified=False)
+    # The worker commits every request
+    with patch.object(frappe.db, 'commit'):
+      fsm_retry.retry_update_requests()
+    self.assertEqual(self.get_status(update_request), 'Success')
+    doc.reload()
+    self.assertEqual(doc.title, 'Retried')
+
+  @staticmethod
+  def deadlock():
+    exc = getattr(frappe, 'QueryDeadlockError', None)
+    if exc:
+      return exc('Deadlock found when trying to get lock')
+    import pymysql
+    return pymysql.err.OperationalError(1213, 'Deadlock found when trying to get lock')
+
+  def test_deadlock_on_submit_is_raised(self):
+    doc = fixtures.make_document(0)
+    deadlock = self.deadlock()
+
+    def deadlocked_title(target):
+      # The database rolls back the whole transaction
+      frappe.db.rollback()
+      raise deadlock
+
+    self.patch_controller('_title', deadlocked_title)
+    update_request = fixtures.make_update_request(doc, 'title', 'Field', {'value': 'Deadlocked'})
+    update_request.insert(ignore_permissions=True)
+    self.assertRaises(type(deadlock), update_request.submit)
+    self.assertFalse(frappe.db.exists('Update Request', update_request.name))
+
+  def test_deadlock_in_the_worker_is_retried(self):
+    frappe.local.conf.fsm_retry_max_attempts = 3
+    doc = fixtures.make_document(0)
+
+    def conflicting_title(target):
+      raise frappe.TimestampMismatchError
+
+    self.patch_controller('_title', conflicting_title)
+    update_request = self.submit(doc, 'title', 'Field', {'value': 'Deadlocked'})
+    self.assertEqual((update_request.status, update_request.retry_count), ('Pending', 1))
+    # The worker only sees committed requests, and rolls back the deadlocked attempt
+    frappe.db.commit()
+    self.addCleanup(self.delete_committed, doc)
+
+    deadlock = self.deadlock()
+
+    def deadlocked_title(target):
+      raise deadlock
+
+    self.patch_controller('_title', deadlocked_title)
+    for retry_count, status in ((2, 'Pending'), (2, 'Failed')):
+      update_request.db_set('next_attempt_on', add_to_date(now_datetime(), seconds=-1), update_modified=False)
+      with patch.object(frappe.db, 'commit'), patch('frappe.log_error'):
+        fsm_retry.retry_update_requests()
+      update_request.reload()
+      self.assertEqual((update_request.status, update_request.retry_count), (status, retry_count))
+      self.assertIn(type(deadlock).__name__, update_request.error)
+    self.assertEqual((update_request.next_attempt_on, update_request.pending_key), (None, None))
+
+  @staticmethod
+  def delete_committed(doc):
+    frappe.db.rollback()
+    names = frappe.get_all('Update Request', filters={'dt': bench_dt, 'docname': doc.name}, pluck='name')
+    if names:
+      frappe.db.delete('Update Request Revert Item', {'parent': ['in', names]})
+      frappe.db.delete('Update Request Event', {'update_request': ['in', names]})
+      frappe.db.delete('Update Request', {'name': ['in', names]})
+    frappe.db.delete('Update Request Head', {'dt': bench_dt, 'docname': doc.name})
+    frappe.db.delete(bench_dt, {'name': doc.name})
+    frappe.db.commit()
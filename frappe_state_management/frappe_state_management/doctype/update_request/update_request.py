@@ -4,12 +4,32 @@
 
 from __future__ import unicode_literals
 
+import hashlib
 from datetime import datetime
 
 import frappe
 from frappe import _, ValidationError
 from frappe.model.document import Document
-from frappe_state_management.classes.fsm_error import PendingUpdateRequestError
+from frappe.utils import add_to_date, cint, now_datetime
+from frappe_state_management.classes.fsm_data import parse_data
+from frappe_state_management.classes.fsm_dispatch import get_handler, get_transitions, get_doctype_info
+from frappe_state_management.classes.fsm_trace import trace, stage
+from frappe_state_management.classes.fsm_bulk import bulk_update_documents, insert_new_children
+from frappe_state_management.classes.fsm_concurrency import load_target
+from frappe_state_management.classes.fsm_feed import record
+from frappe_state_management.classes.fsm_fifo import is_fifo, has_waiting, get_queue_position, release, enqueue_drain
+from frappe_state_management.classes.fsm_queue import is_queued, enqueue_update_request
+from frappe_state_management.classes.fsm_error import PendingUpdateRequestError, MethodNotDefinedError, \
+  MissingOrInvalidDataError, DuplicateUpdateRequestError
+from frappe_state_management.frappe_state_management.doctype.update_request_head.update_request_head import get_head, \
+  set_head
+
+# Types applying a list of rows on a child table at once
+child_rows_types = ['Add Child Rows', 'Update Child Rows', 'Delete Child Rows']
+# Fields changed while a request is applied or reverted, written by `UpdateRequest.persist`
+lifecycle_fields = ['status', 'error', 'created_docname', 'created_count', 'failed_count', 'approval_party',
+                    'applied_on', 'previous_request', 'pending_key', 'retry_count', 'next_attempt_on', 'modified',
+                    'modified_by']
 
 
 class UpdateRequest(Document):
@@ -28,32 +48,53 @@ class UpdateRequest(Document):
   approved_on: datetime
   rejected_by: str
   rejected_on: datetime
+  applied_on: datetime
   revert_items: list
   error: str
+  pending_key: str
+  previous_request: str
+  queued: int
+  enqueued_on: datetime
+  duration_ms: float
+  idempotency_key: str
+  idempotency_scope: str
+  waiting: int
+  created_count: int
+  failed_count: int
+  retry_count: int
+  next_attempt_on: datetime
 
   def validate(self):
 
     # Check if the target doctype is a child doctype
-    meta = frappe.get_meta(self.dt)
-    if meta.istable:
+    doctype_info = get_doctype_info(self.dt)
+    if doctype_info.istable:
       frappe.throw(_("Child DocTypes not allowed"))
 
-    # Check if existing Pending Update Request exist
-    requests = frappe.get_all('Update Request',
-                              filters=[["dt", "=", self.dt], ["docstatus", "=", 1], ['docname', '!=', None],
-                                       ['docname', '=', self.docname],
-                                       ["status", "IN", ['Pending', 'Pending Approval']]])
+    # Check if the request was already submitted, see `get_by_idempotency_scope`
+    if self.is_new() and self.idempotency_key and get_by_idempotency_scope(self.get_idempotency_scope()):
+      raise DuplicateUpdateRequestError
 
-    if len(requests) > 0:
+    # Check if existing Pending Update Request exist
+    pending_key = self.get_pending_key()
+    fifo = pending_key and is_fifo(self.dt)
+    with trace('UpdateRequest.validate', self), stage('pending_check'):
+      pending = pending_key and frappe.db.exists('Update Request',
+                                                 {'pending_key': pending_key, 'name': ['!=', self.name]})
+      # Requests of FIFO doctypes also queue up behind the ones already waiting
+      if fifo and not pending:
+        pending = has_waiting(self.dt, self.docname, exclude=self.name)
+    self.waiting = 1 if fifo and pending else 0
+    if pending and not fifo:
       raise PendingUpdateRequestError
 
     if self.request_type != 'Create':
 
-      # Check if the target doctype extends FSMDocument
-      from frappe_state_management.classes.fsm_document import FSMDocument
-      doc = frappe.get_doc(self.dt, self.docname)
-      if not isinstance(doc, FSMDocument):
+      # Check if the target doctype extends FSMDocument, and that the target exists, without loading it
+      if not doctype_info.is_fsm_document:
         frappe.throw(_("Target DocType does not extend FSMDocument"), ValidationError)
+      if not self.flags.target_doc and not frappe.db.exists(self.dt, self.docname):
+        frappe.throw(_("{0} {1} not found").format(_(self.dt), self.docname), frappe.DoesNotExistError)
 
       # Check if either docfield or custom call is specified
       if not self.docfield and not self.custom_call:
@@ -61,10 +102,58 @@ class UpdateRequest(Document):
 
       if self.docfield and not self.type:
         frappe.throw(_("Docfield type must be selected"), ValidationError)
+
+      # Check if the target doctype handles the request. Child rows types have a default handling
+      if not get_handler(self.dt, self.docfield, self.custom_call) and self.type not in child_rows_types:
+        raise MethodNotDefinedError
+
+      self.validate_transition()
     else:
-      if not self.data or not isinstance(frappe.parse_json(self.data), frappe._dict):
+      # A list of payloads creates a document per payload, see `FSMDocument.create_documents`
+      try:
+        data = self.get_data(strict=True)
+        if isinstance(data, list):
+          if not len(data) or not all(isinstance(x, dict) and x.get('doctype', self.dt) == self.dt for x in data):
+            raise MissingOrInvalidDataError
+        elif not isinstance(data, dict):
+          raise MissingOrInvalidDataError
+      except MissingOrInvalidDataError:
+        frappe.throw(_("Invalid Data field, make sure it's a JSON object or a list of JSON objects of {0}")
+                     .format(self.dt), ValidationError)
+
+    # Reject non JSON payloads if the site enforces it
+    if self.data and self.request_type != 'Create' and frappe.conf.get('fsm_strict_data'):
+      try:
+        self.get_data(strict=True)
+      except MissingOrInvalidDataError:
         frappe.throw(_("Invalid Data field, make sure it's a JSON object"), ValidationError)
 
+  def validate_transition(self):
+    """
+    Rejects the request if the value it sets on `docfield` is not an allowed transition from the current value,
+    reading only that value from the database. Only requests carrying the value in their data, as
+    {"value": ...} or {<docfield>: ...}, are checked here. The others, and requests applied after earlier ones
+    in the same batch or queue, are checked by `FSMDocument.validate_transitions` once their handler ran
+    :return:
+    """
+    transitions = get_transitions(self.dt)
+    if not self.docfield or not transitions.has_field(self.docfield):
+      return
+    if self.flags.target_doc or self.waiting or is_queued(self.dt):
+      return
+    try:
+      data = self.get_data()
+    except MissingOrInvalidDataError:
+      return
+    if not isinstance(data, dict):
+      return
+
+    for key in (self.docfield, 'value'):
+      if key in data:
+        current = frappe.db.get_value(self.dt, self.docname, self.docfield)
+        transitions.validate(self.docfield, current, data[key])
+        return
+
   def before_insert(self):
     """
     Make sure that the status and other fields are set correctly
@@ -73,6 +162,8 @@ class UpdateRequest(Document):
     if self.status != 'Pending':
       self.status = 'Pending'
     self.created_docname = ''
+    self.created_count = 0
+    self.failed_count = 0
     self.error = ''
     self.revert_items = []
     self.approval_party = ''
@@ -80,20 +171,68 @@ class UpdateRequest(Document):
     self.approved_on = None
     self.rejected_by = ''
     self.rejected_on = None
+    self.applied_on = None
+    self.pending_key = None
+    self.previous_request = None
+    self.queued = 0
+    self.enqueued_on = None
+    self.duration_ms = 0
+    self.idempotency_scope = self.get_idempotency_scope()
+    self.waiting = 0
+    self.retry_count = 0
+    self.next_attempt_on = None
+
+  def onload(self):
+    self.set_onload('queue_position', self.get_queue_position())
+
+  @frappe.whitelist()
+  def get_queue_position(self):
+    """
+    The position of the request in the queue of its document, 0 if it's not waiting
+    :return:
+    """
+    return get_queue_position(self)
+
+  def before_submit(self):
+    """
+    Claim the target document. The unique `pending_key` makes concurrent submissions fail at the database level
+    :return:
+    """
+    self.set_pending_key()
+
+  def before_update_after_submit(self):
+    """
+    Release the target document once the request leaves the Pending states
+    :return:
+    """
+    self.set_pending_key()
 
   def on_submit(self):
     """
-    Applies the update on the target doctype by calling the `apply_update_request`
+    Applies the update on the target doctype by calling the `apply_update_request`,
+    or enqueues it if the target doctype is queued. Waiting requests are applied once the document is released,
+    a drain is also enqueued in case the document was released before this request was committed
     :return:
     """
-    self.apply_update_request()
+    if self.waiting:
+      enqueue_drain(self.dt, self.docname)
+      return
+    self.apply_or_enqueue()
 
   def on_update_after_submit(self):
     """
-    In case the update request is approved, apply the update request
+    In case the update request is approved, apply the update request.
+    Once it's processed, the requests waiting on the same document can proceed
     :return:
     """
     if self.status == 'Approved':
+      self.apply_or_enqueue()
+    release([self])
+
+  def apply_or_enqueue(self):
+    if is_queued(self.dt):
+      enqueue_update_request(self)
+    else:
       self.apply_update_request()
 
   def apply_update_request(self):
@@ -102,23 +241,177 @@ class UpdateRequest(Document):
     :return:
     """
 
-    if self.request_type != 'Create':
-      doc = frappe.get_doc(self.dt, self.docname)
-      getattr(doc, 'apply_update_request')(self)
-    else:
-      doc = frappe.get_doc(frappe.parse_json(self.data))
-      getattr(doc, 'create_document')(self)
+    with trace('UpdateRequest.apply_update_request', self, store_duration=True):
+      if self.request_type != 'Create':
+        doc = load_target(self.dt, self.docname)
+        getattr(doc, 'apply_update_request')(self)
+      elif isinstance(self.get_data(), list):
+        with stage('load_target'):
+          doc = frappe.get_doc({'doctype': self.dt})
+        getattr(doc, 'create_documents')(self)
+      else:
+        with stage('load_target'):
+          doc = frappe.get_doc(self.get_data())
+        getattr(doc, 'create_document')(self)
+
+  def get_data(self, strict=False):
+    """
+    The parsed `data`, decoded once per instance and reused until `data` changes
+    :param strict: Reject payloads that are not JSON
+    :return:
+    """
+    cached = self.__dict__.get('_parsed_data')
+    if not cached or cached[0] != self.data or (strict and not cached[2]):
+      cached = (self.data, parse_data(self.data, strict=strict), strict)
+      self.__dict__['_parsed_data'] = cached
+    return cached[1]
+
+  def get_pending_key(self):
+    """
+    The key identifying the target document, shared by all its Update Requests
+    :return:
+    """
+    if self.request_type == 'Create' or not self.docname:
+      return None
+    return '{}::{}'.format(self.dt, self.docname)
+
+  def persist(self):
+    """
+    Writes the fields changed while applying or reverting the request with one update query, and the new revert
+    items with one insert query. Unlike a full save, existing revert items are not rewritten and the submit hooks
+    are not run again
+    :return:
+    """
+    self.set_pending_key()
+    self.set_user_and_timestamp()
+    values = {field: self.get(field) for field in lifecycle_fields}
+    frappe.db.sql("""
+      UPDATE `tabUpdate Request` SET {assignments} WHERE name = %(name)s
+    """.format(assignments=', '.join('`{0}` = %({0})s'.format(x) for x in lifecycle_fields)),
+                  dict(values, name=self.name))
+    insert_new_children(self)
+
+  def set_pending_key(self):
+    """
+    Only Pending and Pending Approval requests, and requests waiting for a retry, hold the key
+    :return:
+    """
+    self.pending_key = self.get_pending_key() \
+      if (self.status in ('Pending', 'Pending Approval') or self.next_attempt_on) and not self.waiting else None
+
+  def get_idempotency_scope(self):
+    """
+    The idempotency key scoped to the target document, or to the owner for Create requests, hashed to fit the column
+    :return:
+    """
+    if not self.idempotency_key:
+      return None
+    scope = '{}::{}::{}'.format(self.dt, self.docname or self.owner or frappe.session.user, self.idempotency_key)
+    return hashlib.sha1(scope.encode()).hexdigest()
+
+  def db_insert(self, *args, **kwargs):
+    try:
+      return super().db_insert(*args, **kwargs)
+    except PendingUpdateRequestError:
+      if not self.wait_behind_claim():
+        raise
+      return super().db_insert(*args, **kwargs)
+
+  def db_update(self, *args, **kwargs):
+    try:
+      return super().db_update(*args, **kwargs)
+    except PendingUpdateRequestError:
+      if not self.wait_behind_claim():
+        raise
+      return super().db_update(*args, **kwargs)
+
+  def wait_behind_claim(self) -> bool:
+    """
+    Another request claimed the target document between `validate` and the database write.
+    Requests of FIFO doctypes are stored as waiting instead of failing
+    :return: True if the request now waits
+    """
+    if self.waiting or not self.pending_key or not is_fifo(self.dt):
+      return False
+    self.waiting = 1
+    self.pending_key = None
+    return True
+
+  def show_unique_validation_message(self, e):
+    # Another request claimed the target document between `validate` and the database write
+    if 'pending_key' in str(e.args):
+      raise PendingUpdateRequestError
+    # A retry of the same submission was inserted in the meantime
+    if 'idempotency_scope' in str(e.args):
+      raise DuplicateUpdateRequestError
+    super().show_unique_validation_message(e)
+
+  def set_as_head(self):
+    """
+    Makes this request the latest successful one of the target document, chaining it to the previous head
+    :return:
+    """
+    if not self.docname:
+      return
+    self.previous_request = get_head(self.dt, self.docname)
+    set_head(self.dt, self.docname, self.name)
+
+  def remove_as_head(self):
+    """
+    Moves the head of the target document back to the request applied before this one
+    :return:
+    """
+    if not self.docname:
+      return
+    set_head(self.dt, self.docname, self.previous_request)
 
-  def revert(self):
+  def revert(self, dry_run=False):
     """
     Calls the revert function of the document.
     Validates before applying the revert
+    :param dry_run: Return the planned revert operations without applying them
     :return:
     """
     self.validate_revert()
 
+    # Create requests have no target, an unsaved document of the doctype runs the revert
+    doc = frappe.get_doc(self.dt, self.docname) if self.docname else frappe.get_doc({'doctype': self.dt})
+    return getattr(doc, 'revert')(self, dry_run=dry_run)
+
+  def revert_to(self, dry_run=False):
+    """
+    Reverts this request and every successful request applied on the same document after it, newest first.
+    The target document is loaded and saved once
+    :param dry_run: Return the planned revert operations without applying them
+    :return: The reverted Update Requests
+    """
+    if self.status != 'Success':
+      frappe.throw("Update Request is not marked as successful")
+
+    update_requests = self.get_revert_chain()
     doc = frappe.get_doc(self.dt, self.docname)
-    getattr(doc, 'revert')(self)
+    return getattr(doc, 'revert_update_requests')(update_requests, dry_run=dry_run)
+
+  def get_revert_chain(self) -> list:
+    """
+    Walks the chain of successful requests from the head of the target document back to this request
+    :return: The Update Requests, newest first
+    """
+    chain = []
+    name = get_head(self.dt, self.docname)
+    while name and name != self.name:
+      try:
+        update_request = frappe.get_doc('Update Request', name)
+      except frappe.DoesNotExistError:
+        frappe.throw("Update Request {} was archived and can no longer be reverted".format(name))
+      chain.append(update_request)
+      name = update_request.previous_request
+
+    if name != self.name:
+      frappe.throw("Update Request is not part of the document's successful Update Requests")
+
+    chain.append(self)
+    return chain
 
   def validate_revert(self):
     """
@@ -131,11 +424,74 @@ class UpdateRequest(Document):
     if self.status != 'Success':
       frappe.throw("Update Request is not marked as successful")
 
-    # Check if the update request is the latest
-    prev = frappe.get_all("Update Request", filters={'status': 'Success', 'dt': self.dt, 'docname': self.docname},
-                          order_by='modified_date DESC')
-
-    if len(prev) and prev[0].name == self.name:
+    # Check if the update request is the latest. Create requests are not part of a document's requests
+    if not self.docname or get_head(self.dt, self.docname) == self.name:
       return
 
     frappe.throw("Not the latest Successful Update Request")
+
+
+def save_update_requests(update_request_docs: list):
+  """
+  Persists Update Requests that are already submitted and were applied together with
+  `FSMDocument.apply_update_requests`, which does not save them.
+  Writes one update query per request and one insert for all the new revert items
+  :param update_request_docs: The Update Requests
+  :return:
+  """
+  for update_request_doc in update_request_docs:
+    if update_request_doc.status == 'Success':
+      update_request_doc.set_as_head()
+    update_request_doc.set_pending_key()
+  bulk_update_documents(update_request_docs)
+  record(update_request_docs)
+  release(update_request_docs)
+
+
+def persist_update_requests(update_request_docs: list):
+  """
+  Persists Update Requests whose status was changed by `FSMDocument`, see `UpdateRequest.persist`,
+  then records them in the change feed and releases their documents
+  :param update_request_docs: The Update Requests
+  :return:
+  """
+  for update_request_doc in update_request_docs:
+    update_request_doc.persist()
+  record(update_request_docs)
+  release(update_request_docs)
+
+
+def get_by_idempotency_scope(idempotency_scope: str) -> frappe._dict:
+  """
+  The request holding the idempotency scope, read through its unique index
+  :param idempotency_scope: See `UpdateRequest.get_idempotency_scope`
+  :return: {name, dt, docname, status, error} or None
+  """
+  if not idempotency_scope:
+    return None
+  return frappe.db.get_value('Update Request', {'idempotency_scope': idempotency_scope},
+                             ['name', 'dt', 'docname', 'status', 'error'], as_dict=True)
+
+
+def clear_expired_idempotency_keys():
+  """
+  Scheduled hourly. Releases the idempotency keys of the requests created more than `fsm_idempotency_ttl_hours` ago,
+  24 by default. The key itself is kept on the request
+  :return:
+  """
+  ttl_hours = cint(frappe.conf.get('fsm_idempotency_ttl_hours')) or 24
+  frappe.db.sql("""
+    UPDATE `tabUpdate Request`
+    SET idempotency_scope = NULL
+    WHERE idempotency_scope IS NOT NULL AND creation < %s
+  """, add_to_date(now_datetime(), hours=-ttl_hours))
+  frappe.db.commit()
+
+
+def on_doctype_update():
+  frappe.db.add_index('Update Request', ['dt', 'docname', 'status'])
+  frappe.db.add_index('Update Request', ['queued', 'dt', 'docname'])
+  frappe.db.add_index('Update Request', ['approval_party', 'status', 'creation'])
+  frappe.db.add_index('Update Request', ['dt', 'docname', 'applied_on'])
+  frappe.db.add_index('Update Request', ['dt', 'docname', 'waiting'])
+  frappe.db.add_index('Update Request', ['next_attempt_on'])
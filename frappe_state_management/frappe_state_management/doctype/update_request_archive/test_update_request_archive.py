@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Leam Technology Systems and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+from unittest.mock import patch
+
+import frappe
+from frappe.utils import add_days, now_datetime
+from frappe_state_management.api import update_request as api
+from frappe_state_management.benchmarks import fixtures
+from frappe_state_management.benchmarks.fixtures import bench_dt
+from frappe_state_management.frappe_state_management.doctype.update_request.test_update_request import \
+  UpdateRequestTestCase
+from frappe_state_management.frappe_state_management.doctype.update_request_archive.update_request_archive import \
+  compact_update_requests
+
+
+class TestUpdateRequestArchive(UpdateRequestTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.patch_controller('_create_', lambda target: target.insert(ignore_permissions=True))
+    doc = fixtures.make_document(0)
+    self.first = self.submit(doc, 'title', 'Field', {'value': 'First'})
+    self.rejected = self.submit(doc, 'title', 'Field', {'value': 'Rejected'})
+    self.rejected.db_set('status', 'Rejected', update_modified=False)
+    self.head = self.submit(doc, 'title', 'Field', {'value': 'Head'})
+    self.created = frappe.get_doc({
+      'doctype': 'Update Request', 'request_type': 'Create', 'dt': bench_dt, 'party_type': fixtures.party_type,
+      'data': frappe.as_json([{'title': 'Created'}])
+    })
+    self.created.insert(ignore_permissions=True)
+    self.created.submit()
+    self.update_requests = [self.first, self.head, self.rejected, self.created]
+    self.assertEqual([x.status for x in self.update_requests], ['Success', 'Success', 'Rejected', 'Success'])
+
+  def age(self, days: int):
+    frappe.db.sql("UPDATE `tabUpdate Request` SET modified = %s WHERE name IN %s",
+                  (add_days(now_datetime(), -days), [x.name for x in self.update_requests]))
+
+  def compact(self):
+    # The compaction commits after every batch
+    with patch.object(frappe.db, 'commit'):
+      compact_update_requests()
+
+  def get_archived(self) -> list:
+    return [x.name for x in self.update_requests if not frappe.db.exists('Update Request', x.name)]
+
+  def test_compaction_keeps_the_revertible_requests(self):
+    self.age(30)
+    self.compact()
+    self.assertEqual(self.get_archived(), [])
+
+    self.age(100)
+    self.compact()
+    self.assertEqual(self.get_archived(), [self.first.name, self.rejected.name])
+    archive = frappe.get_doc('Update Request Archive', {'update_request': self.first.name})
+    self.assertEqual((archive.status, archive.docname, archive.revert_items_dropped),
+                     ('Success', self.first.docname, 1))
+    self.assertEqual(archive.get_archived_data().data, self.first.data)
+    self.assertFalse(frappe.db.exists('Update Request Revert Item', {'parent': self.first.name}))
+
+    # Still revertible
+    self.head.reload()
+    self.head.revert()
+    self.created.reload()
+    self.created.revert()
+    self.assertEqual([self.get_status(x) for x in (self.head, self.created)], ['Reverted', 'Reverted'])
+
+  def test_compaction_can_be_disabled(self):
+    self.age(100)
+    frappe.local.conf.fsm_history_hot_days = 0
+    self.compact()
+    self.assertEqual(self.get_archived(), [])
+
+  def test_restore(self):
+    self.age(100)
+    self.compact()
+    archive = frappe.db.get_value('Update Request Archive', {'update_request': self.first.name})
+    restored = api.restore(archive)
+    self.assertEqual((restored['name'], restored['status']), (self.first.name, 'Success'))
+    self.assertFalse(frappe.db.exists('Update Request Archive', archive))
+
+    update_request = frappe.get_doc('Update Request', self.first.name)
+    self.assertEqual((update_request.docname, update_request.data), (self.first.docname, self.first.data))
+    # Dropped revert items are not restored
+    self.assertEqual(update_request.revert_items, [])
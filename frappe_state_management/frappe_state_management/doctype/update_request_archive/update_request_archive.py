@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Leam Technology Systems and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+
+import base64
+import zlib
+from datetime import datetime
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_days, cint, now_datetime
+from frappe_state_management.classes.fsm_bulk import bulk_insert_documents
+
+dt = 'Update Request Archive'
+
+# Terminal statuses that are archived once out of the hot window
+archived_statuses = ('Success', 'Failed', 'Rejected')
+
+
+class UpdateRequestArchive(Document):
+  """
+  Compressed copy of an Update Request moved out of the `Update Request` table by `compact_update_requests`.
+  The audit fields are kept as columns, the rest of the request is in `archive_data`
+  """
+  update_request: str
+  status: str
+  request_type: str
+  dt: str
+  docname: str
+  docfield: str
+  type: str
+  party_type: str
+  request_owner: str
+  request_creation: datetime
+  request_modified: datetime
+  approved_by: str
+  rejected_by: str
+  revert_items_dropped: int
+  archive_data: str
+
+  def get_archived_data(self) -> frappe._dict:
+    return frappe._dict(frappe.parse_json(zlib.decompress(base64.b64decode(self.archive_data)).decode()))
+
+  def restore(self):
+    """
+    Moves the Update Request back to the `Update Request` table. Dropped revert items can't be restored
+    :return: The restored Update Request
+    """
+    update_request = frappe.get_doc(dict(self.get_archived_data(), doctype='Update Request'))
+    bulk_insert_documents([update_request])
+    frappe.db.delete(dt, {'name': self.name})
+    return update_request
+
+
+def compress(data: dict) -> str:
+  return base64.b64encode(zlib.compress(frappe.as_json(data, indent=None).encode(), 9)).decode()
+
+
+def compact_update_requests():
+  """
+  Scheduled daily. Archives the Success, Failed and Rejected Update Requests last modified before the hot window,
+  `fsm_history_hot_days` in the site config (90 days by default, 0 disables the compaction).
+  Requests that can still be reverted are kept: the latest successful request of each document, and successful
+  Create requests which have no document to be the latest of. The others are archived and their revert items are
+  dropped.
+  Runs in batches of `fsm_history_batch_size` requests, committing after each batch
+  :return:
+  """
+  hot_days = cint(frappe.conf.get('fsm_history_hot_days', 90))
+  if hot_days <= 0:
+    return
+
+  batch_size = cint(frappe.conf.get('fsm_history_batch_size')) or 1000
+  max_batches = cint(frappe.conf.get('fsm_history_max_batches')) or 100
+  cutoff = add_days(now_datetime(), -hot_days)
+  for i in range(max_batches):
+    archived = compact_batch(cutoff, batch_size)
+    frappe.db.commit()
+    if archived < batch_size:
+      break
+
+
+def compact_batch(cutoff: datetime, batch_size: int) -> int:
+  """
+  Archives one batch of Update Requests
+  :param cutoff: Requests modified before it are archived
+  :param batch_size: Maximum number of requests to archive
+  :return: The number of archived requests
+  """
+  names = frappe.db.sql_list("""
+    SELECT ur.name FROM `tabUpdate Request` ur
+    LEFT JOIN `tabUpdate Request Head` head ON head.update_request = ur.name
+    WHERE ur.docstatus = 1 AND ur.status IN %(statuses)s AND ur.modified < %(cutoff)s AND head.name IS NULL
+      AND NOT (ur.request_type = 'Create' AND ur.status = 'Success')
+    ORDER BY ur.modified ASC
+    LIMIT %(limit)s
+  """, {'statuses': archived_statuses, 'cutoff': cutoff, 'limit': batch_size})
+  if not names:
+    return 0
+
+  revert_items = dict(frappe.db.sql("""
+    SELECT parent, COUNT(*) FROM `tabUpdate Request Revert Item`
+    WHERE parenttype = 'Update Request' AND parent IN %(names)s
+    GROUP BY parent
+  """, {'names': names}))
+
+  archives = []
+  for update_request in frappe.get_all('Update Request', filters={'name': ['in', names]}, fields=['*']):
+    archives.append(frappe.get_doc({
+      'doctype': dt,
+      'update_request': update_request.name,
+      'status': update_request.status,
+      'request_type': update_request.request_type,
+      'dt': update_request.dt,
+      'docname': update_request.docname or update_request.created_docname,
+      'docfield': update_request.docfield,
+      'type': update_request.type,
+      'party_type': update_request.party_type,
+      'request_owner': update_request.owner,
+      'request_creation': update_request.creation,
+      'request_modified': update_request.modified,
+      'approved_by': update_request.approved_by,
+      'rejected_by': update_request.rejected_by,
+      'revert_items_dropped': revert_items.get(update_request.name, 0),
+      'archive_data': compress(update_request)
+    }))
+
+  bulk_insert_documents(archives)
+  frappe.db.delete('Update Request Revert Item', {'parenttype': 'Update Request', 'parent': ['in', names]})
+  frappe.db.delete('Update Request', {'name': ['in', names]})
+  return len(names)
+
+
+def on_doctype_update():
+  frappe.db.add_index(dt, ['dt', 'docname'])
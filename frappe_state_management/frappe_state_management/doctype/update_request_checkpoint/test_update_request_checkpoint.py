@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Leam Technology Systems and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+from frappe.utils import add_to_date, now_datetime
+from frappe_state_management.api import update_request as api
+from frappe_state_management.benchmarks import fixtures
+from frappe_state_management.benchmarks.fixtures import bench_dt
+from frappe_state_management.frappe_state_management.doctype.update_request.test_update_request import \
+  UpdateRequestTestCase
+
+
+class TestUpdateRequestCheckpoint(UpdateRequestTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.patch_hooks(fsm_checkpoints={bench_dt: {'interval': 2}})
+    self.now = now_datetime()
+    self.doc = fixtures.make_document(0)
+    frappe.db.sql("UPDATE `tab{}` SET creation = %s WHERE name = %s".format(bench_dt),
+                  (self.at(-240), self.doc.name))
+    self.update_requests = [self.submit(self.doc, 'title', 'Field', {'value': x}) for x in ('One', 'Two', 'Three')]
+    # Applied an hour apart
+    for update_request, minutes in zip(self.update_requests, (-180, -120, -60)):
+      frappe.db.set_value('Update Request', update_request.name, 'applied_on', self.at(minutes),
+                          update_modified=False)
+    frappe.db.sql("UPDATE `tabUpdate Request Checkpoint` SET taken_on = %s WHERE docname = %s",
+                  (self.at(-120), self.doc.name))
+
+  def at(self, minutes: int):
+    return add_to_date(self.now, minutes=minutes)
+
+  def get_title_at(self, minutes: int):
+    state = api.get_state_at(bench_dt, self.doc.name, self.at(minutes))
+    return state and state['title']
+
+  def test_checkpoint_every_interval(self):
+    self.assertEqual(frappe.get_all('Update Request Checkpoint', filters={'docname': self.doc.name},
+                                    fields=['checkpoint_type', 'update_request']),
+                     [{'checkpoint_type': 'Interval', 'update_request': self.update_requests[1].name}])
+
+  def test_get_state_at(self):
+    # From the checkpoint
+    self.assertEqual(self.get_title_at(-150), 'One')
+    self.assertEqual(self.get_title_at(-120), 'Two')
+    # From the document
+    self.assertEqual(self.get_title_at(-90), 'Two')
+    self.assertEqual(self.get_title_at(-30), 'Three')
+    # Before the document was created
+    self.assertIsNone(self.get_title_at(-300))
+
+  def test_revert_takes_a_checkpoint(self):
+    self.update_requests[2].reload()
+    self.update_requests[2].revert()
+    self.assertEqual(frappe.db.get_value(bench_dt, self.doc.name, 'title'), 'Two')
+    self.assertTrue(frappe.db.exists('Update Request Checkpoint', {'docname': self.doc.name,
+                                                                   'checkpoint_type': 'Revert'}))
+    # The request was applied at the time, the revert came later
+    self.assertEqual(self.get_title_at(-30), 'Three')
+
+  def test_doctypes_without_checkpoints(self):
+    self.patch_hooks(fsm_checkpoints={})
+    self.assertRaises(frappe.ValidationError, self.get_title_at, -30)
@@ -0,0 +1,8 @@
+// Copyright (c) 2026, Leam Technology Systems and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Update Request Checkpoint', {
+	// refresh: function(frm) {
+
+	// }
+});
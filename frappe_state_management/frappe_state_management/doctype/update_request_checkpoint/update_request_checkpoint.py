@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Leam Technology Systems and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+
+import base64
+import zlib
+from datetime import datetime
+
+import frappe
+from frappe.model.document import Document
+
+dt = 'Update Request Checkpoint'
+
+
+class UpdateRequestCheckpoint(Document):
+  """
+  Snapshot of a document taken by `fsm_checkpoint`, used to rebuild the document at a past time
+  """
+  dt: str
+  docname: str
+  taken_on: datetime
+  checkpoint_type: str
+  update_request: str
+  checkpoint_data: str
+
+  def get_checkpoint_data(self) -> frappe._dict:
+    return get_checkpoint_data(self.checkpoint_data)
+
+
+def get_checkpoint_data(checkpoint_data: str) -> frappe._dict:
+  return frappe._dict(frappe.parse_json(zlib.decompress(base64.b64decode(checkpoint_data)).decode()))
+
+
+def on_doctype_update():
+  frappe.db.add_index(dt, ['dt', 'docname', 'taken_on'])
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Leam Technology Systems and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+from unittest.mock import patch
+
+import frappe
+from frappe.utils import cint
+from frappe_state_management.benchmarks import fixtures
+from frappe_state_management.benchmarks.fixtures import bench_dt
+from frappe_state_management.classes import fsm_feed
+from frappe_state_management.frappe_state_management.doctype.update_request.test_update_request import \
+  UpdateRequestTestCase
+
+
+class TestUpdateRequestEvent(UpdateRequestTestCase):
+
+  def setUp(self):
+    super().setUp()
+    frappe.cache().delete_value(fsm_feed.sequencing_key)
+    self.cursor = cint(frappe.db.sql("SELECT MAX(sequence) FROM `tabUpdate Request Event`")[0][0])
+
+  @staticmethod
+  def make_events(count: int, dt=bench_dt) -> list:
+    return [frappe._dict(name='fsm-test-{}'.format(i), request_type='Update', dt=dt, docname='fsm-test',
+                         status='Success') for i in range(count)]
+
+  def test_events_are_sequenced_and_read_with_a_cursor(self):
+    doc = fixtures.make_document(0)
+    update_requests = [self.submit(doc, 'title', 'Field', {'value': x}) for x in ('First', 'Second')]
+
+    changes = fsm_feed.get_changes(self.cursor, limit=1, dt=bench_dt)
+    self.assertEqual([(x.update_request, x.status) for x in changes.events], [(update_requests[0].name, 'Success')])
+    self.assertEqual(changes.cursor, changes.events[0].sequence)
+    changes = fsm_feed.get_changes(changes.cursor, limit=10, dt=bench_dt)
+    self.assertEqual([x.update_request for x in changes.events], [update_requests[1].name])
+    self.assertEqual([x.update_request for x in fsm_feed.get_changes(changes.cursor).events], [])
+    # The cursor stays put once the feed is read
+    self.assertEqual(fsm_feed.get_changes(changes.cursor).cursor, changes.cursor)
+    self.assertEqual(fsm_feed.get_changes(self.cursor, dt='ToDo').events, [])
+
+  def test_sequencing_is_enqueued_once(self):
+    with patch('frappe.enqueue') as enqueue:
+      fsm_feed.record(self.make_events(2))
+      fsm_feed.record(self.make_events(1))
+      self.assertEqual(enqueue.call_count, 1)
+      self.assertEqual(fsm_feed.get_changes(self.cursor).events, [])
+
+      fsm_feed.assign_sequences()
+      events = fsm_feed.get_changes(self.cursor, dt=bench_dt).events
+      self.assertEqual(sorted(x.update_request for x in events), ['fsm-test-0', 'fsm-test-0', 'fsm-test-1'])
+      self.assertEqual(sorted(set(x.sequence for x in events)), [x.sequence for x in events])
+      # Events written once the job started enqueue another one
+      fsm_feed.record(self.make_events(1))
+      self.assertEqual(enqueue.call_count, 2)
+
+  def test_redis_feed(self):
+    frappe.local.conf.fsm_change_feed = 'redis'
+    key = 'fsm_change_feed_test_{}'.format(frappe.generate_hash(length=8))
+    self.addCleanup(frappe.cache().delete_value, key)
+
+    with patch.object(fsm_feed, 'stream_key', key), patch('frappe.enqueue') as enqueue:
+      fsm_feed.record(self.make_events(2) + self.make_events(1, dt='ToDo'))
+      self.assertFalse(enqueue.called)
+
+      changes = fsm_feed.get_changes(limit=1)
+      self.assertEqual([x.update_request for x in changes.events], ['fsm-test-0'])
+      changes = fsm_feed.get_changes(changes.cursor, dt=bench_dt)
+      self.assertEqual([x.update_request for x in changes.events], ['fsm-test-1'])
+      self.assertEqual(fsm_feed.get_changes(changes.cursor).events[0].dt, 'ToDo')
+    # Nothing is written to the table
+    self.assertFalse(frappe.db.exists('Update Request Event', {'update_request': 'fsm-test-0'}))
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Leam Technology Systems and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+import frappe
+from frappe.model.document import Document
+
+dt = 'Update Request Event'
+
+
+class UpdateRequestEvent(Document):
+  """
+  Entry of the change feed, written by `fsm_feed.record` when an Update Request reaches a terminal status.
+  Entries are append-only and ordered by `sequence`
+  """
+  sequence: int
+  update_request: str
+  request_type: str
+  dt: str
+  docname: str
+  status: str
+  event_on: datetime
+
+
+def on_doctype_update():
+  frappe.db.add_index(dt, ['event_on'])
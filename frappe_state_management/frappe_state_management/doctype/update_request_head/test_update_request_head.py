@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Leam Technology Systems and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+from frappe_state_management.api import update_request as api
+from frappe_state_management.benchmarks import fixtures
+from frappe_state_management.benchmarks.fixtures import bench_dt
+from frappe_state_management.frappe_state_management.doctype.update_request.test_update_request import \
+  UpdateRequestTestCase
+from frappe_state_management.frappe_state_management.doctype.update_request_head.update_request_head import get_head
+
+
+class TestUpdateRequestHead(UpdateRequestTestCase):
+
+  def test_apply_bulk_moves_the_head_of_a_new_document(self):
+    doc = fixtures.make_document(0)
+    results = api.apply_bulk([
+      self.request(doc, 'title', 'Field', {'value': 'One'}),
+      self.request(doc, 'title', 'Field', {'value': 'Two'}),
+    ])
+    self.assertEqual([x.status for x in results], ['Success', 'Success'], [x.error for x in results])
+    self.assertEqual(get_head(bench_dt, doc.name), results[1].name)
+    self.assertEqual(frappe.db.get_value('Update Request', results[1].name, 'previous_request'), results[0].name)
+
+  def test_head_moves_and_revert_to(self):
+    doc = fixtures.make_document(0)
+    update_requests = [self.submit(doc, 'title', 'Field', {'value': x}) for x in ('One', 'Two', 'Three')]
+    first, second, third = update_requests
+    self.assertEqual([x.status for x in update_requests], ['Success'] * 3)
+    self.assertEqual(get_head(bench_dt, doc.name), third.name)
+    third.reload()
+    self.assertEqual(third.previous_request, second.name)
+
+    first.reload()
+    # Only the head can be reverted on its own
+    self.assertRaises(frappe.ValidationError, first.revert)
+
+    reverted = first.revert_to()
+    self.assertEqual([x.name for x in reverted], [third.name, second.name, first.name])
+    self.assertEqual([self.get_status(x) for x in update_requests], ['Reverted'] * 3)
+    self.assertFalse(get_head(bench_dt, doc.name))
+    doc.reload()
+    self.assertEqual(doc.title, 'Benchmark')
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Leam Technology Systems and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+
+import frappe
+from frappe.model.document import Document
+
+dt = 'Update Request Head'
+
+
+class UpdateRequestHead(Document):
+  """
+  Points at the latest successful Update Request of a document.
+  Named after the document so the head is fetched with a primary key lookup
+  """
+  dt: str
+  docname: str
+  update_request: str
+
+  def autoname(self):
+    self.name = get_head_name(self.dt, self.docname)
+
+
+def get_head_name(doctype: str, docname: str) -> str:
+  return '{}::{}'.format(doctype, docname)
+
+
+def get_head(doctype: str, docname: str):
+  """
+  The latest successful Update Request of the document
+  :param doctype: The target doctype
+  :param docname: The target docname
+  :return: The Update Request name or None
+  """
+  return frappe.db.get_value(dt, get_head_name(doctype, docname), 'update_request')
+
+
+def set_head(doctype: str, docname: str, update_request):
+  """
+  Moves the head of the document. The head is removed if `update_request` is empty
+  :param doctype: The target doctype
+  :param docname: The target docname
+  :param update_request: The Update Request name
+  :return:
+  """
+  name = get_head_name(doctype, docname)
+  if not update_request:
+    frappe.db.delete(dt, {'name': name})
+  elif frappe.db.exists(dt, name):
+    frappe.db.set_value(dt, name, 'update_request', update_request)
+  else:
+    # Bulk applications move the head before inserting their Update Requests, the link can't be checked yet
+    frappe.get_doc(doctype=dt, dt=doctype, docname=docname, update_request=update_request).insert(
+        ignore_permissions=True, ignore_links=True)
@@ -13,6 +13,9 @@ app_license = "MIT"
 
 fixtures = [{'dt': 'Property Setter', 'filters': [['app_name', '=', 'frappe_state_management']]}]
 
+# Drop the resolved Update Request handlers when the cache is cleared
+clear_cache = "frappe_state_management.classes.fsm_dispatch.clear_registry"
+
 # Includes in <head>
 # ------------------
 
@@ -110,6 +113,25 @@ fixtures = [{'dt': 'Property Setter', 'filters': [['app_name', '=', 'frappe_stat
 # 	]
 # }
 
+scheduler_events = {
+	"cron": {
+		"* * * * *": [
+			"frappe_state_management.classes.fsm_retry.retry_update_requests",
+			"frappe_state_management.classes.fsm_feed.assign_sequences",
+			"frappe_state_management.classes.fsm_fifo.drain_unclaimed_documents",
+			"frappe_state_management.classes.fsm_queue.requeue_stale_update_requests"
+		]
+	},
+	"hourly": [
+		"frappe_state_management.frappe_state_management.doctype.update_request.update_request.clear_expired_idempotency_keys"
+	],
+	"daily": [
+		"frappe_state_management.frappe_state_management.doctype.update_request_archive.update_request_archive.compact_update_requests",
+		"frappe_state_management.classes.fsm_feed.clear_old_events",
+		"frappe_state_management.classes.fsm_checkpoint.clear_old_checkpoints"
+	]
+}
+
 # Testing
 # -------
 
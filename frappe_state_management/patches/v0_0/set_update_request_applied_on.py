@@ -0,0 +1,15 @@
+import frappe
+
+
+def execute():
+  """
+  Approximate when the existing requests were applied: successful requests were last modified when they succeeded,
+  reverted ones were modified by the revert so their creation is used instead
+  :return:
+  """
+  frappe.reload_doc('frappe_state_management', 'doctype', 'update_request')
+  frappe.db.sql("""
+    UPDATE `tabUpdate Request`
+    SET applied_on = IF(status = 'Success', modified, creation)
+    WHERE docstatus = 1 AND status IN ('Success', 'Reverted') AND applied_on IS NULL
+  """)
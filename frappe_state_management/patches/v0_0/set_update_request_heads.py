@@ -0,0 +1,26 @@
+import frappe
+from frappe_state_management.frappe_state_management.doctype.update_request_head.update_request_head import set_head
+
+
+def execute():
+  """
+  Chain the existing successful Update Requests of every document and point its head at the latest one
+  :return:
+  """
+  frappe.reload_doc('frappe_state_management', 'doctype', 'update_request')
+  frappe.reload_doc('frappe_state_management', 'doctype', 'update_request_head')
+
+  heads = {}
+  for update_request in frappe.db.sql("""
+    SELECT name, dt, docname FROM `tabUpdate Request`
+    WHERE docstatus = 1 AND status = 'Success' AND IFNULL(docname, '') != ''
+    ORDER BY creation ASC
+  """, as_dict=True):
+    key = (update_request.dt, update_request.docname)
+    if key in heads:
+      frappe.db.set_value('Update Request', update_request.name, 'previous_request', heads[key],
+                          update_modified=False)
+    heads[key] = update_request.name
+
+  for (doctype, docname), update_request in heads.items():
+    set_head(doctype, docname, update_request)
@@ -0,0 +1,16 @@
+import frappe
+
+
+def execute():
+  """
+  Claim the target documents of the Update Requests that are already Pending or Pending Approval.
+  IGNORE keeps the first claim if a document has more than one such request
+  :return:
+  """
+  frappe.reload_doc('frappe_state_management', 'doctype', 'update_request')
+  frappe.db.sql("""
+    UPDATE IGNORE `tabUpdate Request`
+    SET pending_key = CONCAT(dt, '::', docname)
+    WHERE docstatus = 1 AND status IN ('Pending', 'Pending Approval')
+      AND request_type != 'Create' AND IFNULL(docname, '') != ''
+  """)